@@ -0,0 +1,97 @@
+"""
+Measure the per-token overhead of the executor framework, i.e. the time
+BaseExecutor._serve spends on wrapping, accounting and encoding each piece
+yielded by an executor that streams canned tokens without any delay.
+The framework is benchmarked with and without the coalescing window against
+the bare executor.
+
+Example:
+    python benchmark/bench_serve.py -n 20 --tokens 10000
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from statistics import median
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from kuwa.executor.base_executor import BaseExecutor
+from kuwa.executor.metrics import ExecutorMetrics
+
+
+class TokenExecutor(BaseExecutor):
+    """
+    An executor streaming the same token as fast as possible.
+    """
+
+    def __init__(self, n_tokens, token):
+        super().__init__()
+        self.n_tokens = n_tokens
+        self.token = token
+
+    async def serve(self, header, content):
+        for _ in range(self.n_tokens):
+            yield self.token
+
+
+async def measure_once(stream, n_tokens):
+    n_frames = 0
+    n_bytes = 0
+    start_time = time.perf_counter()
+    async for frame in stream:
+        n_frames += 1
+        n_bytes += len(frame)
+    duration = time.perf_counter() - start_time
+    return duration / n_tokens, n_frames, n_bytes
+
+
+async def measure(executor, n, bare=False):
+    per_token, n_frames, n_bytes = [], 0, 0
+    for _ in range(n):
+        if bare:
+            stream = executor.serve(header={}, content={})
+        else:
+            stream = executor._serve(header={}, content={})
+        duration, n_frames, n_bytes = await measure_once(stream, executor.n_tokens)
+        per_token.append(duration)
+    return {
+        "per_token_us": median(per_token) * 1e6,
+        "frames": n_frames,
+        "bytes": n_bytes,
+    }
+
+
+async def benchmark(args):
+    executor = TokenExecutor(args.tokens, args.token)
+    executor.metrics = ExecutorMetrics("bench")
+
+    report = {"bare": await measure(executor, args.n, bare=True)}
+    variants = [("framework", 0, 0)]
+    if hasattr(executor, "coalesce_ms"):
+        variants.append(("coalesced", args.coalesce_bytes, args.coalesce_ms))
+    for name, coalesce_bytes, coalesce_ms in variants:
+        executor.coalesce_bytes = coalesce_bytes
+        executor.coalesce_ms = coalesce_ms
+        result = await measure(executor, args.n)
+        result["added_per_token_us"] = result["per_token_us"] - report["bare"]["per_token_us"]
+        report[name] = result
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the per-token overhead of the executor framework.")
+    parser.add_argument("-n", type=int, default=20, help="Iteration of benchmark.")
+    parser.add_argument("--tokens", type=int, default=10000, help="The number of tokens streamed by the executor.")
+    parser.add_argument("--token", default="Lorem", help="The token streamed by the executor.")
+    parser.add_argument("--coalesce_bytes", type=int, default=1024, help="The coalescing window in bytes.")
+    parser.add_argument("--coalesce_ms", type=float, default=20, help="The coalescing window in milliseconds.")
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(benchmark(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -15,8 +15,9 @@ from openai.resources.chat.completions import AsyncCompletions
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from kuwa.executor import LLMExecutor, Modelfile
+from kuwa.executor import LLMExecutor, Modelfile, CancellationToken
 from kuwa.executor.llm_executor import extract_user_attachment
+from kuwa.executor.message import UsageChunk
 from kuwa.executor.multi_modality import get_supported_image_mime, fetch_image_as_data_url
 from kuwa.executor.util import (
     expose_function_parameter,
@@ -218,20 +219,24 @@ class ChatGptExecutor(LLMExecutor):
             f"Generation config:\n{pprint.pformat(self.generation_config, indent=2)}"
         )
 
-        self.proc = False
-
-    def num_tokens_from_messages(self, messages):
+    def get_encoding(self):
         """
-        Return the number of tokens used by a list of messages.
-        Reference: https://cookbook.openai.com/examples/how_to_count_tokens_with_tiktoken
+        Return the tiktoken encoding of the model.
         """
         try:
-            encoding = tiktoken.encoding_for_model(self.model_name)
+            return tiktoken.encoding_for_model(self.model_name)
         except KeyError:
             logger.warning(
                 f"Model {self.model_name} not found. Using cl100k_base encoding."
             )
-            encoding = tiktoken.get_encoding("cl100k_base")
+            return tiktoken.get_encoding("cl100k_base")
+
+    def num_tokens_from_messages(self, messages):
+        """
+        Return the number of tokens used by a list of messages.
+        Reference: https://cookbook.openai.com/examples/how_to_count_tokens_with_tiktoken
+        """
+        encoding = self.get_encoding()
 
         # Fixed value for nowadays GPT-3.5/4
         tokens_per_message = 3
@@ -274,7 +279,12 @@ class ChatGptExecutor(LLMExecutor):
 
         return result
 
-    async def llm_compute(self, history: list[dict], modelfile: Modelfile):
+    async def llm_compute(
+        self,
+        history: list[dict],
+        modelfile: Modelfile,
+        cancel_token: CancellationToken = None,
+    ):
         try:
             openai_token = self.api_key
             if not self.no_override_api_key:
@@ -326,12 +336,14 @@ class ChatGptExecutor(LLMExecutor):
                 return
 
             # Trim the history to fit into the context window
-            while self.num_tokens_from_messages(msg) > self.context_window:
+            prompt_length = self.num_tokens_from_messages(msg)
+            while prompt_length > self.context_window:
                 msg = msg[1:]
                 if len(msg) == 0:
                     logging.debug("Aborted since the input message exceeds the limit.")
                     yield "[Sorry, The input message is too long!]"
                     return
+                prompt_length = self.num_tokens_from_messages(msg)
 
             openai_token = openai_token.strip()
             openai.api_key = openai_token
@@ -339,21 +351,26 @@ class ChatGptExecutor(LLMExecutor):
             client = openai.AsyncOpenAI(
                 api_key=openai_token, base_url=self.openai_base_url
             )
-            self.proc = True
             logger.debug(f"msg: {msg}")
             response = await client.chat.completions.create(
                 model=model_name, messages=msg, stream=True, **generation_config
             )
+            output = []
             async for i in response:
                 chunk = i.choices[0].delta.content
-                if not self.proc:
+                if cancel_token is not None and cancel_token.cancelled:
                     break
                 if not chunk:
                     continue
 
                 if self.in_debug():
                     print(end=chunk, flush=True)
+                output.append(chunk)
                 yield chunk
+            yield UsageChunk(
+                prompt_tokens=prompt_length,
+                completion_tokens=len(self.get_encoding().encode("".join(output))),
+            )
 
             openai.api_key = None
         except Exception as e:
@@ -363,16 +380,8 @@ class ChatGptExecutor(LLMExecutor):
             else:
                 yield str(e)
         finally:
-            self.proc = False
             logger.debug("finished")
 
-    async def abort(self):
-        if self.proc:
-            self.proc = False
-            logger.debug("aborted")
-            return "Aborted"
-        return "No process to abort"
-
 
 if __name__ == "__main__":
     executor = ChatGptExecutor()
@@ -22,19 +22,12 @@ class DebugExecutor(LLMExecutor):
             "--delay", type=float, default=0.02, help="Inter-token delay"
         )
 
-    def setup(self):
-        self.stop = False
-
     async def llm_compute(self, history: list[dict], modelfile: Modelfile):
         try:
-            self.stop = False
             if history[-1]["content"] == "/crash":
                 raise RuntimeError("oiiaioiiiiai")
             for i in "".join([i["content"] for i in history]).strip():
                 yield i
-                if self.stop:
-                    self.stop = False
-                    break
                 await asyncio.sleep(
                     modelfile.parameters.get("llm_delay", self.args.delay)
                 )
@@ -44,11 +37,6 @@ class DebugExecutor(LLMExecutor):
         finally:
             logger.debug("finished")
 
-    async def abort(self):
-        self.stop = True
-        logger.debug("aborted")
-        return "Aborted"
-
 
 if __name__ == "__main__":
     executor = DebugExecutor()
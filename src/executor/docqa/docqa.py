@@ -228,7 +228,6 @@ class DocQaExecutor(LLMExecutor):
             display_ref_content=self.display_ref_content,
             disable_generator=generator_params.get("disable", False),
         )
-        self.proc = False
 
         # Pre-warm
         if self.pre_built_db is not None:
@@ -263,7 +262,6 @@ class DocQaExecutor(LLMExecutor):
                 return
         document_store.init_retriever(self.retriever_param)
 
-        self.proc = True
         response_generator = self.docqa.process(
             document_store=document_store,
             docs=docs,
@@ -273,8 +271,6 @@ class DocQaExecutor(LLMExecutor):
         )
 
         async for reply in response_generator:
-            if not self.proc:
-                await response_generator.aclose()
             yield reply
 
     async def _failback_to_generator(self, chat_history: [dict], modelfile: Modelfile):
@@ -283,10 +279,7 @@ class DocQaExecutor(LLMExecutor):
         logger.debug(f"History: {history}")
         response_generator = self.llm.chat_complete(messages=history)
 
-        self.proc = True
         async for reply in response_generator:
-            if not self.proc:
-                await response_generator.aclose()
             yield reply
 
     def is_rag_session_ended(self, history: [dict], url):
@@ -360,13 +353,6 @@ class DocQaExecutor(LLMExecutor):
         finally:
             logger.info("Done")
 
-    async def abort(self):
-        if self.proc:
-            self.proc = False
-            logger.debug("aborted")
-            return "Aborted"
-        return "No process to abort"
-
 
 if __name__ == "__main__":
     executor = DocQaExecutor()
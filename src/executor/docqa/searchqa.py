@@ -268,7 +268,6 @@ class SearchQaExecutor(LLMExecutor):
             if len(urls) == 0 and not self.doc_qa.allow_failback:
                 raise NoUrlException(i18n.t("searchqa.search_unreachable"))
 
-            self.proc = True
             response_generator = self.doc_qa.doc_qa(
                 urls=urls,
                 chat_history=history,
@@ -276,8 +275,6 @@ class SearchQaExecutor(LLMExecutor):
             )
 
             async for reply in response_generator:
-                if not self.proc:
-                    await response_generator.aclose()
                 yield reply
 
         except NoUrlException:
@@ -291,14 +288,6 @@ class SearchQaExecutor(LLMExecutor):
         finally:
             logger.info("Done")
 
-    async def abort(self):
-        if self.proc:
-            self.proc = False
-            await self.doc_qa.abort()
-            logger.debug("aborted")
-            return "Aborted"
-        return "No process to abort"
-
 
 if __name__ == "__main__":
     executor = SearchQaExecutor()
@@ -29,17 +29,10 @@ class DummyExecutor(LLMExecutor):
     def extend_arguments(self, parser):
         parser.add_argument("--delay", type=int, default=0.02, help="Inter-token delay")
 
-    def setup(self):
-        self.stop = False
-
     async def llm_compute(self, history: list[dict], modelfile: Modelfile):
         try:
-            self.stop = False
             for i in lorem:
                 yield i
-                if self.stop:
-                    self.stop = False
-                    break
                 await asyncio.sleep(
                     modelfile.parameters.get("llm_delay", self.args.delay)
                 )
@@ -49,11 +42,6 @@ class DummyExecutor(LLMExecutor):
         finally:
             logger.debug("finished")
 
-    async def abort(self):
-        self.stop = True
-        logger.debug("aborted")
-        return "Aborted"
-
 
 if __name__ == "__main__":
     executor = DummyExecutor()
@@ -15,7 +15,7 @@ import requests
 import hashlib
 import tempfile
 
-from kuwa.executor import LLMExecutor, Modelfile
+from kuwa.executor import LLMExecutor, Modelfile, CancellationToken
 from kuwa.executor.multi_modality import get_supported_image_mime, fetch_image, convert_image
 from kuwa.executor.llm_executor import (
     rectify_chat_history,
@@ -209,8 +209,6 @@ class GeminiExecutor(LLMExecutor):
             f"Generation config:\n{pprint.pformat(self.generation_config, indent=2)}"
         )
 
-        self.proc = False
-
     async def count_token(self, messages: List):
         contents = [
             p["text"] for m in messages for p in m["parts"] if "text" in p.keys()
@@ -274,7 +272,12 @@ class GeminiExecutor(LLMExecutor):
 
         return result
 
-    async def llm_compute(self, history: list[dict], modelfile: Modelfile):
+    async def llm_compute(
+        self,
+        history: list[dict],
+        modelfile: Modelfile,
+        cancel_token: CancellationToken = None,
+    ):
         try:
             google_token = (
                 modelfile.parameters["_"].get("google_token") or self.args.api_key
@@ -324,7 +327,6 @@ class GeminiExecutor(LLMExecutor):
             history = msg[:-1]
             logger.debug(f"msg: {msg}")
             chat = self.model.start_chat(history=history)
-            self.proc = True
             generation_config = merge_config(
                 self.generation_config, modelfile.parameters["llm_"]
             )
@@ -350,22 +352,14 @@ class GeminiExecutor(LLMExecutor):
                 yield chunk
                 if self.in_debug():
                     print(end=chunk, flush=True)
-                if not self.proc:
+                if cancel_token is not None and cancel_token.cancelled:
                     break
         except Exception:
             raise
         finally:
             await file_store.delete_all_files()
-            self.proc = False
             logger.debug("finished")
 
-    async def abort(self):
-        if self.proc:
-            self.proc = False
-            logger.debug("aborted")
-            return "Aborted"
-        return "No process to abort"
-
 
 if __name__ == "__main__":
     executor = GeminiExecutor()
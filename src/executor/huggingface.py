@@ -7,6 +7,7 @@ import argparse
 import requests
 import queue
 import json
+import asyncio
 from typing import Optional
 from threading import Thread
 
@@ -27,14 +28,14 @@ from transformers import (
     StoppingCriteriaList,
 )
 
-from kuwa.executor import LLMExecutor, Modelfile
+from kuwa.executor import LLMExecutor, Modelfile, CancellationToken
 from kuwa.executor.llm_executor import rectify_chat_history, extract_user_attachment
 from kuwa.executor.multi_modality import get_supported_image_mime, fetch_image
 from kuwa.executor.util import (
     read_config,
     merge_config,
 )
-from kuwa.executor.message import LogChunk, LogLevel
+from kuwa.executor.message import LogChunk, LogLevel, UsageChunk
 from transformers.utils import is_vision_available
 
 if is_vision_available():
@@ -78,11 +79,26 @@ TORCH_DTYPES = {
 
 
 class CustomStoppingCriteria(StoppingCriteria):
-    def __init__(self):
-        self.proc = None
+    """
+    Stop the generation of a request once it's cancelled or stopped, e.g. a
+    stop word is found. It's called on every generated token, so that the
+    length of the sequence generated so far is recorded as well.
+    """
+
+    def __init__(self, cancel_token: CancellationToken = None):
+        self.cancel_token = cancel_token
+        self.stopped = False
+        self.length = 0
+
+    def stop(self):
+        self.stopped = True
 
     def __call__(self, input_ids, score, **kwargs) -> bool:
-        return not self.proc
+        if input_ids is not None:
+            self.length = input_ids.shape[-1]
+        return self.stopped or (
+            self.cancel_token is not None and self.cancel_token.cancelled
+        )
 
 
 class KwargsParser(argparse.Action):
@@ -383,7 +399,6 @@ class HuggingfaceExecutor(LLMExecutor):
             or self.tokenizer.chat_template
             or self.tokenizer.default_chat_template
         )
-        self.CSC = CustomStoppingCriteria()
 
         # Setup generation config
         self.generation_config["pad_token_id"] = (
@@ -467,7 +482,12 @@ class HuggingfaceExecutor(LLMExecutor):
         logger.info("Image processed.")
         return result
 
-    async def llm_compute(self, history: list[dict], modelfile: Modelfile):
+    async def llm_compute(
+        self,
+        history: list[dict],
+        modelfile: Modelfile,
+        cancel_token: CancellationToken = None,
+    ):
         # Apply modelfile
         system_prompt = modelfile.override_system_prompt or self.system_prompt
         prepended_messages = rectify_chat_history(modelfile.messages)
@@ -518,6 +538,7 @@ class HuggingfaceExecutor(LLMExecutor):
         streamer = TextIteratorStreamer(
             self.tokenizer, skip_prompt=True, timeout=self.timeout
         )
+        stopping_criteria = CustomStoppingCriteria(cancel_token)
         thread = Thread(
             target=self.model.generate,
             kwargs=dict(
@@ -526,14 +547,13 @@ class HuggingfaceExecutor(LLMExecutor):
                 generation_config=GenerationConfig(
                     **merge_config(self.generation_config, modelfile.parameters["llm_"])
                 ),
-                stopping_criteria=StoppingCriteriaList([self.CSC]),
+                stopping_criteria=StoppingCriteriaList([stopping_criteria]),
             ),
             daemon=True,
         )
 
         try:
             thread.start()
-            self.CSC.proc = thread
 
             buffer = ""
             for chunk in streamer:
@@ -543,10 +563,10 @@ class HuggingfaceExecutor(LLMExecutor):
                         continue
                     logger.debug(f"{word} founded!")
                     buffer = buffer.split(word)[0]
-                    self.CSC.proc = None
+                    stopping_criteria.stop()
                     break
 
-                if not self.CSC.proc:
+                if stopping_criteria(None, None):
                     break
 
                 if len(buffer) > self.buffer_length:
@@ -563,6 +583,12 @@ class HuggingfaceExecutor(LLMExecutor):
                     print(end=buffer, flush=True)
                 yield buffer  # Flush buffer
 
+            prompt_length = model_inputs["input_ids"].shape[-1]
+            yield UsageChunk(
+                prompt_tokens=prompt_length,
+                completion_tokens=max(stopping_criteria.length - prompt_length, 0),
+            )
+
         except queue.Empty:
             message = 'The model produced no output. Increasing the executor\'s "--timeout" value may resolve this.\nIf the problem persists, a GPU out-of-memory or a model-specific issue is likely.'
             logger.exception(message)
@@ -570,22 +596,13 @@ class HuggingfaceExecutor(LLMExecutor):
             raise
 
         finally:
-            self.CSC.proc = None
+            stopping_criteria.stop()
+            if thread.is_alive():
+                # The generation stops at the next token, wait for it without blocking the event loop
+                await asyncio.to_thread(thread.join)
             torch.cuda.empty_cache()
             logger.debug("finished")
 
-    async def abort(self):
-        if not self.CSC.proc:
-            return "No process to abort"
-
-        thread = self.CSC.proc
-        self.CSC.proc = None
-        logger.debug("aborting...")
-        thread.join()
-        logger.debug("aborted")
-        torch.cuda.empty_cache()
-        return "Aborted"
-
 
 if __name__ == "__main__":
     executor = HuggingfaceExecutor()
@@ -116,7 +116,6 @@ class DalleExecutor(LLMExecutor):
             f"Generation config:\n{pprint.pformat(self.generation_config, indent=2)}"
         )
 
-        self.proc = False
 
     @functools.cache
     def get_supported_image_mime(self):
@@ -250,16 +249,8 @@ class DalleExecutor(LLMExecutor):
             else:
                 yield str(e)
         finally:
-            self.proc = False
             logger.debug("finished")
 
-    async def abort(self):
-        if self.proc:
-            self.proc = False
-            logger.debug("aborted")
-            return "Aborted"
-        return "No process to abort"
-
 
 if __name__ == "__main__":
     executor = DalleExecutor()
@@ -77,7 +77,6 @@ class StableDiffusionExecutor(LLMExecutor):
         self.model_name = self.args.model
         self.n_cache = self.args.n_cache
         self.show_progress = self.args.show_progress
-        self.stop = False
         setattr(self, "load_pipe", lru_cache(maxsize=self.n_cache)(self._load_pipe))
         if self.args.preload:
             self.load_pipe(task=Task.TEXT2IMG, model_name=self.model_name)
@@ -131,11 +130,6 @@ class StableDiffusionExecutor(LLMExecutor):
 
         logger.info("Done")
 
-    async def abort(self):
-        self.stop = True
-        logger.debug("aborted")
-        return "Aborted"
-
 
 if __name__ == "__main__":
     executor = StableDiffusionExecutor()
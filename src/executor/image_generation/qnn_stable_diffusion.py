@@ -8,7 +8,7 @@ from enum import Enum
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from kuwa.executor import LLMExecutor, Modelfile
+from kuwa.executor import LLMExecutor, Modelfile, CancellationToken
 from kuwa.executor.llm_executor import extract_last_url
 
 import numpy as np
@@ -313,15 +313,18 @@ class QnnStableDiffusionExecutor(LLMExecutor):
             self.model_path = snapshot_download(repo_id=self.args.model)
         self.qnn_binary_path = self.args.qnn_binaries
         self.show_progress = self.args.show_progress
-        self.stop = False
 
-    async def llm_compute(self, history: list[dict], modelfile: Modelfile):
+    async def llm_compute(
+        self,
+        history: list[dict],
+        modelfile: Modelfile,
+        cancel_token: CancellationToken = None,
+    ):
         seed = modelfile.parameters["imgen_"].get("seed", np.int64(1.36477711e14))
         num_inference_steps = modelfile.parameters["imgen_"].get(
             "num_inference_steps", 20
         )
         guidance_scale = modelfile.parameters["imgen_"].get("guidance_scale", 7.5)
-        self.stop = False
 
         img_url, history = extract_last_url(history)  # we omit img2img here
         prompt = next(i for i in reversed(history) if i["role"] == "user")["content"]
@@ -340,7 +343,7 @@ class QnnStableDiffusionExecutor(LLMExecutor):
         generator = Generator(image_generator_app.generate_image(prompt=prompt))
 
         for progress in generator:
-            if self.stop:
+            if cancel_token is not None and cancel_token.cancelled:
                 break
             if self.show_progress:
                 yield f"{progress} "
@@ -349,11 +352,6 @@ class QnnStableDiffusionExecutor(LLMExecutor):
 
         logger.info("Done")
 
-    async def abort(self):
-        self.stop = True
-        logger.debug("aborted")
-        return "Aborted"
-
 
 if __name__ == "__main__":
     executor = QnnStableDiffusionExecutor()
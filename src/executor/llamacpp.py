@@ -13,8 +13,9 @@ from huggingface_hub import hf_hub_download
 from llama_cpp import Llama
 import llama_cpp.llama_chat_format as llama_chat_format
 
-from kuwa.executor import LLMExecutor, Modelfile
+from kuwa.executor import LLMExecutor, Modelfile, CancellationToken
 from kuwa.executor.llm_executor import rectify_chat_history
+from kuwa.executor.message import UsageChunk
 from kuwa.executor.util import (
     expose_function_parameter,
     read_config,
@@ -284,8 +285,6 @@ class LlamaCppExecutor(LLMExecutor):
         )
         logger.debug(f"Stop words: {self.stop_words}")
 
-        self.serving_generator = None
-
     def synthesis_prompt(self, history: list, system_prompt: str, template: str):
         """
         Synthesis the prompt from chat history.
@@ -310,7 +309,12 @@ class LlamaCppExecutor(LLMExecutor):
 
         return prompt
 
-    async def llm_compute(self, history: list[dict], modelfile: Modelfile):
+    async def llm_compute(
+        self,
+        history: list[dict],
+        modelfile: Modelfile,
+        cancel_token: CancellationToken = None,
+    ):
         # Apply modelfile
         system_prompt = modelfile.override_system_prompt or self.system_prompt
         prepended_messages = rectify_chat_history(modelfile.messages)
@@ -323,6 +327,7 @@ class LlamaCppExecutor(LLMExecutor):
                 )
             )
 
+        output_generator = None
         try:
             # Trim the history to fit into the context window
             prompt = ""
@@ -356,28 +361,29 @@ class LlamaCppExecutor(LLMExecutor):
                 stream=True,
                 **merge_config(self.generation_config, modelfile.parameters["llm_"]),
             )
-            self.serving_generator = output_generator
 
+            # Every streamed completion carries a single token
+            completion_length = 0
             for i in output_generator:
+                if cancel_token is not None and cancel_token.cancelled:
+                    break
+                completion_length += 1
                 chunk = i["choices"][0]["text"]
                 if self.in_debug():
                     print(end=chunk, flush=True)
                 yield chunk
+            yield UsageChunk(
+                prompt_tokens=prompt_length, completion_tokens=completion_length
+            )
 
         except Exception as e:
             logger.error("Error occurs while processing request.")
             raise e
         finally:
+            if output_generator is not None:
+                output_generator.close()
             logger.debug("finished")
 
-    async def abort(self):
-        if not self.serving_generator:
-            return "There's not running generation request to abort."
-        self.serving_generator.close()
-        self.serving_generator = None
-        logger.debug("aborted")
-        return "Aborted"
-
 
 if __name__ == "__main__":
     executor = LlamaCppExecutor()
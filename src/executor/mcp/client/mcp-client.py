@@ -237,9 +237,6 @@ class McpClientExecutor(LLMExecutor):
             help="URL of the MCP server.",
         )
 
-    def setup(self):
-        self.stop = False
-
     async def llm_compute(self, history: list[dict], modelfile: Modelfile):
         server_cmd = modelfile.parameters["mcp_"].get("cmd", self.args.mcp_server_cmd)
         server_args = modelfile.parameters["mcp_"].get(
@@ -367,11 +364,6 @@ class McpClientExecutor(LLMExecutor):
         finally:
             return tool_call
 
-    async def abort(self):
-        self.stop = True
-        logger.debug("aborted")
-        return "Aborted"
-
 
 if __name__ == "__main__":
     executor = McpClientExecutor()
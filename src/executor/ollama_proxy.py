@@ -13,7 +13,8 @@ import mimetypes
 from PIL import Image
 from io import BytesIO
 
-from kuwa.executor import LLMExecutor, Modelfile
+from kuwa.executor import LLMExecutor, Modelfile, CancellationToken
+from kuwa.executor.message import UsageChunk
 from kuwa.executor.llm_executor import (
     rectify_chat_history,
     extract_last_url,
@@ -142,8 +143,6 @@ class OllamaExecutor(LLMExecutor):
         loop = asyncio.get_event_loop()
         loop.run_until_complete(self.prepare_model(self.default_model_name))
 
-        self.proc = False
-
     async def prepare_model(self, model_name):
         try:
             logger.info(f'Preparing model "{model_name}"')
@@ -226,7 +225,12 @@ class OllamaExecutor(LLMExecutor):
 
         return prompt
 
-    async def llm_compute(self, history: list[dict], modelfile: Modelfile):
+    async def llm_compute(
+        self,
+        history: list[dict],
+        modelfile: Modelfile,
+        cancel_token: CancellationToken = None,
+    ):
         try:
             model_name = modelfile.parameters["llm_"].get(
                 "model", self.default_model_name
@@ -261,7 +265,6 @@ class OllamaExecutor(LLMExecutor):
 
             # [TODO] Trim the history to fit into the context window
 
-            self.proc = True
             await self.prepare_model(model_name)
             if chat_mode:
                 response = await self.client.chat(
@@ -281,10 +284,14 @@ class OllamaExecutor(LLMExecutor):
                 )
             async for i in response:
                 if i["done"]:
+                    yield UsageChunk(
+                        prompt_tokens=i.get("prompt_eval_count"),
+                        completion_tokens=i.get("eval_count"),
+                    )
                     continue
 
                 chunk = i["message"]["content"] if chat_mode else i["response"]
-                if not self.proc:
+                if cancel_token is not None and cancel_token.cancelled:
                     break
                 if not chunk:
                     continue
@@ -297,16 +304,8 @@ class OllamaExecutor(LLMExecutor):
             logger.exception("Error occurs when calling Ollama API")
             yield str(e)
         finally:
-            self.proc = False
             logger.debug("finished")
 
-    async def abort(self):
-        if self.proc:
-            self.proc = False
-            logger.debug("aborted")
-            return "Aborted"
-        return "No process to abort"
-
 
 if __name__ == "__main__":
     executor = OllamaExecutor()
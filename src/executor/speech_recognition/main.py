@@ -134,7 +134,6 @@ class SpeechRecognitionExecutor(LLMExecutor):
         self.enable_timestamp = self.args.enable_timestamp
         self.enable_diarization = self.args.enable_diarization
 
-        self.stop = False
 
         # Initialize the pipelines
         if self.args.use_onnx:
@@ -307,7 +306,6 @@ class SpeechRecognitionExecutor(LLMExecutor):
         src_file = None
         gc_paths = []
         try:
-            self.stop = False
             url, history = extract_last_url(history)
             if url is None:
                 raise ValueError("An URL to a audio file is expected.")
@@ -404,7 +402,6 @@ class SpeechRecognitionExecutor(LLMExecutor):
             logger.exception("Error occurs during generation.")
             yield str(e)
         finally:
-            self.stop = False
             for path_to_delete in gc_paths:
                 if os.path.isfile(path_to_delete):
                     os.remove(path_to_delete)
@@ -412,11 +409,6 @@ class SpeechRecognitionExecutor(LLMExecutor):
                     os.rmdir(path_to_delete)
             logger.debug("finished")
 
-    async def abort(self):
-        self.stop = True
-        logger.debug("aborted")
-        return "Aborted"
-
 
 if __name__ == "__main__":
     executor = SpeechRecognitionExecutor()
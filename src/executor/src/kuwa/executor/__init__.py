@@ -1,2 +1,3 @@
 from .llm_executor import LLMExecutor  # noqa: F401
 from .modelfile import Modelfile  # noqa: F401
+from .cancellation import CancellationToken  # noqa: F401
@@ -0,0 +1,75 @@
+import asyncio
+from collections import deque
+
+
+class AdmissionQueue:
+    """
+    Admit at most `limit` concurrent requests and let at most `max_queue`
+    more wait for a slot, each for at most `deadline` seconds. A released
+    slot is handed to the waiters in the order they arrived.
+    It's meant to be used by the coroutines on a single event loop.
+    """
+
+    def __init__(self, limit: int = 1, max_queue: int = 0, deadline: float = 30.0):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.active = 0
+        self.waiters = deque()
+
+    @property
+    def depth(self) -> int:
+        """
+        The number of requests waiting for a slot.
+        """
+        return len(self.waiters)
+
+    async def acquire(self) -> bool:
+        """
+        Take a slot, waiting in the queue if all the slots are taken.
+        Return False if the queue is full or the deadline has passed.
+        """
+        if self.active < self.limit and self.depth == 0:
+            self.active += 1
+            return True
+        if self.depth >= self.max_queue:
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.deadline)
+            return True
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over right before giving up
+                self.release()
+            else:
+                waiter.cancel()
+                self.waiters.remove(waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return False
+
+    def release(self):
+        """
+        Hand the slot to the earliest waiter, or free it if there is none.
+        """
+        if self.waiters:
+            self.waiters.popleft().set_result(True)
+            return
+        self.active = max(self.active - 1, 0)
+
+    def releaser(self):
+        """
+        Return a callable releasing the slot once, however many times it's called.
+        """
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.release()
+
+        return release
@@ -7,12 +7,10 @@ import logging
 import atexit
 import signal
 import asyncio
-import json
+import threading
 import traceback
 from urllib.parse import urljoin
 from typing import Optional
-from functools import reduce
-from itertools import compress
 
 import uvicorn
 import prometheus_client
@@ -21,22 +19,15 @@ from fastapi import FastAPI, Response, Request
 from fastapi.responses import JSONResponse, StreamingResponse
 
 from .metrics import ExecutorMetrics
+from .admission import AdmissionQueue
+from .cancellation import CancellationRegistry, CancellationToken, accepts_keyword
 from .logger import ExecutorLoggerFactory
-from .message import BaseChunk, TextChunk, LogChunk, ExitCodeChunk, LogLevel
+from .message import LogChunk, ExitCodeChunk, UsageChunk, LogLevel
+from .sse import AdvancedJSONEncoder, format_sse, format_delta, as_chunks, coalesce  # noqa: F401
 
 logger = logging.getLogger(__name__)
 
 
-class AdvancedJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if hasattr(obj, "__jsonencode__"):
-            return obj.__jsonencode__()
-
-        if isinstance(obj, set):
-            return list(obj)
-        return super().default(obj)
-
-
 def find_free_port():
     port = None
     with socket.socket() as s:
@@ -44,6 +35,75 @@ def find_free_port():
     return port
 
 
+async def until_cancelled(generator, token: CancellationToken):
+    """
+    Iterate the async generator until the token is cancelled. The pending step
+    of the generator is interrupted on cancellation, so that an executor
+    awaiting the upstream stops at once, and the generator is closed.
+    The generator is stepped in the current task, which is cancelled only while
+    it's awaiting the generator, instead of racing every step in a new task.
+    """
+    task = asyncio.current_task()
+    stepping = False
+    interrupted = False
+
+    def interrupt():
+        nonlocal interrupted
+        if stepping and not interrupted:
+            interrupted = True
+            task.cancel()
+
+    token.add_callback(interrupt)
+    try:
+        while not token.cancelled:
+            stepping = True
+            try:
+                chunk = await generator.__anext__()
+            except StopAsyncIteration:
+                break
+            except asyncio.CancelledError:
+                # Swallow only the cancellation requested by the token
+                if not interrupted or uncancel(task) > 0:
+                    raise
+                break
+            finally:
+                stepping = False
+            if interrupted:
+                # The generator ignored the interruption
+                uncancel(task)
+                break
+            yield chunk
+    finally:
+        await generator.aclose()
+
+
+def uncancel(task: asyncio.Task) -> int:
+    """
+    Withdraw a cancellation request of the task and return the number of the
+    remaining ones. The requests aren't counted before Python 3.11.
+    """
+    if not hasattr(task, "uncancel"):
+        return 0
+    return task.uncancel()
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """
+    Release the admission slot after the response, even if the stream is never
+    started because the client has disconnected.
+    """
+
+    def __init__(self, *args, release, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release()
+
+
 class BaseExecutor:
     """
     The basic functionality of an Executor.
@@ -61,6 +121,12 @@ class BaseExecutor:
 
     concurrent_requests: int = 0
     concurrent_req_limit: int = 1
+    queue_length: int = 16
+    queue_deadline: float = 30.0
+    coalesce_bytes: int = 1024
+    coalesce_ms: float = 0
+    admission: Optional[AdmissionQueue] = None
+    cancellation: Optional[CancellationRegistry] = None
     ready: bool = False
 
     log_level: str = "INFO"
@@ -68,6 +134,7 @@ class BaseExecutor:
 
     def __init__(self):
         self.app = FastAPI()
+        self.cancellation = CancellationRegistry()
         self.parser = self._create_parser()
         self.extend_arguments(parser=self.parser)
 
@@ -107,9 +174,34 @@ class BaseExecutor:
         )
         group.add_argument(
             "--concurrent_req_limit",
+            type=int,
             default=self.concurrent_req_limit,
             help="The number of allowed concurrent requests.",
         )
+        group.add_argument(
+            "--queue_length",
+            type=int,
+            default=self.queue_length,
+            help="The number of requests waiting for a free slot before responding 429.",
+        )
+        group.add_argument(
+            "--queue_deadline",
+            type=float,
+            default=self.queue_deadline,
+            help="The seconds a request waits for a free slot before responding 429.",
+        )
+        group.add_argument(
+            "--coalesce_ms",
+            type=float,
+            default=self.coalesce_ms,
+            help="Merge the consecutive text chunks streamed within the milliseconds into one. Disabled by 0.",
+        )
+        group.add_argument(
+            "--coalesce_bytes",
+            type=int,
+            default=self.coalesce_bytes,
+            help="Flush the merged text chunks once they reach the size in bytes.",
+        )
         group.add_argument(
             "--log",
             type=str.upper,
@@ -145,10 +237,21 @@ class BaseExecutor:
         self.port = self.args.port or find_free_port()
         self.https = self.args.https
         self.executor_path = self.args.executor_path
+        self.concurrent_req_limit = self.args.concurrent_req_limit
+        self.queue_length = self.args.queue_length
+        self.queue_deadline = self.args.queue_deadline
+        self.coalesce_ms = self.args.coalesce_ms
+        self.coalesce_bytes = self.args.coalesce_bytes
+        self.admission = AdmissionQueue(
+            limit=self.concurrent_req_limit,
+            max_queue=self.queue_length,
+            deadline=self.queue_deadline,
+        )
 
         # Metrics
         self.metrics = ExecutorMetrics(self.access_codes[0])
         self.metrics.state.state("idle")
+        self.metrics.queue_depth.set_function(lambda: self.admission.depth)
 
         self._register_routes()
 
@@ -161,21 +264,52 @@ class BaseExecutor:
     def _register_routes(self):
         @self.app.post(self.executor_path)
         async def api(request: Request):
-            if self.concurrent_requests >= self.concurrent_req_limit:
+            header = request.headers
+            # The request can be aborted by the id in the response header, or
+            # by the one given by the client even while waiting for a slot
+            token = self.cancellation.create(header.get("X-Request-Id"))
+            # Wait for a free slot, bursts beyond the queue length are rejected
+            enqueued_at = time.monotonic()
+            try:
+                admitted = await self._admit(token)
+            except BaseException:
+                self.cancellation.remove(token)
+                raise
+            if not admitted:
+                self.cancellation.remove(token)
+                if token.cancelled:
+                    logger.debug(f"Aborted the request {token.request_id} while queued")
+                    return Response(
+                        media_type="text/event-stream",
+                        headers={"X-Request-Id": token.request_id},
+                    )
+                self.metrics.rejected.inc()
                 return JSONResponse(
                     {"msg": "Processing another request."}, status_code=429
                 )
-            content = await request.form()
-            header = request.headers
+            self.metrics.queue_wait_seconds.observe(time.monotonic() - enqueued_at)
+            release = self.admission.releaser()
+            try:
+                content = await request.form()
+            except BaseException:
+                self.cancellation.remove(token)
+                release()
+                raise
             if not content:
+                self.cancellation.remove(token)
+                release()
                 logger.debug("Received empty request!")
                 return JSONResponse({"msg": "Received empty request!"}, status_code=400)
             logger.debug(f"HTTP headers: {header}")
             logger.debug(f"Raw form content: {content}")
-            resp = StreamingResponse(
-                self._serve(header=header, content=content),
+            resp = AdmittedStreamingResponse(
+                self._serve(header=header, content=content, release=release, token=token),
+                release=lambda: (self.cancellation.remove(token), release()),
                 media_type="text/event-stream",
-                headers={"Content-Type": "text/event-stream; charset=utf-8"},
+                headers={
+                    "Content-Type": "text/event-stream; charset=utf-8",
+                    "X-Request-Id": token.request_id,
+                },
             )
             return resp
 
@@ -194,9 +328,23 @@ class BaseExecutor:
 
         @self.app.get(urljoin(f"{self.executor_path}/", "./abort"))
         async def abort():
+            """
+            Abort all the requests being served.
+            """
+            cancelled = self.cancellation.cancel_all()
             if hasattr(self, "abort") and callable(self.abort):
                 return JSONResponse({"msg": await self.abort()})
-            return JSONResponse({"msg": "No abort method configured"}, status_code=404)
+            return JSONResponse({"msg": "Aborted" if cancelled else "No process to abort"})
+
+        @self.app.get(urljoin(f"{self.executor_path}/", "./abort/{request_id}"))
+        async def abort_request(request_id: str):
+            """
+            Abort the request by the id in its X-Request-Id response header.
+            """
+            if not self.cancellation.cancel(request_id):
+                return JSONResponse({"msg": "No such request"}, status_code=404)
+            logger.debug(f"Aborted the request {request_id}")
+            return JSONResponse({"msg": "Aborted"})
 
         @self.app.get("/metrics")
         async def get_metrics():
@@ -204,6 +352,28 @@ class BaseExecutor:
                 content=prometheus_client.generate_latest(), media_type="text/plain"
             )
 
+    async def _admit(self, token: CancellationToken) -> bool:
+        """
+        Take an admission slot, giving up if the request is aborted while
+        waiting. Return False if it's rejected or aborted.
+        """
+        acquire = asyncio.ensure_future(self.admission.acquire())
+        aborted = asyncio.ensure_future(token.wait())
+        try:
+            await asyncio.wait({acquire, aborted}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            aborted.cancel()
+            if not acquire.done():
+                # A slot handed over meanwhile is released by acquire() itself
+                acquire.cancel()
+                await asyncio.wait({acquire})
+        if acquire.cancelled() or not acquire.result():
+            return False
+        if token.cancelled:
+            self.admission.release()
+            return False
+        return True
+
     def run(self):
         self.args = self.parser.parse_args()
         self._setup()
@@ -244,91 +414,154 @@ class BaseExecutor:
             url=urljoin(
                 self.kernel_url, f"{self.executor_iface_version}/worker/register"
             ),
-            data={"name": access_code, "endpoint": self.get_reg_endpoint()},
+            data={
+                "name": access_code,
+                "endpoint": self.get_reg_endpoint(),
+                "capacity": self.concurrent_req_limit,
+            },
         )
         if not resp.ok or resp.text == "Failed":
             raise RuntimeWarning("The server failed to register to kernel.")
 
-    def _start_server(self):
-        self.registered = False
-        if not self.ignore_kernel:
-            try:
-                for access_code in self.access_codes:
-                    self._try_register(access_code)
-                    logger.info(f'Registered with the name "{access_code}"')
-                self.registered = True
+    def _register_when_started(self, server: uvicorn.Server):
+        """
+        Register to the kernel once the server is accepting connections, so
+        that the kernel never routes a job to an executor that isn't listening.
+        """
+        while not server.started:
+            if server.should_exit:
+                return
+            time.sleep(0.1)
+        try:
+            for access_code in self.access_codes:
+                self._try_register(access_code)
+                logger.info(f'Registered with the name "{access_code}"')
+            self.registered = True
 
-            except Exception:
-                logger.exception("Failed to register to kernel.")
+        except Exception:
+            logger.exception("Failed to register to kernel.")
+            logger.info("The program will exit now.")
+            server.should_exit = True
 
-                if not self.ignore_kernel:
-                    logger.info("The program will exit now.")
-                    sys.exit(0)
+    def _start_server(self):
+        self.registered = False
         self.concurrent_requests = 0
-        uvicorn.run(
-            self.app,
-            host=self.host,
-            port=self.port,
-            log_config=ExecutorLoggerFactory(level=self.log_level).get_config(),
+        server = uvicorn.Server(
+            uvicorn.Config(
+                self.app,
+                host=self.host,
+                port=self.port,
+                log_config=ExecutorLoggerFactory(level=self.log_level).get_config(),
+            )
         )
+        if not self.ignore_kernel:
+            threading.Thread(
+                target=self._register_when_started, args=(server,), daemon=True
+            ).start()
+        server.run()
 
-    def _update_statistics(self, duration_sec: float, total_output_length: int):
+    def _update_statistics(self, duration_sec: float, total_output_length: int, usage: UsageChunk = None):
         """
         Update the internal statistical metrics.
+        The token counts are recorded only if the executor reported them.
         """
         if duration_sec > 0:
             throughput = total_output_length / duration_sec
             self.metrics.process_time_seconds.observe(duration_sec)
             self.metrics.output_length_charters.observe(total_output_length)
             self.metrics.output_throughput_charters_per_second.observe(throughput)
+        if usage is None:
+            return
+        if usage.prompt_tokens is not None:
+            self.metrics.prompt_length_tokens.observe(usage.prompt_tokens)
+        if usage.completion_tokens is not None:
+            self.metrics.output_length_tokens.observe(usage.completion_tokens)
+            if duration_sec > 0:
+                self.metrics.output_throughput_tokens_per_second.observe(
+                    usage.completion_tokens / duration_sec
+                )
+
+    def _usage(self, total_output_length: int, usage: UsageChunk = None) -> dict:
+        """
+        The usage of the response. The completion is measured in charters
+        unless the executor reported the token counts.
+        """
+        prompt_tokens = 0
+        completion_tokens = total_output_length
+        if usage is not None:
+            if usage.prompt_tokens is not None:
+                prompt_tokens = usage.prompt_tokens
+            if usage.completion_tokens is not None:
+                completion_tokens = usage.completion_tokens
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
 
     def _format_sse(self, data: dict):
-        json_data = json.dumps(data, cls=AdvancedJSONEncoder)
-        return f"data: {json_data}\n"
+        return format_sse(data)
 
-    async def _serve(self, header, content):
+    async def _serve(self, header, content, release=None, token: CancellationToken = None):
         """
         The middle layer between the actual executor logic and API server logic.
         Interception of the request-response can be done in this layer.
+        The admission slot is released by calling release once it's finished.
+        The request is served until the cancellation token is cancelled, which
+        is passed to serve() if it accepts the cancel_token argument.
         """
 
+        if token is None:
+            token = self.cancellation.create()
+        kwargs = {"cancel_token": token} if accepts_keyword(self.serve, "cancel_token") else {}
         self.concurrent_requests += 1
         self.metrics.state.state("busy")
         try:
             start_time = time.time()
             total_output_length = 0
-            exit_code_chunks = [ExitCodeChunk(exit_code=ExitCodeChunk.OK)]
-
-            async for chunks in self.serve(header=header, content=content):
-                if isinstance(chunks, str):
-                    chunks = TextChunk(chunks)
-                if not isinstance(chunks, list):
-                    chunks = [chunks]
-                unsupported_chunk = [not isinstance(x, BaseChunk) for x in chunks]
-                if any(unsupported_chunk):
-                    raise RuntimeError(
-                        f"Unsupported chunk type: {[type(x) for x in compress(chunks, unsupported_chunk)]}"
-                    )
-                exit_code_chunks += list(filter(lambda x: isinstance(x, ExitCodeChunk), chunks))
-                total_output_length += reduce(lambda x, y: x + len(y), chunks, 0)
-                yield self._format_sse({"finish_reason": None, "delta": chunks})
+            exit_code_chunk = ExitCodeChunk(exit_code=ExitCodeChunk.OK)
+            usage = None
+            last_chunk_at = time.monotonic()
+            first_chunk = True
+
+            stream = until_cancelled(self.serve(header=header, content=content, **kwargs), token)
+            if self.coalesce_ms > 0:
+                stream = coalesce(stream, self.coalesce_bytes, self.coalesce_ms / 1000)
+            async for chunks in stream:
+                chunks = as_chunks(chunks)
+                reported = None
+                for chunk in chunks:
+                    if isinstance(chunk, ExitCodeChunk):
+                        exit_code_chunk = chunk
+                    elif isinstance(chunk, UsageChunk):
+                        reported = usage = chunk
+                    total_output_length += len(chunk)
+                if reported is not None:
+                    # The usage is reported at the end of the response instead
+                    chunks = [i for i in chunks if not isinstance(i, UsageChunk)]
+                    if not chunks:
+                        continue
+                now = time.monotonic()
+                if first_chunk:
+                    self.metrics.time_to_first_chunk_seconds.observe(now - last_chunk_at)
+                    first_chunk = False
+                else:
+                    self.metrics.inter_chunk_latency_seconds.observe(now - last_chunk_at)
+                last_chunk_at = now
+                yield format_delta(chunks)
 
-                # Yield control to the event loop.
+                # Yield control to the event loop once per frame.
                 # So that other coroutine, like aborting, can run.
                 await asyncio.sleep(0)
 
             duration_sec = time.time() - start_time
-            self._update_statistics(duration_sec, total_output_length)
+            self._update_statistics(duration_sec, total_output_length, usage)
 
             yield self._format_sse(
                 {
                     "finish_reason": "stop",
-                    "delta": exit_code_chunks[-1:],
-                    "usage": {
-                        "prompt_tokens": 0,  # [TODO]
-                        "completion_tokens": total_output_length,
-                        "total_tokens": total_output_length,
-                    },
+                    "delta": [exit_code_chunk],
+                    "usage": self._usage(total_output_length, usage),
                 }
             )
 
@@ -349,17 +582,18 @@ class BaseExecutor:
                 {
                     "finish_reason": "exception",
                     "delta": display_messages,
-                    "usage": {
-                        "prompt_tokens": 0,  # [TODO]
-                        "completion_tokens": total_output_length,
-                        "total_tokens": total_output_length,
-                    },
+                    "usage": self._usage(total_output_length, usage),
                 }
             )
 
         finally:
-            self.metrics.state.state("idle")
             self.concurrent_requests -= 1
+            # The requests are served concurrently, it's idle after the last one
+            if self.concurrent_requests == 0:
+                self.metrics.state.state("idle")
+            self.cancellation.remove(token)
+            if release is not None:
+                release()
 
     async def serve(self, header, content):
         raise NotImplementedError('Executor should implement the "serve" method.')
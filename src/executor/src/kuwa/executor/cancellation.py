@@ -0,0 +1,109 @@
+import uuid
+import asyncio
+import inspect
+import logging
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CancellationToken:
+    """
+    The cancellation state of a single request.
+    The executors poll `cancelled`, await `wait()`, or register callbacks to
+    stop the work running outside the event loop, e.g. in a thread.
+    """
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.event = asyncio.Event()
+        self.callbacks = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.event.set()
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception(f"Failed to cancel the request {self.request_id}.")
+
+    def add_callback(self, callback: Callable[[], None]):
+        """
+        Call the callback on cancellation, or immediately if already cancelled.
+        """
+        if self.cancelled:
+            callback()
+        else:
+            self.callbacks.append(callback)
+
+    async def wait(self):
+        await self.event.wait()
+
+
+class CancellationRegistry:
+    """
+    The cancellation tokens of the requests being served, by request id.
+    """
+
+    def __init__(self):
+        self.tokens = {}
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __contains__(self, request_id):
+        return request_id in self.tokens
+
+    def create(self, request_id: Optional[str] = None) -> CancellationToken:
+        """
+        Register the token of a new request, generating the id if not given or
+        already in use.
+        """
+        if not request_id or request_id in self.tokens:
+            request_id = uuid.uuid4().hex
+        token = CancellationToken(request_id)
+        self.tokens[request_id] = token
+        return token
+
+    def remove(self, token: CancellationToken):
+        if self.tokens.get(token.request_id) is token:
+            del self.tokens[token.request_id]
+
+    def cancel(self, request_id: str) -> bool:
+        """
+        Cancel the request. Return False if there is no such request.
+        """
+        token = self.tokens.get(request_id)
+        if token is None:
+            return False
+        token.cancel()
+        return True
+
+    def cancel_all(self) -> int:
+        """
+        Cancel all the requests and return the number of them.
+        """
+        tokens = list(self.tokens.values())
+        for token in tokens:
+            token.cancel()
+        return len(tokens)
+
+
+def accepts_keyword(func, name: str) -> bool:
+    """
+    Whether the function accepts the keyword argument.
+    """
+    try:
+        parameters = inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+    return name in parameters or any(
+        p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters.values()
+    )
@@ -47,6 +47,11 @@ EXECUTORS = [
         "description": "[Cloud model] Nvidia NIM. Need API key.",
         "class": "nim.NimExecutor",
     },
+    {
+        "name": "warm",
+        "description": "[Tool] Pre-imported executor waiting for its arguments on stdin. Used by the warm pool of the kernel.",
+        "class": "kuwa.executor.warm.WarmExecutor",
+    },
 ]
 
 
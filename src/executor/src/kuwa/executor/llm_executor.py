@@ -4,10 +4,12 @@ import logging
 import requests
 import time
 from fnmatch import fnmatch
+from contextlib import aclosing
 from collections.abc import Iterable
 from .base_executor import BaseExecutor
 from .modelfile import Modelfile
 from .cache import lru_cache_with_ttl
+from .cancellation import CancellationToken, accepts_keyword
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +19,7 @@ class LLMExecutor(BaseExecutor):
     The specialized class for serving LLM process.
     """
 
-    async def serve(self, header, content):
+    async def serve(self, header, content, cancel_token: CancellationToken = None):
         param = dict(content)
         history = json.loads(param.pop("input", "[]"))
         history = to_openai_chat_format(history)
@@ -33,10 +35,20 @@ class LLMExecutor(BaseExecutor):
 
         logger.debug(f"History: {history}")
         logger.debug(f"Modelfile: {modelfile}")
-        async for chunk in self.llm_compute(history=history, modelfile=modelfile):
-            yield chunk
-
-    async def llm_compute(self, history: list[dict], modelfile: Modelfile):
+        kwargs = {}
+        if cancel_token is not None and accepts_keyword(self.llm_compute, "cancel_token"):
+            kwargs["cancel_token"] = cancel_token
+        async with aclosing(self.llm_compute(history=history, modelfile=modelfile, **kwargs)) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+    async def llm_compute(self, history: list[dict], modelfile: Modelfile, cancel_token: CancellationToken = None):
+        """
+        Generate the response to the chat history. The cancel_token is
+        cancelled when the request is aborted, the implementations accepting
+        it should stop the generation running outside the event loop on
+        cancellation.
+        """
         raise NotImplementedError(
             'LLM Executor should implement the "llm_compute" method.'
         )
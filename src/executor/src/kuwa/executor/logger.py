@@ -1,4 +1,11 @@
+import time
+import queue
 import logging
+import logging.handlers
+import threading
+import importlib
+
+logger = logging.getLogger(__name__)
 
 
 class InternalEndpointFilter(logging.Filter):
@@ -24,6 +31,109 @@ class InternalEndpointFilter(logging.Filter):
         return result
 
 
+class LargeMessageFilter(logging.Filter):
+    """
+    Truncate the messages longer than max_length, and let at most burst of
+    them pass every interval_sec seconds. The number of the dropped ones is
+    reported by the next one passing. The decision is kept on the record,
+    since it passes the filter of each handler.
+    """
+
+    def __init__(self, max_length=4096, burst=10, interval_sec=60):
+        super().__init__()
+        self.max_length = max_length
+        self.burst = burst
+        self.interval_sec = interval_sec
+        self.window_start = 0
+        self.passed = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        decision = getattr(record, "large_message_passed", None)
+        if decision is not None:
+            return decision
+        msg = record.msg
+        if isinstance(msg, str) and not record.args:
+            if len(msg) <= self.max_length:
+                return True
+        else:
+            msg = record.getMessage()
+            if len(msg) <= self.max_length:
+                return True
+
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= self.interval_sec:
+                self.window_start, self.passed = now, 0
+            if self.passed >= self.burst:
+                self.dropped += 1
+                record.large_message_passed = False
+                return False
+            self.passed += 1
+            dropped, self.dropped = self.dropped, 0
+        msg = f"{msg[:self.max_length]}... ({len(msg) - self.max_length} characters truncated)"
+        if dropped:
+            msg += f" ({dropped} large messages dropped)"
+        record.msg, record.args = msg, None
+        record.large_message_passed = True
+        return True
+
+
+class QueuedHandler(logging.handlers.QueueHandler):
+    """
+    Hand the records over to a thread, which formats and emits them with the
+    target handler, so that the formatting and the I/O are off the request
+    threads. The filters are still applied before queuing. The records are
+    dropped and counted if the queue is full. The number of the dropped ones
+    is logged once the queue accepts records again, and on closing.
+    """
+
+    def __init__(self, target="logging.StreamHandler", queue_size=10000, **kwargs):
+        super().__init__(queue.Queue(queue_size))
+        module, _, name = target.rpartition(".")
+        self.target = getattr(importlib.import_module(module), name)(**kwargs)
+        self.dropped = 0
+        self.reported = 0
+        self.listener = logging.handlers.QueueListener(self.queue, self.target)
+        self.listener.start()
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # The arguments are kept for the formatters and filters of uvicorn
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped > self.reported:
+            # Reported to the module logger, since the records of the access
+            # log are formatted from their arguments
+            dropped, self.reported = self.dropped - self.reported, self.dropped
+            logger.warning(f"{dropped} log records dropped, the queue of {self.target} is full")
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        if self.dropped > self.reported and logging.lastResort is not None:
+            # The other handlers may be closed already
+            dropped, self.reported = self.dropped - self.reported, self.dropped
+            logging.lastResort.handle(logging.makeLogRecord({
+                "name": __name__,
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": f"{dropped} log records dropped, the queue of {self.target} is full",
+            }))
+        self.target.close()
+        super().close()
+
+
 class ExecutorLoggerFactory:
     template = {
         "version": 1,
@@ -43,18 +153,24 @@ class ExecutorLoggerFactory:
         "filters": {
             "internal_endpoint_filter": {
                 "()": "kuwa.executor.logger.InternalEndpointFilter"
-            }
+            },
+            "large_message_filter": {
+                "()": "kuwa.executor.logger.LargeMessageFilter"
+            },
         },
         "handlers": {
             "default": {
+                "()": "kuwa.executor.logger.QueuedHandler",
                 "formatter": "default",
-                "class": "logging.StreamHandler",
+                "filters": ["large_message_filter"],
+                "target": "logging.StreamHandler",
                 "stream": "ext://sys.stderr",
             },
             "access": {
+                "()": "kuwa.executor.logger.QueuedHandler",
                 "formatter": "access",
                 "filters": ["internal_endpoint_filter"],
-                "class": "logging.StreamHandler",
+                "target": "logging.StreamHandler",
                 "stream": "ext://sys.stdout",
             },
         },
@@ -174,3 +174,33 @@ class ExitCodeChunk(BaseChunk):
 
     def calculate_cost(self):
         return 0
+
+
+class UsageChunk(BaseChunk):
+    """
+    The number of tokens of the prompt and the completion counted by the
+    tokenizer of the model. It's reported in the usage of the response
+    instead of being streamed.
+    """
+
+    def __init__(
+        self,
+        prompt_tokens: int | None = None,
+        completion_tokens: int | None = None,
+        cost: int | None = None,
+    ):
+        super().__init__(cost)
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+
+    def __jsonencode__(self):
+        return {
+            "type": "usage",
+            "usage": {
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+            },
+        }
+
+    def calculate_cost(self):
+        return 0
@@ -12,6 +12,14 @@ class ExecutorMetrics:
             "type": "Counter",
             "description": "Number of failed requests.",
         },
+        "rejected": {
+            "type": "Counter",
+            "description": "Number of requests rejected since the admission queue is full or timed out.",
+        },
+        "queue_depth": {
+            "type": "Gauge",
+            "description": "Number of requests waiting in the admission queue.",
+        },
         "process_time_seconds": {
             "type": "Histogram",
             "description": "Time consumed to process single request with unit: Seconds.",
@@ -94,6 +102,129 @@ class ExecutorMetrics:
                 float("inf"),
             ],
         },
+        "queue_wait_seconds": {
+            "type": "Histogram",
+            "description": "Time a request waited in the admission queue with unit: Seconds.",
+            "buckets": [
+                0.001,
+                0.005,
+                0.01,
+                0.05,
+                0.1,
+                0.5,
+                1.0,
+                2.5,
+                5.0,
+                10.0,
+                20.0,
+                30.0,
+                60.0,
+                float("inf"),
+            ],
+        },
+        "time_to_first_chunk_seconds": {
+            "type": "Histogram",
+            "description": "Time from the start of processing to the first streamed chunk with unit: Seconds.",
+            "buckets": [
+                0.01,
+                0.025,
+                0.05,
+                0.1,
+                0.25,
+                0.5,
+                0.75,
+                1.0,
+                2.5,
+                5.0,
+                7.5,
+                10.0,
+                20.0,
+                30.0,
+                60.0,
+                float("inf"),
+            ],
+        },
+        "inter_chunk_latency_seconds": {
+            "type": "Histogram",
+            "description": "Time between the consecutive streamed chunks with unit: Seconds.",
+            "buckets": [
+                0.001,
+                0.0025,
+                0.005,
+                0.01,
+                0.025,
+                0.05,
+                0.075,
+                0.1,
+                0.25,
+                0.5,
+                1.0,
+                2.5,
+                5.0,
+                float("inf"),
+            ],
+        },
+        "prompt_length_tokens": {
+            "type": "Histogram",
+            "description": "The length of the prompt reported by the executor with unit: Tokens.",
+            "buckets": [
+                16,
+                32,
+                64,
+                128,
+                256,
+                512,
+                1024,
+                2048,
+                4096,
+                8192,
+                16384,
+                32768,
+                65536,
+                131072,
+                float("inf"),
+            ],
+        },
+        "output_length_tokens": {
+            "type": "Histogram",
+            "description": "The length of the output reported by the executor with unit: Tokens.",
+            "buckets": [
+                8,
+                16,
+                32,
+                64,
+                128,
+                256,
+                512,
+                1024,
+                2048,
+                4096,
+                8192,
+                16384,
+                float("inf"),
+            ],
+        },
+        "output_throughput_tokens_per_second": {
+            "type": "Histogram",
+            "description": "The throughput of output reported by the executor with unit: Tokens/Second.",
+            "buckets": [
+                1,
+                5,
+                10,
+                20,
+                30,
+                40,
+                50,
+                60,
+                70,
+                80,
+                90,
+                100,
+                200,
+                500,
+                float("inf"),
+            ],
+        },
     }
 
     def __init__(self, executor_name=None):
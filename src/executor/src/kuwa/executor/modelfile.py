@@ -1,13 +1,18 @@
 from __future__ import annotations
 
 import re
+import copy
 import json
 import logging
+import functools
 from dataclasses import dataclass, field
 from collections import Counter
 
 logger = logging.getLogger(__name__)
 
+# The number of the parsed modelfiles to keep
+MODELFILE_CACHE_SIZE = 128
+
 
 def convert_value(value):
     precedence = [int, float]
@@ -94,6 +99,9 @@ def discard_comments(text_string):
         >>> discard_comments('no hash')
         'no hash'
     """
+    if "#" not in text_string:
+        return text_string.strip()
+
     result = []
     in_double_quotes = False
     in_single_quotes = False
@@ -118,12 +126,94 @@ def discard_comments(text_string):
     return "".join(result).strip()
 
 
+def namespace_of(key):
+    """
+    The namespace of a parameter is the prefix till the first underscore,
+    e.g. "llm_" of "llm_temperature". Return None if there is no namespace.
+    """
+    if not isinstance(key, str):
+        return None
+    i = key.find("_")
+    return key[: i + 1] if i >= 0 else None
+
+
 class ParameterDict(dict):
+    """
+    A dictionary whose keys are indexed by their namespace, so that looking
+    up the parameters by prefix only visits the keys of the namespace.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._namespaces = {}
+        for key in self:
+            self._index(key)
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+    def _index(self, key):
+        namespace = namespace_of(key)
+        if namespace is not None:
+            self._namespaces.setdefault(namespace, {})[key] = None
+
+    def _unindex(self, key):
+        namespace = namespace_of(key)
+        keys = self._namespaces.get(namespace)
+        if keys is None:
+            return
+        keys.pop(key, None)
+        if not keys:
+            del self._namespaces[namespace]
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._index(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._unindex(key)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, key, *args):
+        value = super().pop(key, *args)
+        self._unindex(key)
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._unindex(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return super().__getitem__(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        super().clear()
+        self._namespaces = {}
+
+    def copy(self):
+        return type(self)(self)
+
     def __missing__(self, key):
         """
         Return a sub-dictionary which has common-prefix in key if not exact match.
+        A key containing an underscore shares the namespace with the keys it's
+        the prefix of, otherwise all the keys are visited.
         """
-        prefix_dict = {k[len(key) :]: v for k, v in self.items() if k.startswith(key)}
+        namespace = namespace_of(key)
+        keys = self if namespace is None else self._namespaces.get(namespace, ())
+        getitem = super().__getitem__
+        prefix_dict = {k[len(key) :]: getitem(k) for k in keys if k.startswith(key)}
         return prefix_dict
 
 
@@ -291,6 +381,15 @@ class Modelfile:
 
     @classmethod
     def from_json(cls, raw_modelfile: str):
+        """
+        Parse the modelfile in JSON. The parsed modelfiles are cached by their
+        content and a copy is returned, since the callers modify it.
+        """
+        return cls._parse_json(raw_modelfile).copy()
+
+    @classmethod
+    @functools.lru_cache(maxsize=MODELFILE_CACHE_SIZE)
+    def _parse_json(cls, raw_modelfile: str):
         raw_modelfile = json.loads(raw_modelfile)
         if not raw_modelfile:
             raw_modelfile = []
@@ -326,3 +425,12 @@ class Modelfile:
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
+
+    def copy(self) -> Modelfile:
+        """
+        Copy the modelfile, deep enough to modify its messages and parameters.
+        """
+        modelfile = copy.copy(self)
+        modelfile.messages = [dict(message) for message in self.messages]
+        modelfile.parameters = self.parameters.copy()
+        return modelfile
@@ -0,0 +1,190 @@
+import json
+import time
+import asyncio
+import logging
+import contextlib
+from json.encoder import encode_basestring_ascii
+
+from .message import BaseChunk, TextChunk, ExitCodeChunk
+
+logger = logging.getLogger(__name__)
+
+
+class AdvancedJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if hasattr(obj, "__jsonencode__"):
+            return obj.__jsonencode__()
+
+        if isinstance(obj, set):
+            return list(obj)
+        return super().default(obj)
+
+
+def format_sse(data: dict) -> str:
+    """
+    Format the event as a single "data:" line. The newlines are escaped by
+    the JSON encoding, and the kernel relies on it to flush the stream on the
+    event boundaries.
+    """
+    json_data = json.dumps(data, cls=AdvancedJSONEncoder)
+    return f"data: {json_data}\n"
+
+
+def encode_chunk(chunk: BaseChunk) -> str:
+    """
+    Serialize the chunk to the same JSON as AdvancedJSONEncoder does.
+    The plain text and exit code chunks are serialized directly, the rest
+    goes through the encoder.
+    """
+    chunk_type = type(chunk)
+    if chunk_type is TextChunk and type(chunk.value) is str and not chunk.annotations:
+        return (
+            '{"type": "text", "text": {"value": '
+            + encode_basestring_ascii(chunk.value)
+            + ', "annotations": []}}'
+        )
+    if chunk_type is ExitCodeChunk and type(chunk.exit_code) is int:
+        return '{"type": "exit_code", "exit_code": ' + str(chunk.exit_code) + "}"
+    return json.dumps(chunk, cls=AdvancedJSONEncoder)
+
+
+def format_delta(chunks: list) -> str:
+    """
+    The SSE frame of the chunks in the middle of the response, which is equal
+    to format_sse({"finish_reason": None, "delta": chunks}), in a single line.
+    """
+    return (
+        'data: {"finish_reason": null, "delta": ['
+        + ", ".join([encode_chunk(chunk) for chunk in chunks])
+        + "]}\n"
+    )
+
+
+def as_chunks(item) -> list:
+    """
+    Normalize a piece yielded by the executor to a list of chunks.
+    """
+    if isinstance(item, str):
+        chunks = [TextChunk(item)]
+    elif isinstance(item, list):
+        chunks = item
+    else:
+        chunks = [item]
+    for chunk in chunks:
+        if not isinstance(chunk, BaseChunk):
+            raise RuntimeError(
+                f"Unsupported chunk type: {[type(x) for x in chunks if not isinstance(x, BaseChunk)]}"
+            )
+    return chunks
+
+
+def is_mergeable(chunk: BaseChunk) -> bool:
+    return type(chunk) is TextChunk and type(chunk.value) is str and not chunk.annotations
+
+
+class TextCoalescer:
+    """
+    Merge the consecutive plain text chunks into one, which is flushed once it
+    reaches max_bytes in UTF-8, max_sec after its first piece arrived, or
+    right before any other kind of chunk, so that the order is kept.
+    """
+
+    def __init__(self, max_bytes: int, max_sec: float):
+        self.max_bytes = max_bytes
+        self.max_sec = max_sec
+        self.ready = []
+        self.text = []
+        self.size = 0
+        self.cost = 0
+        self.deadline = None
+
+    def add(self, chunks: list):
+        for chunk in chunks:
+            if not is_mergeable(chunk):
+                self.flush()
+                self.ready.append(chunk)
+                continue
+            if not self.text:
+                self.deadline = time.monotonic() + self.max_sec
+            self.text.append(chunk.value)
+            self.size += len(chunk.value.encode("utf-8"))
+            self.cost += len(chunk)
+        if self.size >= self.max_bytes or (self.text and time.monotonic() >= self.deadline):
+            self.flush()
+
+    def flush(self):
+        if not self.text:
+            return
+        value = "".join(self.text)
+        self.ready.append(TextChunk(value, cost=self.cost if self.cost != len(value) else None))
+        self.text = []
+        self.size = 0
+        self.cost = 0
+        self.deadline = None
+
+    def take(self) -> list:
+        ready, self.ready = self.ready, []
+        return ready
+
+    def remaining(self):
+        """
+        The seconds before the pending text is due, or None if there is none.
+        """
+        if not self.text:
+            return None
+        return max(self.deadline - time.monotonic(), 0)
+
+
+async def coalesce(stream, max_bytes: int, max_sec: float):
+    """
+    Merge the consecutive plain text chunks of the async generator with a
+    TextCoalescer and yield the lists of chunks to flush.
+    The generator is consumed in a separate task, so that the pending text is
+    flushed in time even if the generator stalls, and the task waits for the
+    flushed chunks to be taken, so that it doesn't run ahead of the client.
+    """
+    coalescer = TextCoalescer(max_bytes, max_sec)
+    wakeup = asyncio.Event()
+    taken = asyncio.Event()
+
+    async def pump():
+        async with contextlib.aclosing(stream):
+            async for item in stream:
+                pending = bool(coalescer.text)
+                coalescer.add(as_chunks(item))
+                if coalescer.ready:
+                    taken.clear()
+                    wakeup.set()
+                    await taken.wait()
+                elif coalescer.text and not pending:
+                    # Let the consumer wait with the deadline of the new text
+                    wakeup.set()
+
+    task = asyncio.ensure_future(pump())
+    task.add_done_callback(lambda _: wakeup.set())
+    try:
+        while not task.done():
+            if not coalescer.ready:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), coalescer.remaining())
+                except asyncio.TimeoutError:
+                    coalescer.flush()
+                wakeup.clear()
+            chunks = coalescer.take()
+            taken.set()
+            if chunks:
+                yield chunks
+        coalescer.flush()
+        chunks = coalescer.take()
+        if chunks:
+            yield chunks
+        task.result()
+    finally:
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                logger.debug("Exception raised while closing the stream.", exc_info=True)
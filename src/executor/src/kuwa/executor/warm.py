@@ -0,0 +1,43 @@
+import sys
+import json
+import argparse
+
+# Printed to stdout once the executor class is imported. Keep it in sync with the kernel.
+READY_LINE = "KUWA_WARM_EXECUTOR_READY"
+
+
+class WarmExecutor:
+    """
+    A pre-spawned executor process for the warm pool of the kernel.
+    The executor class, and the heavy libraries it depends on, are imported in
+    advance. The process then waits for a JSON line {"argv": [...]} on stdin
+    and runs the executor with the given arguments, so that assigning a model
+    only pays for loading the weights. It exits if stdin is closed before
+    being assigned.
+    """
+
+    def __init__(self):
+        self.parser = argparse.ArgumentParser(
+            description="Pre-spawned executor waiting for its arguments on stdin."
+        )
+        self.parser.add_argument(
+            "--executor", default="huggingface", help="The executor to pre-import."
+        )
+
+    def run(self):
+        from .cli import EXECUTORS, import_class
+
+        args = self.parser.parse_args()
+        executor_info = [i for i in EXECUTORS if i["name"] == args.executor]
+        if len(executor_info) != 1:
+            self.parser.error(f"Unknown executor {args.executor}")
+        executor_class = import_class(executor_info[0]["class"])
+        print(READY_LINE, flush=True)
+
+        line = sys.stdin.readline()
+        if not line:
+            return
+        argv = json.loads(line)["argv"]
+        sys.argv = [f"{sys.argv[0].rsplit(' ', 1)[0]} {args.executor}", *argv]
+        executor = executor_class()
+        executor.run()
@@ -0,0 +1,81 @@
+import asyncio
+import unittest
+import logging
+from kuwa.executor.admission import AdmissionQueue
+
+
+class TestAdmissionQueue(unittest.IsolatedAsyncioTestCase):
+    async def test_admit_within_limit(self):
+        queue = AdmissionQueue(limit=2, max_queue=0)
+        self.assertTrue(await queue.acquire())
+        self.assertTrue(await queue.acquire())
+        self.assertFalse(await queue.acquire())
+        queue.release()
+        self.assertTrue(await queue.acquire())
+
+    async def test_fifo(self):
+        queue = AdmissionQueue(limit=1, max_queue=3, deadline=5)
+        self.assertTrue(await queue.acquire())
+        admitted = []
+
+        async def request(i):
+            if await queue.acquire():
+                admitted.append(i)
+
+        tasks = []
+        for i in range(3):
+            tasks.append(asyncio.create_task(request(i)))
+            await asyncio.sleep(0)
+        self.assertEqual(queue.depth, 3)
+        for _ in range(3):
+            queue.release()
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*tasks)
+        self.assertEqual(admitted, [0, 1, 2])
+        self.assertEqual(queue.active, 1)
+
+    async def test_queue_full(self):
+        queue = AdmissionQueue(limit=1, max_queue=1, deadline=5)
+        self.assertTrue(await queue.acquire())
+        waiter = asyncio.create_task(queue.acquire())
+        await asyncio.sleep(0)
+        self.assertFalse(await queue.acquire())
+        queue.release()
+        self.assertTrue(await waiter)
+
+    async def test_deadline(self):
+        queue = AdmissionQueue(limit=1, max_queue=1, deadline=0.01)
+        self.assertTrue(await queue.acquire())
+        self.assertFalse(await queue.acquire())
+        self.assertEqual(queue.depth, 0)
+        queue.release()
+        self.assertEqual(queue.active, 0)
+
+    async def test_cancelled_waiter(self):
+        queue = AdmissionQueue(limit=1, max_queue=2, deadline=5)
+        self.assertTrue(await queue.acquire())
+        cancelled = asyncio.create_task(queue.acquire())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(queue.acquire())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await cancelled
+        self.assertEqual(queue.depth, 1)
+        queue.release()
+        self.assertTrue(await waiter)
+
+    async def test_release_once(self):
+        queue = AdmissionQueue(limit=1, max_queue=0)
+        self.assertTrue(await queue.acquire())
+        release = queue.releaser()
+        release()
+        release()
+        self.assertEqual(queue.active, 0)
+        self.assertTrue(await queue.acquire())
+        self.assertEqual(queue.active, 1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,127 @@
+import asyncio
+import unittest
+import logging
+from kuwa.executor.cancellation import CancellationRegistry, accepts_keyword
+from kuwa.executor.admission import AdmissionQueue
+from kuwa.executor.base_executor import BaseExecutor, until_cancelled
+
+
+class TestCancellationRegistry(unittest.IsolatedAsyncioTestCase):
+    async def test_cancel_by_id(self):
+        registry = CancellationRegistry()
+        first, second = registry.create("a"), registry.create()
+        self.assertEqual(first.request_id, "a")
+        self.assertNotEqual(registry.create("a").request_id, "a")
+        self.assertTrue(registry.cancel("a"))
+        self.assertTrue(first.cancelled)
+        self.assertFalse(second.cancelled)
+        self.assertFalse(registry.cancel("missing"))
+        registry.remove(first)
+        self.assertNotIn("a", registry)
+
+    async def test_cancel_all(self):
+        registry = CancellationRegistry()
+        tokens = [registry.create() for _ in range(3)]
+        self.assertEqual(registry.cancel_all(), 3)
+        self.assertTrue(all(i.cancelled for i in tokens))
+
+    async def test_callback(self):
+        token = CancellationRegistry().create()
+        called = []
+        token.add_callback(lambda: called.append(1))
+        token.cancel()
+        token.cancel()
+        token.add_callback(lambda: called.append(2))
+        self.assertEqual(called, [1, 2])
+
+    def test_accepts_keyword(self):
+        self.assertTrue(accepts_keyword(lambda history, cancel_token=None: None, "cancel_token"))
+        self.assertTrue(accepts_keyword(lambda history, **kwargs: None, "cancel_token"))
+        self.assertFalse(accepts_keyword(lambda history: None, "cancel_token"))
+
+
+class TestUntilCancelled(unittest.IsolatedAsyncioTestCase):
+    async def test_interrupt_pending_step(self):
+        token = CancellationRegistry().create()
+        events = []
+
+        async def generate():
+            try:
+                yield "first"
+                await asyncio.sleep(60)
+                yield "second"
+            except asyncio.CancelledError:
+                events.append("interrupted")
+                raise
+
+        chunks = []
+
+        async def consume():
+            async for chunk in until_cancelled(generate(), token):
+                chunks.append(chunk)
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.01)
+        token.cancel()
+        await asyncio.wait_for(task, 1)
+        self.assertEqual(chunks, ["first"])
+        self.assertEqual(events, ["interrupted"])
+
+    async def test_close_generator(self):
+        token = CancellationRegistry().create()
+        events = []
+
+        async def generate():
+            try:
+                for i in range(10):
+                    yield i
+            finally:
+                events.append("closed")
+
+        chunks = []
+        async for chunk in until_cancelled(generate(), token):
+            chunks.append(chunk)
+            if chunk == 2:
+                token.cancel()
+        self.assertEqual(chunks, [0, 1, 2])
+        self.assertEqual(events, ["closed"])
+
+    async def test_exhausted(self):
+        token = CancellationRegistry().create()
+
+        async def generate():
+            yield 1
+            yield 2
+
+        self.assertEqual([i async for i in until_cancelled(generate(), token)], [1, 2])
+
+
+class TestAdmit(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.executor = BaseExecutor()
+        self.executor.admission = AdmissionQueue(limit=1, max_queue=1)
+
+    async def test_abort_while_queued(self):
+        self.assertTrue(await self.executor._admit(self.executor.cancellation.create()))
+        token = self.executor.cancellation.create("queued")
+        waiting = asyncio.create_task(self.executor._admit(token))
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.executor.admission.depth, 1)
+        self.assertTrue(self.executor.cancellation.cancel("queued"))
+        self.assertFalse(await asyncio.wait_for(waiting, 1))
+        self.assertEqual(self.executor.admission.depth, 0)
+        # The slot is handed to the next request instead of the aborted one
+        self.executor.admission.release()
+        self.assertTrue(await self.executor._admit(self.executor.cancellation.create()))
+        self.assertEqual(self.executor.admission.active, 1)
+
+    async def test_aborted_before_admission(self):
+        token = self.executor.cancellation.create()
+        token.cancel()
+        self.assertFalse(await self.executor._admit(token))
+        self.assertEqual(self.executor.admission.active, 0)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
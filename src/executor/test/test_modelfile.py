@@ -1,6 +1,8 @@
 import unittest
 import logging
-from kuwa.executor.modelfile import extract_text_from_quotes, discard_comments, Script
+import json
+import pickle
+from kuwa.executor.modelfile import extract_text_from_quotes, discard_comments, Script, Modelfile, ParameterDict
 
 
 class TestExtractTextFromQuotes(unittest.TestCase):
@@ -168,10 +170,106 @@ class TestDiscardComments(unittest.TestCase):
         self.assertEqual(discard_comments(input_string), expected_output)
 
 
+class TestParameterDict(unittest.TestCase):
+    def test_prefix_lookup(self):
+        parameters = ParameterDict({"llm_temperature": 0.5, "_lang": "en"})
+        parameters["llm_top_k"] = 10
+        parameters["tool"] = "x"
+        self.assertEqual(parameters["llm_"], {"temperature": 0.5, "top_k": 10})
+        self.assertEqual(parameters["llm_top"], {"_k": 10})
+        self.assertEqual(parameters["_"], {"lang": "en"})
+        self.assertEqual(parameters["to"], {"ol": "x"})
+        self.assertEqual(parameters["agent_"], {})
+
+    def test_index_follows_mutation(self):
+        parameters = ParameterDict(llm_a=1, llm_b=2, llm_c=3)
+        del parameters["llm_a"]
+        parameters.pop("llm_b")
+        parameters.update({"llm_d": 4}, llm_e=5)
+        parameters |= {"llm_f": 6}
+        parameters.setdefault("llm_g", 7)
+        self.assertEqual(parameters["llm_"], {"c": 3, "d": 4, "e": 5, "f": 6, "g": 7})
+        copied = parameters.copy()
+        copied["llm_h"] = 8
+        self.assertIsInstance(copied, ParameterDict)
+        self.assertNotIn("h", parameters["llm_"])
+        self.assertEqual(pickle.loads(pickle.dumps(copied))["llm_"]["h"], 8)
+        parameters.clear()
+        self.assertEqual(parameters["llm_"], {})
+
+
+class TestModelfileCache(unittest.TestCase):
+    raw_modelfile = json.dumps(
+        [
+            {"name": "system", "args": '"You are a helpful assistant." # comment'},
+            {"name": "message", "args": "user Hi"},
+            {"name": "parameter", "args": "llm_temperature 0.5"},
+        ]
+    )
+
+    def test_cached_copy(self):
+        first = Modelfile.from_json(self.raw_modelfile)
+        first.parameters["_lang"] = "en"
+        first.messages[0]["content"] = "Modified"
+        second = Modelfile.from_json(self.raw_modelfile)
+        self.assertEqual(second.override_system_prompt, "You are a helpful assistant.")
+        self.assertEqual(second.messages, [{"content": "Hi", "role": "user"}])
+        self.assertEqual(second.parameters["llm_"], {"temperature": 0.5})
+        self.assertEqual(second.parameters["_"], {})
+
+
 if __name__ == "__main__":
     unittest.main(argv=["first-arg-is-ignored"], exit=False)
 
 
+class TestParameterDict(unittest.TestCase):
+    def test_prefix_lookup(self):
+        parameters = ParameterDict({"llm_temperature": 0.5, "_lang": "en"})
+        parameters["llm_top_k"] = 10
+        parameters["tool"] = "x"
+        self.assertEqual(parameters["llm_"], {"temperature": 0.5, "top_k": 10})
+        self.assertEqual(parameters["llm_top"], {"_k": 10})
+        self.assertEqual(parameters["_"], {"lang": "en"})
+        self.assertEqual(parameters["to"], {"ol": "x"})
+        self.assertEqual(parameters["agent_"], {})
+
+    def test_index_follows_mutation(self):
+        parameters = ParameterDict(llm_a=1, llm_b=2, llm_c=3)
+        del parameters["llm_a"]
+        parameters.pop("llm_b")
+        parameters.update({"llm_d": 4}, llm_e=5)
+        parameters |= {"llm_f": 6}
+        parameters.setdefault("llm_g", 7)
+        self.assertEqual(parameters["llm_"], {"c": 3, "d": 4, "e": 5, "f": 6, "g": 7})
+        copied = parameters.copy()
+        copied["llm_h"] = 8
+        self.assertIsInstance(copied, ParameterDict)
+        self.assertNotIn("h", parameters["llm_"])
+        self.assertEqual(pickle.loads(pickle.dumps(copied))["llm_"]["h"], 8)
+        parameters.clear()
+        self.assertEqual(parameters["llm_"], {})
+
+
+class TestModelfileCache(unittest.TestCase):
+    raw_modelfile = json.dumps(
+        [
+            {"name": "system", "args": '"You are a helpful assistant." # comment'},
+            {"name": "message", "args": "user Hi"},
+            {"name": "parameter", "args": "llm_temperature 0.5"},
+        ]
+    )
+
+    def test_cached_copy(self):
+        first = Modelfile.from_json(self.raw_modelfile)
+        first.parameters["_lang"] = "en"
+        first.messages[0]["content"] = "Modified"
+        second = Modelfile.from_json(self.raw_modelfile)
+        self.assertEqual(second.override_system_prompt, "You are a helpful assistant.")
+        self.assertEqual(second.messages, [{"content": "Hi", "role": "user"}])
+        self.assertEqual(second.parameters["llm_"], {"temperature": 0.5})
+        self.assertEqual(second.parameters["_"], {})
+
+
 if __name__ == "__main__":
     logging.basicConfig(level="DEBUG")
     unittest.main()
@@ -0,0 +1,51 @@
+import time
+import types
+import unittest
+import logging
+import threading
+from kuwa.executor.base_executor import BaseExecutor
+
+
+class TestRegisterWhenStarted(unittest.TestCase):
+    def setUp(self):
+        self.executor = BaseExecutor()
+        self.executor.access_codes = ["a", "b"]
+        self.executor.registered = False
+        self.registered = []
+        self.executor._try_register = self.registered.append
+        self.server = types.SimpleNamespace(started=False, should_exit=False)
+        self.thread = threading.Thread(target=self.executor._register_when_started, args=(self.server,))
+
+    def test_register_once_listening(self):
+        self.thread.start()
+        time.sleep(0.2)
+        # The kernel mustn't route jobs to the executor before it's listening
+        self.assertEqual(self.registered, [])
+        self.server.started = True
+        self.thread.join(1)
+        self.assertEqual(self.registered, ["a", "b"])
+        self.assertTrue(self.executor.registered)
+        self.assertFalse(self.server.should_exit)
+
+    def test_exit_on_failure(self):
+        def fail(access_code):
+            raise RuntimeWarning("The server failed to register to kernel.")
+        self.executor._try_register = fail
+        self.server.started = True
+        self.thread.start()
+        self.thread.join(1)
+        # The server is shut down instead of serving without being registered
+        self.assertTrue(self.server.should_exit)
+        self.assertFalse(self.executor.registered)
+
+    def test_exit_before_started(self):
+        self.thread.start()
+        self.server.should_exit = True
+        self.thread.join(1)
+        self.assertFalse(self.thread.is_alive())
+        self.assertEqual(self.registered, [])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,136 @@
+import asyncio
+import unittest
+import logging
+from kuwa.executor.sse import format_sse, format_delta, as_chunks, coalesce, TextCoalescer
+from kuwa.executor.message import (
+    TextChunk,
+    LogChunk,
+    LogLevel,
+    ImageURLChunk,
+    ExitCodeChunk,
+)
+from kuwa.executor.cancellation import CancellationRegistry
+from kuwa.executor.base_executor import until_cancelled
+
+
+class TestEncoder(unittest.TestCase):
+    def test_same_as_json_encoder(self):
+        cases = [
+            [TextChunk("Hello")],
+            [TextChunk('quote " backslash \\ newline \n tab \t \x00')],
+            [TextChunk("中文 emoji 🤖")],
+            [TextChunk("annotated", annotations=[{"type": "file_citation"}])],
+            [TextChunk(""), ExitCodeChunk(ExitCodeChunk.INCOMPLETE)],
+            [LogChunk("log", level=LogLevel.ERROR), ImageURLChunk("http://localhost/a.png")],
+            [],
+        ]
+        for chunks in cases:
+            frame = format_delta(chunks)
+            self.assertEqual(frame, format_sse({"finish_reason": None, "delta": chunks}))
+            # The kernel flushes the stream on newlines
+            self.assertEqual(frame.count("\n"), 1)
+            self.assertTrue(frame.endswith("\n"))
+
+    def test_as_chunks(self):
+        self.assertEqual(as_chunks("a")[0].value, "a")
+        log = LogChunk("log")
+        self.assertEqual(as_chunks(log), [log])
+        with self.assertRaises(RuntimeError):
+            as_chunks(["a"])
+
+
+class TestTextCoalescer(unittest.TestCase):
+    def test_merge_until_other_chunk(self):
+        coalescer = TextCoalescer(max_bytes=1024, max_sec=60)
+        exit_code = ExitCodeChunk(ExitCodeChunk.OK)
+        coalescer.add([TextChunk("a"), TextChunk("b")])
+        self.assertEqual(coalescer.take(), [])
+        coalescer.add([TextChunk("c"), exit_code, TextChunk("d")])
+        chunks = coalescer.take()
+        self.assertEqual([chunk.value for chunk in chunks[:1]], ["abc"])
+        self.assertIs(chunks[1], exit_code)
+        coalescer.flush()
+        self.assertEqual(coalescer.take()[0].value, "d")
+
+    def test_max_bytes(self):
+        coalescer = TextCoalescer(max_bytes=6, max_sec=60)
+        coalescer.add([TextChunk("中")])
+        self.assertEqual(coalescer.take(), [])
+        coalescer.add([TextChunk("文")])
+        self.assertEqual(coalescer.take()[0].value, "中文")
+
+    def test_keep_cost(self):
+        coalescer = TextCoalescer(max_bytes=1024, max_sec=60)
+        coalescer.add([TextChunk("ab", cost=1), TextChunk("c")])
+        coalescer.flush()
+        self.assertEqual(len(coalescer.take()[0]), 2)
+
+
+class TestCoalesce(unittest.IsolatedAsyncioTestCase):
+    async def test_flush_on_deadline(self):
+        async def generate():
+            yield "a"
+            yield "b"
+            await asyncio.sleep(0.2)
+            yield "c"
+
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        flushed = []
+        async for chunks in coalesce(generate(), max_bytes=1024, max_sec=0.02):
+            flushed.append(([chunk.value for chunk in chunks], loop.time() - start_time))
+        self.assertEqual([values for values, _ in flushed], [["ab"], ["c"]])
+        self.assertLess(flushed[0][1], 0.15)
+
+    async def test_flush_before_exception(self):
+        async def generate():
+            yield "a"
+            raise ValueError()
+
+        flushed = []
+        with self.assertRaises(ValueError):
+            async for chunks in coalesce(generate(), max_bytes=1024, max_sec=60):
+                flushed.append(chunks[0].value)
+        self.assertEqual(flushed, ["a"])
+
+    async def test_cancel(self):
+        token = CancellationRegistry().create()
+
+        async def generate():
+            yield "a"
+            await asyncio.sleep(60)
+            yield "b"
+
+        flushed = []
+
+        async def consume():
+            stream = until_cancelled(generate(), token)
+            async for chunks in coalesce(stream, max_bytes=1024, max_sec=0.01):
+                flushed.append(chunks[0].value)
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.05)
+        token.cancel()
+        await asyncio.wait_for(task, 1)
+        self.assertEqual(flushed, ["a"])
+
+    async def test_close(self):
+        events = []
+
+        async def generate():
+            try:
+                while True:
+                    yield "a"
+                    await asyncio.sleep(0)
+            finally:
+                events.append("closed")
+
+        stream = coalesce(generate(), max_bytes=4, max_sec=60)
+        self.assertEqual((await stream.__anext__())[0].value, "aaaa")
+        await stream.aclose()
+        self.assertEqual(events, ["closed"])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,92 @@
+import json
+import asyncio
+import unittest
+import logging
+from prometheus_client import REGISTRY
+from kuwa.executor.base_executor import BaseExecutor
+from kuwa.executor.metrics import ExecutorMetrics
+from kuwa.executor.message import UsageChunk
+
+metrics = ExecutorMetrics("test_usage")
+
+
+class CannedExecutor(BaseExecutor):
+    def __init__(self, pieces):
+        super().__init__()
+        self.pieces = pieces
+        self.metrics = metrics
+
+    async def serve(self, header, content):
+        for piece in self.pieces:
+            yield piece
+
+
+async def serve(pieces):
+    executor = CannedExecutor(pieces)
+    frames = [json.loads(i.removeprefix("data: ")) async for i in executor._serve(header={}, content={})]
+    return frames[:-1], frames[-1]
+
+
+def sample(name, **labels):
+    value = REGISTRY.get_sample_value(f"executor_framework_{name}", {"executor_name": "test_usage", **labels})
+    return value or 0
+
+
+class TestUsage(unittest.IsolatedAsyncioTestCase):
+    async def test_reported_usage(self):
+        observed = sample("output_length_tokens_count")
+        chunks, final = await serve(["ab", UsageChunk(prompt_tokens=3, completion_tokens=2), "c"])
+        self.assertEqual(
+            [[delta["type"] for delta in i["delta"]] for i in chunks],
+            [["text"], ["text"]],
+        )
+        self.assertEqual(
+            final["usage"],
+            {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5},
+        )
+        self.assertEqual(sample("output_length_tokens_count"), observed + 1)
+
+    async def test_charters_without_report(self):
+        _, final = await serve(["ab", "c"])
+        self.assertEqual(
+            final["usage"],
+            {"prompt_tokens": 0, "completion_tokens": 3, "total_tokens": 3},
+        )
+
+    async def test_chunk_latency(self):
+        first = sample("time_to_first_chunk_seconds_count")
+        inter = sample("inter_chunk_latency_seconds_count")
+        await serve(["a", "b", "c"])
+        self.assertEqual(sample("time_to_first_chunk_seconds_count"), first + 1)
+        self.assertEqual(sample("inter_chunk_latency_seconds_count"), inter + 2)
+
+    async def test_busy_until_the_last_request(self):
+        executor = CannedExecutor(["a", "b"])
+        first, second = executor._serve(header={}, content={}), executor._serve(header={}, content={})
+        await first.__anext__()
+        await second.__anext__()
+        self.assertEqual(sample("state", executor_framework_state="busy"), 1)
+        async for _ in first: pass
+        self.assertEqual(sample("state", executor_framework_state="busy"), 1)
+        async for _ in second: pass
+        self.assertEqual(sample("state", executor_framework_state="idle"), 1)
+
+    async def test_yield_to_event_loop(self):
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0)
+
+        task = asyncio.create_task(tick())
+        await asyncio.sleep(0)
+        observed = len(ticks)
+        await serve(["a"] * 10)
+        task.cancel()
+        self.assertGreaterEqual(len(ticks) - observed, 10)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,268 @@
+"""
+End-to-end benchmark of the kernel. It starts a kernel and N debug or dummy
+executors locally, then drives concurrent chat sessions through
+schedule -> completions (-> abort for a fraction of them), and reports the
+requests per second, the percentiles of the TTFB and of the interval between
+chunks, and the CPU time of the kernel per request as JSON.
+The same workload is first sent to the executors directly as the baseline,
+so that the overhead of the kernel can be told apart from the executors.
+
+Example:
+    python benchmark/bench_kernel.py --executors 4 --sessions 8 --requests 400 \\
+        --executor_command "python -m kuwa.executor.cli" --output report.json
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import asyncio
+import argparse
+import tempfile
+import itertools
+import subprocess
+from statistics import quantiles, median
+
+import aiohttp
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from kuwa.kernel.loadgen import send_request
+
+API_PREFIX = "/v1.0"
+
+
+def percentiles(values):
+    """
+    Return the p50/p95/p99 of the values in milliseconds.
+    """
+    if not values:
+        return None
+    if len(values) == 1:
+        return {f"p{p}_ms": values[0] * 1000 for p in (50, 95, 99)}
+    cuts = quantiles(values, n=100, method="inclusive")
+    return {"p50_ms": median(values) * 1000, "p95_ms": cuts[94] * 1000, "p99_ms": cuts[98] * 1000}
+
+
+def cpu_seconds(pid):
+    """
+    Return the user and system CPU time of the process, None if unavailable.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Cluster:
+    """
+    The kernel and executor processes under benchmark, logging to work_dir.
+    """
+
+    def __init__(self, args, work_dir):
+        self.args = args
+        self.work_dir = work_dir
+        self.kernel_url = f"http://127.0.0.1:{args.kernel_port}"
+        self.endpoints = [f"http://127.0.0.1:{args.base_port + i}/chat" for i in range(args.executors)]
+        self.kernel = None
+        self.executors = []
+
+    def spawn(self, command, log_name):
+        log_file = open(os.path.join(self.work_dir, log_name), "w")
+        return subprocess.Popen(command, cwd=self.work_dir, stdout=log_file, stderr=subprocess.STDOUT)
+
+    async def wait_for(self, session, condition, timeout, what):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                if await condition(session): return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+        raise TimeoutError(f"Timed out waiting for {what}, see the logs in {self.work_dir}")
+
+    async def start(self, session):
+        args = self.args
+        kernel_command = [
+            sys.executable, "-m", "kuwa.kernel.main", "--port", str(args.kernel_port),
+            "--host", "127.0.0.1", "--log_level", "WARNING", *shlex.split(args.kernel_args)
+        ]
+        if args.asgi: kernel_command.append("--asgi")
+        self.kernel = self.spawn(kernel_command, "kernel.log")
+
+        async def kernel_ready(session):
+            async with session.get(f"{self.kernel_url}{API_PREFIX}/worker/list") as resp:
+                return resp.status == 200
+        await self.wait_for(session, kernel_ready, args.startup_timeout, "the kernel")
+
+        for i, endpoint in enumerate(self.endpoints):
+            self.executors.append(self.spawn([
+                *shlex.split(args.executor_command), args.executor,
+                "--access_code", args.access_code, "--kernel_url", self.kernel_url + "/",
+                "--host", "127.0.0.1", "--port", str(args.base_port + i), "--delay", str(args.delay),
+                "--log", "WARNING",
+            ], f"executor-{i}.log"))
+
+        async def executors_registered(session):
+            async with session.get(f"{self.kernel_url}{API_PREFIX}/worker/debug", headers={"Accept": "application/json"}) as resp:
+                records = await resp.json()
+            return len(records.get(args.access_code, [])) >= len(self.endpoints)
+        await self.wait_for(session, executors_registered, args.startup_timeout, "the executors")
+
+    def stop(self):
+        for process in [*self.executors, self.kernel]:
+            if process is not None and process.poll() is None:
+                process.terminate()
+        for process in [*self.executors, self.kernel]:
+            if process is None: continue
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+async def chat(session, url, form, abort_url=None, abort_form=None, abort_after=0):
+    """
+    Send a chat request, aborting it after abort_after seconds if abort_url is given.
+    """
+    task = asyncio.create_task(send_request(session, url, form))
+    if abort_url is not None:
+        await asyncio.sleep(abort_after)
+        if abort_form is None:
+            async with session.get(abort_url) as resp: await resp.read()
+        else:
+            async with session.post(abort_url, data=abort_form) as resp: await resp.read()
+    result = await task
+    result["aborted"] = abort_url is not None
+    return result
+
+
+async def run_sessions(n_sessions, n_requests, request):
+    """
+    Run the requests in n_sessions closed-loop sessions and return the results and the duration.
+    """
+    counter = itertools.count()
+    results = []
+
+    async def session_loop(session_id):
+        while next(counter) < n_requests:
+            results.append(await request(session_id))
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(session_loop(i) for i in range(n_sessions)))
+    return results, time.perf_counter() - start_time
+
+
+def summarize(results, duration):
+    counts = {}
+    for i in results:
+        counts[i["result"]] = counts.get(i["result"], 0) + 1
+    completed = [i for i in results if i["result"] == "READY" and i["ttfb"] is not None]
+    intervals = [b - a for i in completed for a, b in zip(i["chunk_times"], i["chunk_times"][1:])]
+    return {
+        "requests": len(results),
+        "results": counts,
+        "aborted": sum(1 for i in results if i.get("aborted")),
+        "duration_sec": duration,
+        "requests_per_sec": len(completed) / duration if duration > 0 else None,
+        "ttfb": percentiles([i["ttfb"] for i in completed]),
+        "chunk_interval": percentiles(intervals),
+    }
+
+
+async def benchmark(args):
+    prompt = args.prompt or "Lorem ipsum dolor sit amet, consectetur adipiscing elit."
+    history = json.dumps([{"isbot": False, "msg": prompt}])
+    history_ids = itertools.count(1)
+    rng = random.Random(args.seed)
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=600)
+    report = {"config": {k: v for k, v in vars(args).items() if k != "output"}}
+
+    with tempfile.TemporaryDirectory(prefix="kuwa-bench-") as work_dir:
+        cluster = Cluster(args, work_dir)
+        async with aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=0)) as session:
+            try:
+                await cluster.start(session)
+
+                # Baseline: one session per executor, talking to the executors directly
+                async def direct_request(session_id):
+                    endpoint = cluster.endpoints[session_id]
+                    form = {"input": history, "name": args.access_code, "history_id": str(next(history_ids)), "user_id": str(session_id)}
+                    abort_url = endpoint + "/abort" if rng.random() < args.abort_ratio else None
+                    return await chat(session, endpoint, form, abort_url, abort_after=args.abort_after)
+                results, duration = await run_sessions(len(cluster.endpoints), args.baseline_requests, direct_request)
+                report["baseline"] = summarize(results, duration)
+
+                # Through the kernel: schedule -> completions (-> abort)
+                async def kernel_request(session_id):
+                    form = {"input": history, "name": args.access_code, "history_id": str(next(history_ids)), "user_id": str(session_id)}
+                    start_time = time.perf_counter()
+                    async with session.post(f"{cluster.kernel_url}{API_PREFIX}/worker/schedule", data=form) as resp:
+                        state = (await resp.text()).strip()
+                    schedule_sec = time.perf_counter() - start_time
+                    if state != "READY":
+                        return {"result": state or "ERROR", "ttfb": None, "duration": schedule_sec, "chunk_times": [], "schedule": schedule_sec}
+                    abort_url, abort_form = None, None
+                    if rng.random() < args.abort_ratio:
+                        abort_url = f"{cluster.kernel_url}{API_PREFIX}/chat/abort"
+                        abort_form = {"history_id": json.dumps([form["history_id"]]), "user_id": form["user_id"]}
+                    result = await chat(session, f"{cluster.kernel_url}{API_PREFIX}/chat/completions", form, abort_url, abort_form, args.abort_after)
+                    result["schedule"] = schedule_sec
+                    return result
+
+                cpu_before = cpu_seconds(cluster.kernel.pid)
+                results, duration = await run_sessions(args.sessions, args.requests, kernel_request)
+                cpu_after = cpu_seconds(cluster.kernel.pid)
+                summary = summarize(results, duration)
+                summary["schedule"] = percentiles([i["schedule"] for i in results])
+                summary["ttfb_with_schedule"] = percentiles([i["schedule"] + i["ttfb"] for i in results if i["ttfb"] is not None])
+                summary["kernel_cpu_ms_per_request"] = (cpu_after - cpu_before) * 1000 / len(results) \
+                    if cpu_before is not None and cpu_after is not None and results else None
+                report["kernel"] = summary
+            finally:
+                cluster.stop()
+
+    baseline, kernel = report["baseline"], report["kernel"]
+    report["overhead"] = {
+        name: kernel[name]["p50_ms"] - baseline[name]["p50_ms"]
+        for name in ("ttfb", "chunk_interval")
+        if kernel[name] is not None and baseline[name] is not None
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the throughput and the latency of the kernel end to end.")
+    parser.add_argument("--executors", type=int, default=2, help="The number of executors.")
+    parser.add_argument("--executor", choices=["debug", "dummy"], default="debug", help="The executor to serve.")
+    parser.add_argument("--executor_command", default="kuwa-executor", help="The command to start the executors.")
+    parser.add_argument("--delay", type=float, default=0.005, help="The inter-token delay of the executors in seconds.")
+    parser.add_argument("--access_code", default="bench", help="The access code of the executors.")
+    parser.add_argument("--sessions", type=int, default=4, help="The number of concurrent chat sessions.")
+    parser.add_argument("--requests", type=int, default=200, help="The number of requests through the kernel.")
+    parser.add_argument("--baseline_requests", type=int, default=50, help="The number of requests sent to the executors directly.")
+    parser.add_argument("--abort_ratio", type=float, default=0.1, help="The fraction of the requests to abort.")
+    parser.add_argument("--abort_after", type=float, default=0.05, help="The seconds after which the requests are aborted.")
+    parser.add_argument("--prompt", default=None, help="The prompt, which is echoed by the debug executor.")
+    parser.add_argument("--asgi", action="store_true", help="Serve the kernel with the ASGI server.")
+    parser.add_argument("--kernel_args", default="", help="Extra arguments of the kernel.")
+    parser.add_argument("--kernel_port", type=int, default=9300, help="The port of the kernel.")
+    parser.add_argument("--base_port", type=int, default=9301, help="The port of the first executor.")
+    parser.add_argument("--startup_timeout", type=float, default=60, help="The seconds to wait for the processes to start.")
+    parser.add_argument("--seed", type=int, default=0, help="The random seed to choose the requests to abort.")
+    parser.add_argument("--output", default=None, help="The file to write the JSON report to.")
+    args = parser.parse_args()
+
+    report = asyncio.run(benchmark(args))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Measure the time to the first chunk and the per-chunk overhead added by the
+safety middleware to an in-process backend streaming canned chunks.
+The middleware is benchmarked with and without the guard pool against the
+bare backend. The guard of "llm-safety-guard" is used if it's installed,
+otherwise --guard passthrough measures the overhead of the middleware itself.
+
+Example:
+    python benchmark/bench_safety_middleware.py -n 1000 --guard passthrough
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from statistics import median, quantiles
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from kuwa.kernel.safety_middleware import safety_middleware
+
+
+class PassThroughGuard:
+    """
+    A guard forwarding everything, so that only the middleware is measured.
+    """
+
+    def __init__(self, n_max_buffer, streaming):
+        pass
+
+    def guard(self, func):
+        def wrap(chat_history, model_id, *args, at_exit=None, **kwargs):
+            return func(chat_history, model_id, *args, **kwargs)
+        return wrap
+
+
+def make_backend(n_chunks, chunk):
+    def completions_backend(form: dict, headers: dict, dest: list, decode: bool = False):
+        def event_stream():
+            for _ in range(n_chunks):
+                yield chunk
+        return event_stream(), {'Content-Type': 'text/plain'}
+    return completions_backend
+
+
+def measure(completions_backend, form, n):
+    ttfbs, per_chunk = [], []
+    for _ in range(n):
+        start_time = time.perf_counter()
+        stream, _ = completions_backend(form=form, headers={}, dest=["http://127.0.0.1:9/chat", "bench", "1", "1"])
+        chunk_times = []
+        for _ in stream:
+            chunk_times.append(time.perf_counter())
+        stream_close = getattr(stream, "close", None)
+        if stream_close is not None: stream_close()
+        ttfbs.append(chunk_times[0] - start_time)
+        if len(chunk_times) > 1:
+            per_chunk.append((chunk_times[-1] - chunk_times[0]) / (len(chunk_times) - 1))
+    return {
+        "ttfb_p50_us": median(ttfbs) * 1e6,
+        "ttfb_p99_us": quantiles(ttfbs, n=100)[98] * 1e6 if len(ttfbs) > 1 else ttfbs[0] * 1e6,
+        "per_chunk_us": median(per_chunk) * 1e6 if per_chunk else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the overhead of the safety middleware.")
+    parser.add_argument("-n", type=int, default=1000, help="Iteration of benchmark.")
+    parser.add_argument("--guard", choices=["llm-safety-guard", "passthrough"], default="llm-safety-guard", help="The guard to benchmark.")
+    parser.add_argument("--turns", type=int, default=10, help="The number of records in the chat history.")
+    parser.add_argument("--chunks", type=int, default=100, help="The number of chunks streamed by the backend.")
+    parser.add_argument("--pool_size", type=int, default=16, help="The size of the guard pool.")
+    args = parser.parse_args()
+
+    guard_class = PassThroughGuard if args.guard == "passthrough" else None
+    history = [{"isbot": i % 2 == 1, "msg": "Lorem ipsum dolor sit amet. " * 20} for i in range(args.turns)]
+    form = {"name": "bench", "input": json.dumps(history), "history_id": "1", "user_id": "1"}
+    backend = make_backend(args.chunks, "data: Lorem ipsum\n\n")
+
+    pooled = safety_middleware(backend, pool_size=args.pool_size, guard_class=guard_class)
+    if pooled.bypass:
+        print('The package "llm-safety-guard" is not installed, try --guard passthrough.')
+        return
+    pooled.pool.fill()
+    unpooled = safety_middleware(backend, pool_size=0, guard_class=guard_class)
+
+    report = {"baseline": measure(backend, form, args.n)}
+    for name, middleware in (("pooled", pooled), ("unpooled", unpooled)):
+        result = measure(middleware, form, args.n)
+        result["added_ttfb_p50_us"] = result["ttfb_p50_us"] - report["baseline"]["ttfb_p50_us"]
+        result["added_per_chunk_us"] = result["per_chunk_us"] - report["baseline"]["per_chunk_us"]
+        report[name] = result
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import logging, asyncio, aiohttp, json
+from urllib.parse import parse_qsl
+from uvicorn.middleware.wsgi import WSGIMiddleware
+from .variable import *
+from .registry import READY, BUSY
+from .routes.chat import completions_backend, SCHEDULE_FAILURE_STATUS
+from .routes.chat import parse_history_ids, abort_coalesced, abort_report, session_of
+from .functions import abort_all, SSEFrameAligner, is_event_stream
+from .health import prober
+from .metrics import metrics, StreamMonitor
+from .autoscaler import autoscaler
+from .coalescer import coalescer
+
+logger = logging.getLogger(__name__)
+
+# Headers that should not be forwarded to the executor
+HOP_BY_HOP_HEADERS = {
+    "host", "content-length", "connection", "keep-alive", "transfer-encoding",
+    "te", "trailer", "upgrade", "proxy-authorization", "proxy-authenticate",
+}
+
+class KernelASGIApp:
+    """
+    The asyncio-native kernel.
+    The chat completions endpoint is served by coroutines that stream through a
+    shared keep-alive connection pool to the executors, and the scheduling
+    requests wait in the admission queue without holding a thread. The
+    remaining routes are delegated to the Flask application.
+    """
+
+    def __init__(self, flask_app, api_prefix, pool_size=1000, keepalive_timeout=60, read_timeout=5000):
+        self.flask_app = flask_app
+        self.wsgi_app = WSGIMiddleware(flask_app)
+        self.completions_path = f"{api_prefix}/chat/completions"
+        self.schedule_path = f"{api_prefix}/worker/schedule"
+        self.stream_path = f"{api_prefix}/chat/stream"
+        self.abort_path = f"{api_prefix}/chat/abort"
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=read_timeout)
+        self.session = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == self.completions_path:
+            await self.completions(scope, receive, send)
+        elif scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == self.schedule_path:
+            await self.schedule(scope, receive, send)
+        elif scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == self.stream_path:
+            await self.completions(scope, receive, send, schedule=True)
+        elif scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == self.abort_path:
+            await self.abort(scope, receive, send)
+        else:
+            await self.wsgi_app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout),
+                    timeout=self.timeout,
+                    auto_decompress=False,
+                )
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.session is not None:
+                    await self.session.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    def is_urlencoded(headers):
+        return headers.get("content-type", "").startswith("application/x-www-form-urlencoded")
+
+    @staticmethod
+    async def read_body(receive):
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body", False): break
+        return bytes(body)
+
+    @staticmethod
+    def replay(body, receive):
+        """
+        Return the receive callable replaying the body which has been read.
+        """
+        replayed = False
+        async def wrap():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+        return wrap
+
+    @staticmethod
+    async def call_registry(func, *args, **kwargs):
+        """
+        Call the registry method, in a thread if it may make round trips to
+        the lease backend, so that a slow backend doesn't stall the streams.
+        """
+        if data.leases is None:
+            return func(*args, **kwargs)
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def wait(self, form):
+        """
+        Schedule the job in the form without blocking the event loop.
+        Return "READY", "BUSY" or "NOMACHINE".
+        """
+        llm_name, history_id, user_id = form.get("name"), form.get("history_id"), form.get("user_id")
+        if not llm_name or not history_id:
+            return BUSY
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        max_wait = self.flask_app.config.get("SCHEDULE_MAX_WAIT_SEC", schedule_max_wait_sec)
+        max_wait = min(float(form.get("max_wait", max_wait)), max_wait)
+        affinity_wait = self.flask_app.config.get("AFFINITY_WAIT_SEC", affinity_wait_sec)
+        done = asyncio.Event()
+        waiter = await self.call_registry(data.enqueue, llm_name, history_id, user_id, session_of(form), affinity=affinity_wait > 0)
+        waiter.add_done_callback(lambda: loop.call_soon_threadsafe(done.set))
+        try:
+            if waiter.preferred is not None:
+                try:
+                    await asyncio.wait_for(done.wait(), timeout=min(affinity_wait, max_wait))
+                except asyncio.TimeoutError:
+                    await self.call_registry(data.relax, waiter)
+            await asyncio.wait_for(done.wait(), timeout=max(max_wait - (loop.time() - start_time), 0))
+        except asyncio.TimeoutError:
+            pass
+        state = await self.call_registry(data.dequeue, waiter)
+        metrics.schedule_latency_seconds.labels(llm_name).observe(loop.time() - start_time)
+        metrics.schedule_total.labels(llm_name, state).inc()
+        autoscaler.observe(llm_name, state)
+        return state
+
+    async def schedule(self, scope, receive, send):
+        # The asynchronous version of the /worker/schedule route
+        # Parameters: name, history_id, user_id, max_wait (optional), session_id (optional)
+        headers = {k.decode("latin1"): v.decode("latin1") for k, v in scope["headers"]}
+        if not self.is_urlencoded(headers):
+            await self.wsgi_app(scope, receive, send)
+            return
+        form = dict(parse_qsl((await self.read_body(receive)).decode("utf-8"), keep_blank_values=True))
+        llm_name, history_id, user_id = form.get("name"), form.get("history_id"), form.get("user_id")
+        state = await self.wait(form)
+        if state == READY:
+            logger.info(f"Scheduled {llm_name} for {history_id},{user_id}")
+        elif state == "NOMACHINE":
+            logger.warning(f"No machine for {llm_name} has founded, returning NOMACHINE code")
+        else:
+            logger.warning(f"No READY machine for {llm_name}, returning BUSY code")
+        await self.send_response(send, state.encode())
+
+    async def completions(self, scope, receive, send, schedule=False):
+        # Forward SSE stream to the READY state LLM API, If no exist then return empty message
+        # If schedule is True, the job is scheduled first as the /chat/stream route does.
+        # Parameters: name, input, history_id, user_id
+        headers = {k.decode("latin1"): v.decode("latin1") for k, v in scope["headers"]}
+        if not self.is_urlencoded(headers) or not getattr(completions_backend, "bypass", True):
+            # Multipart forms and the safety guard are only supported by the synchronous path.
+            await self.wsgi_app(scope, receive, send)
+            return
+
+        body = await self.read_body(receive)
+        form = dict(parse_qsl(body.decode("utf-8"), keep_blank_values=True))
+        if coalescer.key(form, headers.get("accept-language")) is not None:
+            # The coalesced requests share the stream through the synchronous path
+            await self.wsgi_app(scope, self.replay(body, receive), send)
+            return
+
+        llm_name = form.get("name")
+        if schedule:
+            state = await self.wait(form)
+            if state != READY:
+                await self.send_response(send, state.encode(), status=SCHEDULE_FAILURE_STATUS[state])
+                return
+        dest = data.acquire(llm_name, form.get("history_id"), form.get("user_id"))
+        if dest is None:
+            if schedule:
+                await self.send_response(send, BUSY.encode(), status=SCHEDULE_FAILURE_STATUS[BUSY])
+            else:
+                await self.send_response(send, b"")
+            return
+
+        forward_headers = {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS | {"x-request-id"}}
+        request_id = data.request_id_of(dest)
+        if request_id is not None:
+            forward_headers["X-Request-Id"] = request_id
+        monitor = StreamMonitor(metrics, llm_name, dest[0])
+        try:
+            response = await self.session.post(dest[0], headers=forward_headers, data=body)
+            data.attach(dest, form.get("history_id"), form.get("user_id"), response.headers.get("X-Request-Id"))
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            #POST Failed, remove this LLM until it's healthy again
+            monitor.on_error()
+            prober.trip(dest[0])
+            await self.send_response(send, b"")
+            return
+        except BaseException:
+            # Including the cancellation when the client disconnects meanwhile
+            await self.call_registry(data.release, dest, form.get("history_id"), form.get("user_id"))
+            raise
+
+        disconnected = asyncio.Event()
+        async def watch_disconnect():
+            while (await receive())["type"] != "http.disconnect": pass
+            disconnected.set()
+        watcher = asyncio.create_task(watch_disconnect())
+        try:
+            content_type = response.headers.get("Content-Type", "text/plain")
+            # Event streams are flushed on the frame boundaries
+            aligner = SSEFrameAligner() if is_event_stream(content_type) else None
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", content_type.encode("latin1"))],
+            })
+            async for c in response.content.iter_any():
+                if disconnected.is_set(): break
+                monitor.on_chunk(c)
+                if aligner is not None:
+                    c = aligner.feed(c)
+                    if not c: continue
+                await send({"type": "http.response.body", "body": c, "more_body": True})
+            await send({"type": "http.response.body", "body": aligner.flush() if aligner else b"", "more_body": False})
+        except Exception as e:
+            monitor.on_error()
+            logger.warning(f"Error while streaming from {dest[0]}: {e}")
+        finally:
+            monitor.finish()
+            watcher.cancel()
+            response.release()
+            await self.call_registry(data.release, dest, form.get("history_id"), form.get("user_id"))
+            logger.debug(f"Done streaming from {dest[0]}")
+
+    async def abort(self, scope, receive, send):
+        # The asynchronous version of the /chat/abort route using the shared connection pool
+        # Parameters: history_id (JSON list), user_id
+        headers = {k.decode("latin1"): v.decode("latin1") for k, v in scope["headers"]}
+        if not self.is_urlencoded(headers):
+            await self.wsgi_app(scope, receive, send)
+            return
+        form = dict(parse_qsl((await self.read_body(receive)).decode("utf-8"), keep_blank_values=True))
+        history_id, user_id = form.get("history_id"), form.get("user_id")
+        targets, coalesced = [], []
+        if history_id and user_id:
+            try:
+                history_ids = parse_history_ids(history_id)
+            except ValueError:
+                body = json.dumps({"status": "Failed", "msg": "history_id should be a JSON list"}).encode()
+                await self.send_response(send, body, status=400, content_type=b"application/json")
+                return
+            coalesced, targets = abort_coalesced(history_ids, user_id)
+        jobs = [job for _, job in targets]
+        results = await abort_all(jobs, abort_deadline_sec, self.session) if jobs else {}
+        await self.send_response(send, json.dumps(abort_report(targets, results, coalesced)).encode(), content_type=b"application/json")
+
+    @staticmethod
+    async def send_response(send, body, status=200, content_type=b"text/html; charset=utf-8"):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,184 @@
+import time, logging, threading
+from .variable import *
+from .executor_pool import executor_pool
+from .federation import federation
+
+logger = logging.getLogger(__name__)
+
+class ScalingPolicy:
+    """
+    The autoscaling policy of an access code.
+    A replica is added when the queue of the access code is deeper than
+    target_queue_depth per replica, and a replica started by the autoscaler is
+    retired after it's idle for scale_down_idle_sec seconds.
+    """
+
+    def __init__(self, access_code, executor="huggingface", argv=(), min_replicas=0, max_replicas=1,
+                 target_queue_depth=1, scale_down_idle_sec=300):
+        self.access_code = access_code
+        self.executor = executor
+        self.argv = list(argv)
+        self.min_replicas = int(min_replicas)
+        self.max_replicas = int(max_replicas)
+        self.target_queue_depth = float(target_queue_depth)
+        self.scale_down_idle_sec = float(scale_down_idle_sec)
+        if not access_code:
+            raise ValueError("access_code is required")
+        if self.min_replicas < 0 or self.max_replicas < max(self.min_replicas, 1):
+            raise ValueError("0 <= min_replicas <= max_replicas and max_replicas >= 1 are required")
+        if self.target_queue_depth <= 0:
+            raise ValueError("target_queue_depth should be positive")
+
+    @classmethod
+    def from_dict(cls, policy):
+        try:
+            return cls(**policy)
+        except TypeError as e:
+            raise ValueError(str(e))
+
+    def export(self):
+        return {
+            "access_code": self.access_code,
+            "executor": self.executor,
+            "argv": self.argv,
+            "min_replicas": self.min_replicas,
+            "max_replicas": self.max_replicas,
+            "target_queue_depth": self.target_queue_depth,
+            "scale_down_idle_sec": self.scale_down_idle_sec,
+        }
+
+class Autoscaler:
+    """
+    Spawn and retire the executors of the access codes with a policy from the
+    scheduling state, evaluated periodically. At most one replica is added
+    while another is still loading, since loading a model takes a while.
+    The replicas registered by others are counted but never retired.
+    """
+
+    def __init__(self, registry, pool, store, kernel_url=None):
+        self.registry = registry
+        self.pool = pool
+        self.store = store
+        self.kernel_url = kernel_url
+        self.policies = {}  # access_code -> ScalingPolicy
+        self.replicas = {}  # access_code -> [StartJob]
+        self.idle_since = {}  # (access_code, endpoint) -> timestamp
+        self.demand = set()  # Access codes requested without any machine since the last evaluation
+        self.lock = threading.RLock()
+
+    def load(self):
+        for access_code, policy in self.store.load_policies().items():
+            try:
+                self.policies[access_code] = ScalingPolicy.from_dict(policy)
+            except ValueError as e:
+                logger.warning(f"Ignored the invalid autoscaling policy of {access_code}: {e}")
+
+    def set_policy(self, policy):
+        with self.lock:
+            self.policies[policy.access_code] = policy
+        self.store.save_policy(policy.access_code, policy.export())
+        logger.info(f"Autoscaling policy of {policy.access_code} is set: {policy.export()}")
+
+    def remove_policy(self, access_code):
+        """
+        Remove the policy, the running replicas are left as is.
+        """
+        with self.lock:
+            if self.policies.pop(access_code, None) is None: return False
+            self.replicas.pop(access_code, None)
+        self.store.remove_policy(access_code)
+        return True
+
+    def observe(self, access_code, state):
+        """
+        Record the result of a scheduling request, so that an access code
+        without any replica can be scaled up from zero.
+        """
+        if state == "NOMACHINE" and access_code in self.policies:
+            self.demand.add(access_code)
+
+    def status(self):
+        with self.lock:
+            return {
+                access_code: {
+                    "policy": policy.export(),
+                    "replicas": [i.export() for i in self.replicas.get(access_code, [])],
+                }
+                for access_code, policy in self.policies.items()
+            }
+
+    def evaluate(self):
+        """
+        The cronjob to scale the access codes.
+        """
+        with self.lock:
+            for policy in list(self.policies.values()):
+                try:
+                    self._scale(policy)
+                except Exception:
+                    logger.exception(f"Failed to scale {policy.access_code}")
+
+    def _scale(self, policy):
+        access_code = policy.access_code
+        jobs = [i for i in self.replicas.get(access_code, []) if i.state in ("starting", "loading", "ready")]
+        self.replicas[access_code] = jobs
+        pending = [i for i in jobs if i.state != "ready"]
+        endpoints = list(self.registry.registrations().get(access_code, {}).keys())
+        free, total, queued = self.registry.slot_counts().get(access_code, (0, 0, 0))
+        # The managed replicas quarantined by the health prober are still counted
+        replicas = len(set(endpoints) | {i.endpoint for i in jobs if i.state == "ready"}) + len(pending)
+        demand = access_code in self.demand
+        self.demand.discard(access_code)
+
+        if replicas < policy.min_replicas:
+            for _ in range(policy.min_replicas - replicas):
+                self._start(policy, reason="below min_replicas")
+            return
+        if replicas < policy.max_replicas and not pending:
+            if not endpoints and demand:
+                self._start(policy, reason="requested without any replica")
+                return
+            if endpoints and queued > policy.target_queue_depth * len(endpoints):
+                self._start(policy, reason=f"{queued} jobs queued for {len(endpoints)} replicas")
+                return
+
+        # Retire at most one idle replica started by the autoscaler
+        now = time.time()
+        managed = {i.endpoint: i for i in jobs if i.state == "ready"}
+        for endpoint, job in managed.items():
+            key = (access_code, endpoint)
+            inflight, capacity = self.registry.load_of(access_code, endpoint)
+            if inflight > 0 or capacity == 0:
+                self.idle_since.pop(key, None)
+                continue
+            idle_since = self.idle_since.setdefault(key, now)
+            if replicas > policy.min_replicas and not pending and queued == 0 \
+                    and now - idle_since >= policy.scale_down_idle_sec:
+                if self._retire(access_code, endpoint, job):
+                    break
+
+    def _start(self, policy, reason):
+        argv = [*policy.argv]
+        if "--access_code" not in argv:
+            argv.extend(["--access_code", policy.access_code])
+        if self.kernel_url and "--kernel_url" not in argv:
+            argv.extend(["--kernel_url", self.kernel_url])
+        job = self.pool.start(policy.access_code, argv, executor=policy.executor)
+        self.replicas.setdefault(policy.access_code, []).append(job)
+        logger.info(f"Scaling up {policy.access_code}: {reason}, started job {job.id}")
+
+    def _retire(self, access_code, endpoint, job):
+        # Stop routing to the replica first, so that no job is lost
+        with self.registry.lock:
+            if self.registry.load_of(access_code, endpoint)[0] > 0: return False
+            self.registry.unregister(access_code, lambda i: i == endpoint)
+        self.store.remove(access_code, endpoint)
+        federation.unregister(access_code, endpoint)
+        self.idle_since.pop((access_code, endpoint), None)
+        self.replicas[access_code].remove(job)
+        if job.process is not None:
+            job.process.terminate()
+        logger.info(f"Scaling down {access_code}: retired the idle replica at {endpoint}")
+        return True
+
+autoscaler = Autoscaler(data, executor_pool, store)
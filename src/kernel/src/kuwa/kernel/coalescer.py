@@ -0,0 +1,343 @@
+import json, hashlib, logging, threading
+from collections import deque
+from .variable import *
+
+logger = logging.getLogger(__name__)
+
+# The generation parameters that randomize the output, matched by the suffix of
+# the Modelfile parameter names, e.g. "llm_temperature"
+SAMPLING_PARAMETERS = ("temperature", "top_p", "top_k", "min_p", "typical_p", "do_sample", "seed")
+
+def parse_parameters(modelfile):
+    """
+    Return the PARAMETER commands of the Modelfile in JSON as {name: value}.
+    """
+    parameters = {}
+    for command in modelfile:
+        if not isinstance(command, dict) or command.get("name") not in ("parameter", "kuwaparam"):
+            continue
+        key, _, value = str(command.get("args", "")).split("#", 1)[0].strip().partition(" ")
+        value = value.strip().strip("'\"")
+        if value.lower() in ("true", "false"):
+            value = value.lower() == "true"
+        else:
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        parameters[key.strip().strip("'\"").lower()] = value
+    return parameters
+
+def is_deterministic(parameters):
+    """
+    Whether the parameters keep the greedy decoding of an access code that
+    is deterministic by default.
+    """
+    sampling = {
+        name: value for name, value in parameters.items()
+        for i in SAMPLING_PARAMETERS if name.endswith(i)
+    }
+    if any(name.endswith("do_sample") and value is False for name, value in sampling.items()):
+        return True
+    if any(name.endswith("temperature") and value == 0 for name, value in sampling.items()):
+        return True
+    return not sampling
+
+class Flight:
+    """
+    An upstream stream shared by the identical requests in flight. The leader
+    streams it to its own client while buffering the chunks, which the
+    followers replay from the start. Once the buffer exceeds max_buffer_bytes
+    no more followers can join, and the chunks consumed by all the followers
+    are dropped. If the leader leaves, e.g. it's aborted, the upstream is
+    drained for the followers, and it's closed once no follower remains.
+    """
+
+    def __init__(self, key, max_buffer_bytes, on_close):
+        self.key = key
+        self.max_buffer_bytes = max_buffer_bytes
+        self.on_close = on_close
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.base = 0  # The position of chunks[0] in the stream
+        self.size = 0
+        self.started = False
+        self.headers = None  # None if the result is the bare stream
+        self.failed = False
+        self.done = False
+        self.joinable = True
+        self.cursors = {}  # follower -> position in the stream
+        self.next_follower = 0
+        self.jobs = {}  # (history_id, user_id) -> follower, None for the leader
+        self.detached = False  # Whether the leader was aborted
+
+    def join(self):
+        """
+        Return the follower token, None if the flight can't be joined.
+        """
+        with self.cond:
+            if not self.joinable: return None
+            token, self.next_follower = self.next_follower, self.next_follower + 1
+            self.cursors[token] = 0
+            return token
+
+    def follow(self, token):
+        """
+        Wait for the response of the leader and return the stream to replay in
+        the same form, or None if the leader failed to start the stream.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.started or self.failed)
+            if self.failed:
+                self.cursors.pop(token, None)
+                return None
+            stream = Replay(self, token)
+            return stream if self.headers is None else (stream, self.headers)
+
+    def _next(self, token):
+        with self.cond:
+            self.cond.wait_for(lambda: token not in self.cursors or self.cursors[token] < self.base + len(self.chunks) or self.done)
+            if token not in self.cursors:
+                # The follower was aborted
+                return []
+            pending = self.chunks[self.cursors[token] - self.base:]
+            self.cursors[token] += len(pending)
+            self._trim()
+            return pending
+
+    def _leave(self, token):
+        with self.cond:
+            if self.cursors.pop(token, None) is not None:
+                self._trim()
+                self.cond.notify_all()
+
+    def abort(self, job):
+        """
+        Stop streaming to the job without cancelling the upstream shared with
+        the others. Return False if the job isn't in the flight or it's the
+        only one left, in which case the upstream should be aborted instead.
+        """
+        with self.cond:
+            if job not in self.jobs:
+                return False
+            token = self.jobs[job]
+            if token is not None:
+                self._leave(token)
+                return True
+            if not self.cursors:
+                # No follower can join a stream about to be aborted
+                self.joinable = False
+                return False
+            self.detached = True
+            return True
+
+    def _trim(self):
+        if self.joinable: return
+        position = min(self.cursors.values(), default=self.base + len(self.chunks))
+        if position > self.base:
+            dropped = self.chunks[:position - self.base]
+            del self.chunks[:position - self.base]
+            self.base = position
+            self.size -= sum(len(c) for c in dropped)
+
+    def lead(self, result):
+        """
+        Share the result of completions_backend() with the followers and
+        return the stream for the leader.
+        """
+        if isinstance(result, tuple) and len(result) == 2:
+            stream, headers = result
+        elif hasattr(result, "__next__"):
+            stream, headers = result, None
+        else:
+            self.fail()
+            return result
+        with self.cond:
+            self.started, self.headers = True, headers
+            self.cond.notify_all()
+        stream = self._relay(stream)
+        return stream if headers is None else (stream, headers)
+
+    def _relay(self, stream):
+        handed_off = False
+        try:
+            for c in stream:
+                self._append(c)
+                if self.detached: break
+                yield c
+            else:
+                return
+            handed_off = self._hand_off(stream)
+        except GeneratorExit:
+            handed_off = self._hand_off(stream)
+            raise
+        finally:
+            if not handed_off:
+                self._finish(stream)
+
+    def _hand_off(self, stream):
+        """
+        Keep streaming for the followers after the leader left.
+        """
+        with self.cond:
+            if not self.cursors: return False
+        threading.Thread(target=self._drain, args=(stream,), daemon=True).start()
+        return True
+
+    def _drain(self, stream):
+        try:
+            for c in stream:
+                self._append(c)
+                with self.cond:
+                    if not self.cursors:
+                        # Every follower left, close the upstream
+                        self.joinable = False
+                        break
+        except Exception as e:
+            logger.warning(f"Failed to stream to the followers: {e}")
+        finally:
+            self._finish(stream)
+
+    def _append(self, c):
+        close = False
+        with self.cond:
+            self.chunks.append(c)
+            self.size += len(c)
+            if self.joinable and self.size > self.max_buffer_bytes:
+                self.joinable, close = False, True
+                self._trim()
+            self.cond.notify_all()
+        if close: self.on_close(self)
+
+    def _finish(self, stream):
+        close = getattr(stream, "close", None)
+        if close is not None: close()
+        with self.cond:
+            self.done, self.joinable = True, False
+            self._trim()
+            self.cond.notify_all()
+        self.on_close(self)
+
+    def fail(self):
+        with self.cond:
+            self.failed, self.done, self.joinable = True, True, False
+            self.chunks.clear()
+            self.cond.notify_all()
+        self.on_close(self)
+
+class Replay:
+    """
+    The stream of a follower, which leaves the flight once it's exhausted or
+    closed, even if it has never been iterated.
+    """
+
+    def __init__(self, flight, token):
+        self.flight = flight
+        self.token = token
+        self.pending = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self.pending:
+            if self.token is None: raise StopIteration
+            self.pending = deque(self.flight._next(self.token))
+            if not self.pending: self.close()
+        return self.pending.popleft()
+
+    def close(self):
+        if self.token is not None:
+            self.flight._leave(self.token)
+            self.token = None
+
+class Coalescer:
+    """
+    The single-flight layer of the chat completions. The identical requests
+    to an access code that is deterministic by default are served by a single
+    upstream stream, which is keyed on the access code, the normalized chat
+    history, the Modelfile and the language. Requests overriding the sampling
+    parameters are not coalesced. It's opt-in, no access code is coalesced by
+    default.
+    """
+
+    def __init__(self, access_codes=(), max_buffer_bytes=4 * 2**20):
+        self.access_codes = set(access_codes)
+        self.max_buffer_bytes = max_buffer_bytes
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.jobs = {}  # (history_id, user_id) -> the flight serving the job
+
+    def key(self, form, language=None):
+        """
+        Return the coalescing key of the request form, None if it shouldn't be coalesced.
+        """
+        access_code = form.get("name")
+        if access_code not in self.access_codes:
+            return None
+        try:
+            history = json.loads(form.get("input") or "[]")
+            history = [[bool(r.get("isbot")), (r.get("msg") or "").strip()] for r in history]
+            modelfile = json.loads(form.get("modelfile") or "[]") or []
+            if not is_deterministic(parse_parameters(modelfile)):
+                return None
+        except (ValueError, TypeError, AttributeError):
+            return None
+        normalized = json.dumps([access_code, history, modelfile, language], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def flight(self, key, job=None):
+        """
+        Return the (flight, token) to follow the identical request in flight,
+        or (flight, None) to lead a new one. The job, (history_id, user_id),
+        can be aborted by abort() then.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            token = flight.join() if flight is not None else None
+            if token is None:
+                flight = Flight(key, self.max_buffer_bytes, self._close)
+                self.flights[key] = flight
+            self._track(job, flight, token)
+            return flight, token
+
+    def follow(self, key, job=None):
+        """
+        Return the stream of the identical request in flight, None if there
+        is none or it failed.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            token = flight.join() if flight is not None else None
+            if token is not None:
+                self._track(job, flight, token)
+        return flight.follow(token) if token is not None else None
+
+    def _track(self, job, flight, token):
+        if job is None: return
+        with flight.cond:
+            if flight.done: return
+            flight.jobs[job] = token
+        self.jobs[job] = flight
+
+    def abort(self, job):
+        """
+        Abort the coalesced job, (history_id, user_id), without cancelling the
+        stream shared with the other jobs. Return False if the job isn't
+        coalesced or no other job shares its stream, in which case it should
+        be aborted on the executor.
+        """
+        with self.lock:
+            flight = self.jobs.get(job)
+        return flight is not None and flight.abort(job)
+
+    def _close(self, flight):
+        with self.lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+            if flight.done:
+                for job in flight.jobs:
+                    if self.jobs.get(job) is flight:
+                        del self.jobs[job]
+
+coalescer = Coalescer(max_buffer_bytes=coalesce_max_buffer_bytes)
@@ -0,0 +1,343 @@
+import os, time, json, shutil, hashlib, logging, threading, requests
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+class DownloadAborted(Exception):
+    pass
+
+class ChecksumError(Exception):
+    pass
+
+class RangeNotSupported(Exception):
+    pass
+
+class BandwidthLimiter:
+    """
+    A token bucket shared by the download workers to cap the total bandwidth.
+    """
+
+    def __init__(self, max_bytes_per_sec=None):
+        self.rate = max_bytes_per_sec
+        self.tokens = 0
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        if not self.rate: return
+        with self.lock:
+            now = time.monotonic()
+            # Allow a burst of at most one second
+            self.tokens = min(self.tokens + (now - self.last_time) * self.rate, self.rate)
+            self.last_time = now
+            self.tokens -= n
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+class RepoFile:
+    """
+    A file of a model repository and its checksum. The blob of a LFS file is
+    named by its SHA-256, and the others by their git blob SHA-1, as the
+    Hugging Face cache does.
+    """
+
+    def __init__(self, sibling):
+        self.filename = sibling["rfilename"]
+        lfs = sibling.get("lfs")
+        if lfs:
+            self.etag, self.size, self.algorithm = lfs["sha256"], lfs["size"], "sha256"
+        else:
+            self.etag, self.size, self.algorithm = sibling.get("blobId"), sibling.get("size"), "git-sha1"
+
+    def hasher(self):
+        if self.algorithm == "sha256":
+            return hashlib.sha256()
+        hasher = hashlib.sha1()
+        hasher.update(f"blob {self.size}\0".encode())
+        return hasher
+
+class ModelDownloader:
+    """
+    Download a model repository from the Hugging Face Hub into the local cache
+    with the same layout as huggingface-cli, so that the executors can load it.
+    Files are downloaded concurrently into "<blob>.incomplete" files which are
+    resumed with range requests after an abort or a crash, and each blob is
+    verified against its checksum before being moved into place.
+    A file larger than segment_size is fetched in segments of that size by
+    up to segment_workers concurrent range requests, each into its own
+    "<blob>.incomplete.<n>" file resumed separately, and the segments are
+    joined after all of them are complete.
+    The progress is reported to on_event as dictionaries.
+    """
+
+    def __init__(self, cache_dir, endpoint=None, token=None, max_workers=4,
+                 max_bytes_per_sec=None, chunk_size=1024*1024, timeout=30, progress_interval_sec=0.5,
+                 segment_size=64*1024*1024, segment_workers=4):
+        self.cache_dir = cache_dir
+        self.endpoint = (endpoint or os.environ.get("HF_ENDPOINT", "https://huggingface.co")).rstrip("/")
+        self.token = token if token is not None else self.default_token()
+        self.max_workers = max_workers
+        self.limiter = BandwidthLimiter(max_bytes_per_sec)
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.progress_interval_sec = progress_interval_sec
+        self.segment_size = segment_size
+        self.segment_workers = segment_workers
+
+    @staticmethod
+    def default_token():
+        if os.environ.get("HF_TOKEN"):
+            return os.environ["HF_TOKEN"]
+        hf_home = os.environ.get("HF_HOME", os.path.join(os.path.expanduser("~"), ".cache", "huggingface"))
+        try:
+            with open(os.path.join(hf_home, "token")) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def headers(self):
+        return {"Authorization": f"Bearer {self.token}"} if self.token else {}
+
+    def repo_dir(self, repo_id):
+        return os.path.join(self.cache_dir, "models--" + repo_id.replace("/", "--"))
+
+    def download(self, repo_id, revision="main", stop_event=None, on_event=None):
+        """
+        Download the repository and return the path of the snapshot.
+        Raise DownloadAborted if stop_event is set, and the partial blobs are kept.
+        """
+        stop_event = stop_event or threading.Event()
+        on_event = on_event or (lambda event: None)
+
+        resp = requests.get(
+            f"{self.endpoint}/api/models/{repo_id}/revision/{revision}",
+            params={"blobs": "true"}, headers=self.headers(), timeout=self.timeout
+        )
+        resp.raise_for_status()
+        info = resp.json()
+        commit = info["sha"]
+        files = [RepoFile(i) for i in info.get("siblings", [])]
+
+        repo_dir = self.repo_dir(repo_id)
+        blobs_dir = os.path.join(repo_dir, "blobs")
+        snapshot_dir = os.path.join(repo_dir, "snapshots", commit)
+        os.makedirs(blobs_dir, exist_ok=True)
+        os.makedirs(os.path.join(repo_dir, "refs"), exist_ok=True)
+        if revision != commit:
+            with open(os.path.join(repo_dir, "refs", revision), "w") as f:
+                f.write(commit)
+
+        progress = {"downloaded": 0, "total": sum(i.size or 0 for i in files), "last_report": 0}
+        lock = threading.Lock()
+        start_time = time.monotonic()
+
+        def report(n, force=False):
+            with lock:
+                progress["downloaded"] += n
+                now = time.monotonic()
+                if not force and now - progress["last_report"] < self.progress_interval_sec: return
+                progress["last_report"] = now
+                event = {
+                    "event": "progress",
+                    "model_name": repo_id,
+                    "downloaded_bytes": progress["downloaded"],
+                    "total_bytes": progress["total"],
+                    "bytes_per_sec": progress["downloaded"] / max(now - start_time, 1e-6),
+                }
+            on_event(event)
+
+        on_event({"event": "start", "model_name": repo_id, "revision": commit, "files": len(files), "total_bytes": progress["total"]})
+        # The files sharing a blob are handled by the same worker, so that the
+        # blob is fetched once instead of into the same file concurrently
+        groups = {}
+        for file in files:
+            groups.setdefault(file.etag or ("", file.filename), []).append(file)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [
+                pool.submit(self._download_files, repo_id, commit, group, blobs_dir, snapshot_dir, stop_event, report, on_event)
+                for group in groups.values()
+            ]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Stop the other workers and keep the partial blobs for resuming
+                stop_event.set()
+                raise
+        report(0, force=True)
+        on_event({"event": "complete", "model_name": repo_id, "path": snapshot_dir})
+        return snapshot_dir
+
+    def _download_files(self, repo_id, commit, files, blobs_dir, snapshot_dir, stop_event, report, on_event):
+        for file in files:
+            self._download_file(repo_id, commit, file, blobs_dir, snapshot_dir, stop_event, report, on_event)
+
+    def _download_file(self, repo_id, commit, file, blobs_dir, snapshot_dir, stop_event, report, on_event):
+        snapshot_path = os.path.join(snapshot_dir, file.filename)
+        blob_path = os.path.join(blobs_dir, file.etag) if file.etag else snapshot_path
+        if os.path.exists(snapshot_path) and os.path.getsize(snapshot_path) == file.size:
+            report(file.size)
+            return
+        if stop_event.is_set():
+            raise DownloadAborted()
+
+        # The blob is fetched into the snapshot directly if it has no checksum
+        os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+        if not os.path.exists(blob_path) or os.path.getsize(blob_path) != file.size:
+            url = f"{self.endpoint}/{repo_id}/resolve/{commit}/{file.filename}"
+            if self._is_segmented(file, blob_path):
+                self._fetch_segmented(url, file, blob_path, stop_event, report)
+            else:
+                self._fetch_blob(url, file, blob_path, stop_event, report)
+        else:
+            report(file.size)
+
+        if blob_path != snapshot_path:
+            if os.path.lexists(snapshot_path): os.remove(snapshot_path)
+            try:
+                os.symlink(os.path.relpath(blob_path, os.path.dirname(snapshot_path)), snapshot_path)
+            except OSError:
+                # Symbolic links are not available, e.g. on Windows without developer mode
+                shutil.move(blob_path, snapshot_path)
+        on_event({"event": "file_complete", "model_name": repo_id, "filename": file.filename, "size": file.size})
+
+    def _fetch_blob(self, url, file, blob_path, stop_event, report):
+        incomplete_path = blob_path + ".incomplete"
+        offset = os.path.getsize(incomplete_path) if os.path.exists(incomplete_path) else 0
+        if file.size is not None and offset > file.size:
+            offset = 0
+        hasher = file.hasher() if file.etag else None
+        if offset > 0 and hasher is not None:
+            with open(incomplete_path, "rb") as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                    hasher.update(chunk)
+
+        report(offset)
+        headers = self.headers()
+        if offset > 0:
+            headers["Range"] = f"bytes={offset}-"
+            logger.info(f"Resuming {file.filename} from byte {offset}")
+        with requests.get(url, headers=headers, stream=True, timeout=self.timeout) as resp:
+            if resp.status_code == 416 and offset == file.size:
+                pass  # The partial blob is already complete
+            else:
+                resp.raise_for_status()
+                if offset > 0 and resp.status_code != 206:
+                    # The server ignored the range, start over
+                    report(-offset)
+                    offset = 0
+                    hasher = file.hasher() if file.etag else None
+                with open(incomplete_path, "ab" if offset > 0 else "wb") as f:
+                    for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                        if stop_event.is_set():
+                            raise DownloadAborted()
+                        self.limiter.consume(len(chunk))
+                        f.write(chunk)
+                        if hasher is not None: hasher.update(chunk)
+                        report(len(chunk))
+
+        if hasher is not None and hasher.hexdigest() != file.etag:
+            os.remove(incomplete_path)
+            raise ChecksumError(f"Checksum mismatch of {file.filename}")
+        os.replace(incomplete_path, blob_path)
+
+    def _is_segmented(self, file, blob_path):
+        """
+        Whether to fetch the blob in segments. A blob partially fetched in a
+        single stream, e.g. by the previous versions, is resumed as is.
+        """
+        return (
+            file.etag is not None and file.size is not None and file.size > self.segment_size
+            and self.segment_workers > 1 and not os.path.exists(blob_path + ".incomplete")
+        )
+
+    def _fetch_segmented(self, url, file, blob_path, stop_event, report):
+        segments = [
+            (f"{blob_path}.incomplete.{n}", start, min(start + self.segment_size, file.size))
+            for n, start in enumerate(range(0, file.size, self.segment_size))
+        ]
+        failed = threading.Event()
+        with ThreadPoolExecutor(max_workers=self.segment_workers) as pool:
+            futures = [
+                pool.submit(self._fetch_segment, url, file, part_path, start, end, (stop_event, failed), report)
+                for part_path, start, end in segments
+            ]
+            try:
+                for future in futures:
+                    future.result()
+            except RangeNotSupported:
+                failed.set()
+            except BaseException:
+                # Stop the other segments and keep them for resuming
+                failed.set()
+                raise
+        if failed.is_set():
+            logger.info(f"Range requests are not supported for {file.filename}, fetching it in a single stream")
+            for part_path, start, end in segments:
+                if os.path.exists(part_path):
+                    report(-os.path.getsize(part_path))
+                    os.remove(part_path)
+            self._fetch_blob(url, file, blob_path, stop_event, report)
+            return
+
+        joined_path = blob_path + ".incomplete.joined"
+        hasher = file.hasher()
+        with open(joined_path, "wb") as out:
+            for part_path, start, end in segments:
+                with open(part_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                        hasher.update(chunk)
+                        out.write(chunk)
+        for part_path, start, end in segments:
+            os.remove(part_path)
+        if hasher.hexdigest() != file.etag:
+            os.remove(joined_path)
+            raise ChecksumError(f"Checksum mismatch of {file.filename}")
+        os.replace(joined_path, blob_path)
+
+    def _fetch_segment(self, url, file, part_path, start, end, stop_events, report):
+        """
+        Fetch the bytes [start, end) of the file into part_path, resuming from its size.
+        """
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset > end - start:
+            offset = 0
+        report(offset)
+        if offset == end - start:
+            return
+        headers = self.headers()
+        headers["Range"] = f"bytes={start + offset}-{end - 1}"
+        with requests.get(url, headers=headers, stream=True, timeout=self.timeout) as resp:
+            resp.raise_for_status()
+            if resp.status_code != 206:
+                raise RangeNotSupported()
+            with open(part_path, "ab" if offset > 0 else "wb") as f:
+                for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                    if any(i.is_set() for i in stop_events):
+                        raise DownloadAborted()
+                    self.limiter.consume(len(chunk))
+                    f.write(chunk)
+                    report(len(chunk))
+        if os.path.getsize(part_path) != end - start:
+            raise OSError(f"The segment {start}-{end} of {file.filename} ended early")
+
+def format_event(event):
+    """
+    Format the event as a human-readable line.
+    """
+    kind = event["event"]
+    if kind == "start":
+        return f"Downloading {event['files']} files ({event['total_bytes']/2**20:.1f} MiB) of {event['model_name']}@{event['revision']}"
+    elif kind == "progress":
+        percent = 100 * event["downloaded_bytes"] / event["total_bytes"] if event["total_bytes"] else 100
+        return f"{percent:.1f}% ({event['downloaded_bytes']/2**20:.1f}/{event['total_bytes']/2**20:.1f} MiB, {event['bytes_per_sec']/2**20:.1f} MiB/s)"
+    elif kind == "file_complete":
+        return f"Downloaded {event['filename']}"
+    elif kind == "evicted":
+        return f"Evicted {', '.join(event['folders'])} from the model cache"
+    elif kind == "complete":
+        return f"Model downloaded and cached at: {event['path']}"
+    elif kind == "error":
+        return f"Error: {event['msg']}"
+    return json.dumps(event)
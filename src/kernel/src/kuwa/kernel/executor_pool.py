@@ -0,0 +1,214 @@
+import json, time, uuid, logging, threading, subprocess
+from collections import deque, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Printed by "kuwa-executor warm" once the executor class is imported
+WARM_READY_LINE = "KUWA_WARM_EXECUTOR_READY"
+
+class StartJob:
+    """
+    A model start request. The job is "starting" until a process is assigned,
+    "loading" until the executor registers itself to the kernel, and then
+    "ready". It's "failed" if the process exits before being ready, and
+    "exited" if it exits afterwards.
+    """
+    TERMINAL_STATES = ("ready", "failed", "exited")
+
+    def __init__(self, access_code, argv, executor):
+        self.id = uuid.uuid4().hex
+        self.access_code = access_code
+        self.argv = argv
+        self.executor = executor
+        self.state = "starting"
+        self.created_at = time.time()
+        self.process = None
+        self.endpoint = None
+        self.events = []
+        self.cond = threading.Condition()
+
+    def emit(self, state, **kwargs):
+        with self.cond:
+            self.state = state
+            self.events.append({"event": state, "job_id": self.id, "timestamp": time.time(), **kwargs})
+            self.cond.notify_all()
+        logger.info(f"Start job {self.id} of {self.access_code}: {state} {kwargs}")
+
+    def wait_events(self, since, timeout):
+        """
+        Return the events after the index since, waiting at most timeout seconds for new ones.
+        """
+        with self.cond:
+            if len(self.events) <= since:
+                self.cond.wait(timeout)
+            return self.events[since:]
+
+    def export(self):
+        with self.cond:
+            return {
+                "job_id": self.id,
+                "access_code": self.access_code,
+                "executor": self.executor,
+                "state": self.state,
+                "endpoint": self.endpoint,
+                "created_at": self.created_at,
+                "pid": self.process.pid if self.process else None,
+                "events": list(self.events),
+            }
+
+class ExecutorProcess:
+    """
+    An executor process whose output is drained by a thread, so that it never
+    blocks on a full pipe. The last lines are kept for the error report.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.ready = threading.Event()
+        self.output = deque(maxlen=20)
+        self.process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            text=True, bufsize=1, start_new_session=True
+        )
+        self.pid = self.process.pid
+        self.reader = threading.Thread(target=self._drain, daemon=True)
+        self.reader.start()
+
+    def _drain(self):
+        for line in iter(self.process.stdout.readline, ""):
+            line = line.rstrip()
+            if line == WARM_READY_LINE:
+                self.ready.set()
+                continue
+            self.output.append(line)
+            logger.debug(f"[executor {self.pid}] {line}")
+        self.process.stdout.close()
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def assign(self, argv):
+        self.process.stdin.write(json.dumps({"argv": argv}) + "\n")
+        self.process.stdin.close()
+
+    def terminate(self):
+        if self.alive():
+            self.process.terminate()
+
+class ExecutorPool:
+    """
+    A pool of pre-spawned executor processes that have imported the executor
+    class and wait for the model to serve, so that starting a model only pays
+    for loading the weights. A process is assigned to each start job, or a
+    cold process is spawned if no warm one is ready, and the pool is refilled
+    in the background. The jobs become ready when the executor registers.
+    """
+
+    def __init__(self, size=0, executor="huggingface", command=("kuwa-executor",), max_jobs=100):
+        self.size = size
+        self.executor = executor
+        self.command = list(command)
+        self.max_jobs = max_jobs
+        self.idle = []  # [ExecutorProcess]
+        self.jobs = OrderedDict()  # job_id -> StartJob
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def warm_command(self):
+        return [*self.command, "warm", "--executor", self.executor]
+
+    def cold_command(self, executor, argv):
+        return [*self.command, executor, *argv]
+
+    def fill(self):
+        """
+        Spawn warm processes until the pool is full.
+        """
+        with self.lock:
+            if self.closed: return
+            self.idle = [i for i in self.idle if i.alive()]
+            missing = self.size - len(self.idle)
+            for _ in range(missing):
+                try:
+                    self.idle.append(ExecutorProcess(self.warm_command()))
+                except OSError as e:
+                    logger.warning(f"Failed to spawn a warm executor: {e}")
+                    break
+        if missing > 0:
+            logger.info(f"Spawned {missing} warm executors")
+
+    def _take(self):
+        # Prefer the processes that have finished importing
+        with self.lock:
+            self.idle = [i for i in self.idle if i.alive()]
+            if not self.idle: return None
+            ready = [i for i in self.idle if i.ready.is_set()]
+            process = (ready or self.idle)[0]
+            self.idle.remove(process)
+            return process
+
+    def start(self, access_code, argv, executor=None):
+        """
+        Start an executor with the arguments and return the job immediately.
+        Only the executors of the pool's type can be served by a warm process.
+        """
+        job = StartJob(access_code, argv, executor or self.executor)
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+        threading.Thread(target=self._run, args=(job,), daemon=True).start()
+        return job
+
+    def _run(self, job):
+        process = self._take() if job.executor == self.executor else None
+        try:
+            if process is not None:
+                process.assign(job.argv)
+                job.process = process
+                job.emit("loading", warm=True, pid=process.pid)
+            else:
+                process = ExecutorProcess(self.cold_command(job.executor, job.argv))
+                process.process.stdin.close()
+                job.process = process
+                job.emit("loading", warm=False, pid=process.pid)
+        except OSError as e:
+            job.emit("failed", msg=str(e))
+            return
+        finally:
+            threading.Thread(target=self.fill, daemon=True).start()
+
+        returncode = process.process.wait()
+        process.reader.join(timeout=1)
+        if job.state != "ready":
+            job.emit("failed", returncode=returncode, output=list(process.output))
+        else:
+            job.emit("exited", returncode=returncode)
+
+    def on_register(self, access_code, endpoint):
+        """
+        Mark the oldest loading job of the access code as ready.
+        """
+        with self.lock:
+            job = next((i for i in self.jobs.values() if i.access_code == access_code and i.state == "loading"), None)
+            if job is None: return
+            job.endpoint = endpoint
+        job.emit("ready", endpoint=endpoint)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def shutdown(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for process in idle:
+            # The idle processes exit when their stdin is closed
+            try:
+                process.process.stdin.close()
+            except OSError:
+                pass
+            process.terminate()
+
+executor_pool = ExecutorPool()
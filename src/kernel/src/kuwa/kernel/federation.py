@@ -0,0 +1,272 @@
+import json, time, logging, threading
+from .variable import *
+
+logger = logging.getLogger(__name__)
+
+def job_id(history_id, user_id):
+    return json.dumps([str(history_id), str(user_id)])
+
+class LocalBackend:
+    """
+    An in-process shared registry, standing in for Redis in the tests and
+    when several kernels are federated in a single process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._registrations = {}  # (access_code, endpoint) -> capacity
+        self._leases = {}  # (access_code, endpoint) -> {job: expiry}
+        self._version = 0
+
+    def register(self, access_code, endpoint, capacity):
+        with self.lock:
+            self._registrations[(access_code, endpoint)] = capacity
+            self._version += 1
+
+    def unregister(self, access_code, endpoint):
+        with self.lock:
+            self._registrations.pop((access_code, endpoint), None)
+            self._leases.pop((access_code, endpoint), None)
+            self._version += 1
+
+    def version(self):
+        with self.lock:
+            return self._version
+
+    def registrations(self):
+        with self.lock:
+            return dict(self._registrations)
+
+    def claim(self, access_code, endpoint, capacity, job, ttl):
+        with self.lock:
+            now = time.monotonic()
+            leases = self._leases.setdefault((access_code, endpoint), {})
+            for i in [i for i, expiry in leases.items() if expiry <= now]:
+                del leases[i]
+            if job not in leases and len(leases) >= capacity:
+                return False
+            leases[job] = now + ttl
+            return True
+
+    def release(self, access_code, endpoint, job):
+        with self.lock:
+            self._leases.get((access_code, endpoint), {}).pop(job, None)
+
+    def renew(self, leases, ttl):
+        with self.lock:
+            expiry = time.monotonic() + ttl
+            for access_code, endpoint, job in leases:
+                jobs = self._leases.get((access_code, endpoint), {})
+                if job in jobs:
+                    jobs[job] = expiry
+
+class RedisBackend:
+    """
+    The shared registry on Redis. The registrations are a hash bumping a
+    version counter on every change, and the leases of each endpoint are a
+    sorted set scored by their expiry, which is claimed atomically by a script
+    on the clock of the Redis server.
+    """
+
+    CLAIM_SCRIPT = """
+        local now = redis.call('TIME')
+        now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+        local ttl = tonumber(ARGV[3])
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+        if redis.call('ZSCORE', KEYS[1], ARGV[2]) or redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[1]) then
+            redis.call('ZADD', KEYS[1], now + ttl, ARGV[2])
+            redis.call('EXPIRE', KEYS[1], math.ceil(ttl))
+            return 1
+        end
+        return 0
+    """
+
+    RENEW_SCRIPT = """
+        local now = redis.call('TIME')
+        now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+        local ttl = tonumber(ARGV[2])
+        if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+            redis.call('ZADD', KEYS[1], 'XX', now + ttl, ARGV[1])
+            redis.call('EXPIRE', KEYS[1], math.ceil(ttl))
+            return 1
+        end
+        return 0
+    """
+
+    def __init__(self, client, namespace="kuwa:federation"):
+        self.client = client
+        self.namespace = namespace
+        self.claim_script = client.register_script(self.CLAIM_SCRIPT)
+        self.renew_script = client.register_script(self.RENEW_SCRIPT)
+
+    @classmethod
+    def from_url(cls, url, timeout=1.0, **kwargs):
+        """
+        Connect to the Redis of the URL. A stalled Redis fails the calls within
+        timeout seconds, so that the kernel falls back to its local view.
+        """
+        import redis
+        client = redis.Redis.from_url(url, decode_responses=True, socket_connect_timeout=timeout, socket_timeout=timeout)
+        return cls(client, **kwargs)
+
+    def _key(self, name):
+        return f"{self.namespace}:{name}"
+
+    def _lease_key(self, access_code, endpoint):
+        return self._key(f"leases:{json.dumps([access_code, endpoint])}")
+
+    def register(self, access_code, endpoint, capacity):
+        pipe = self.client.pipeline()
+        pipe.hset(self._key("registrations"), json.dumps([access_code, endpoint]), capacity)
+        pipe.incr(self._key("version"))
+        pipe.execute()
+
+    def unregister(self, access_code, endpoint):
+        pipe = self.client.pipeline()
+        pipe.hdel(self._key("registrations"), json.dumps([access_code, endpoint]))
+        pipe.delete(self._lease_key(access_code, endpoint))
+        pipe.incr(self._key("version"))
+        pipe.execute()
+
+    def version(self):
+        return int(self.client.get(self._key("version")) or 0)
+
+    def registrations(self):
+        return {
+            tuple(json.loads(field)): int(capacity)
+            for field, capacity in self.client.hgetall(self._key("registrations")).items()
+        }
+
+    def claim(self, access_code, endpoint, capacity, job, ttl):
+        return bool(self.claim_script(keys=[self._lease_key(access_code, endpoint)], args=[capacity, job, ttl]))
+
+    def release(self, access_code, endpoint, job):
+        self.client.zrem(self._lease_key(access_code, endpoint), job)
+
+    def renew(self, leases, ttl):
+        pipe = self.client.pipeline()
+        for access_code, endpoint, job in leases:
+            self.renew_script(keys=[self._lease_key(access_code, endpoint)], args=[job, ttl], client=pipe)
+        pipe.execute()
+
+def backend_from_url(url):
+    """
+    Return the backend of the URL, "local" for the in-process one.
+    """
+    if url == "local":
+        return LocalBackend()
+    if url.split("://", 1)[0] in ("redis", "rediss", "unix"):
+        return RedisBackend.from_url(url)
+    raise ValueError(f"Unsupported federation backend: {url}")
+
+class Federation:
+    """
+    Share the executor registrations and the slot accounting of the kernels
+    through a backend, so that any kernel can schedule onto any executor.
+    Each kernel keeps scheduling with its own registry, which claims a lease
+    from the backend before reserving a slot, so an endpoint never serves more
+    jobs than its capacity across the kernels. The leases of a crashed kernel
+    expire after lease_ttl_sec, and the live ones are renewed by sync().
+    The registrations made through any kernel are applied by sync(), while the
+    endpoints quarantined locally by the health prober stay local.
+    If the backend is unreachable, the kernels fall back to their local view.
+    """
+
+    def __init__(self, registry, backend=None, lease_ttl_sec=600):
+        self.registry = registry
+        self.backend = None
+        self.lease_ttl_sec = lease_ttl_sec
+        self.known = {}  # (access_code, endpoint) -> capacity, as of the last sync
+        self.version = None
+        self.renewed_at = float('-inf')
+        self.degraded = False
+        if backend is not None:
+            self.enable(backend)
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def enable(self, backend):
+        """
+        Publish the local registrations to the backend and start claiming leases.
+        """
+        self.backend = backend
+        for access_code, endpoints in self.registry.registrations().items():
+            for endpoint, capacity in endpoints.items():
+                self.register(access_code, endpoint, capacity)
+        self.registry.leases = self
+        self.sync()
+
+    def _failed(self, action, e):
+        if not self.degraded:
+            logger.warning(f"Federation backend failed to {action}, falling back to the local registry: {e}")
+        self.degraded = True
+
+    def _recovered(self):
+        if self.degraded:
+            logger.info("Federation backend recovered")
+        self.degraded = False
+
+    def claim(self, access_code, endpoint, capacity, history_id, user_id):
+        try:
+            claimed = self.backend.claim(access_code, endpoint, capacity, job_id(history_id, user_id), self.lease_ttl_sec)
+        except Exception as e:
+            self._failed("claim a lease", e)
+            return True
+        self._recovered()
+        return claimed
+
+    def release(self, access_code, endpoint, history_id, user_id):
+        try:
+            self.backend.release(access_code, endpoint, job_id(history_id, user_id))
+        except Exception as e:
+            self._failed("release a lease", e)
+
+    def register(self, access_code, endpoint, capacity):
+        if not self.enabled: return
+        try:
+            self.backend.register(access_code, endpoint, capacity)
+            self.known[(access_code, endpoint)] = capacity
+        except Exception as e:
+            self._failed("register", e)
+
+    def unregister(self, access_code, endpoint):
+        if not self.enabled: return
+        try:
+            self.backend.unregister(access_code, endpoint)
+            self.known.pop((access_code, endpoint), None)
+        except Exception as e:
+            self._failed("unregister", e)
+
+    def sync(self):
+        """
+        The cronjob to apply the registration changes made through the other
+        kernels, renew the leases of the local jobs and retry the waiters.
+        """
+        if not self.enabled: return
+        try:
+            if time.monotonic() - self.renewed_at >= self.lease_ttl_sec / 4:
+                self.backend.renew([(i[0], i[1], job_id(i[2], i[3])) for i in self.registry.jobs()], self.lease_ttl_sec)
+                self.renewed_at = time.monotonic()
+            version = self.backend.version()
+            shared = self.backend.registrations() if version != self.version else None
+        except Exception as e:
+            self._failed("sync", e)
+            return
+        self._recovered()
+        if shared is not None:
+            added = {k: v for k, v in shared.items() if self.known.get(k) != v}
+            removed = [k for k in self.known if k not in shared]
+            self.known, self.version = shared, version
+            for (access_code, endpoint), capacity in added.items():
+                if self.registry.register(access_code, endpoint, capacity):
+                    logger.info(f"{access_code} at {endpoint} joined from the federation")
+                elif self.registry.resize(access_code, endpoint, capacity):
+                    logger.info(f"{access_code} at {endpoint} resized to {capacity} slots by the federation")
+            for access_code, endpoint in removed:
+                if self.registry.unregister(access_code, lambda i: i == endpoint):
+                    logger.info(f"{access_code} at {endpoint} left the federation")
+        self.registry.retry_waiters()
+
+federation = Federation(data, lease_ttl_sec=federation_lease_ttl_sec)
@@ -1,5 +1,5 @@
 import os, logging, re, gzip, pickle, requests, aiohttp, asyncio
-from urllib.parse import urlparse
+from urllib.parse import urlparse, quote
 from flask import make_response
 from json import dumps
 from .variable import *
@@ -9,7 +9,14 @@ logger = logging.getLogger(__name__)
 def save_variable_to_file(filename, data):
     with gzip.open(filename, 'wb') as file:
         pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
-    logger.info(f"Records saved\n{data}")
+    logger.info(f"Records saved: {summarize_records(data)}")
+    logger.debug(f"Saved records\n{data}")
+
+def summarize_records(records):
+    """
+    Describe the records briefly, the whole records are only logged at the debug level.
+    """
+    return f"{sum(len(i) for i in records.values())} executors of {len(records)} access codes"
 
 def load_variable_from_file(filename):
     with gzip.open(filename, 'rb') as file:
@@ -40,10 +47,36 @@ async def check_all_health(endpoints):
         results = await asyncio.gather(*tasks.values())
         return dict(zip(tasks.keys(), results))
 
+async def async_abort(url, session, timeout):
+    try:
+        async with session.get(url, timeout=timeout) as resp:
+            return "aborted" if resp.status == 200 else f"failed with HTTP {resp.status}"
+    except aiohttp.ClientConnectionError:
+        return "unreachable"
+    except asyncio.exceptions.TimeoutError:
+        return "timeout"
+
+def abort_url(endpoint, request_id=None):
+    # All the requests of the executor are aborted if the request id is unknown
+    if request_id is None:
+        return f"{endpoint}/abort"
+    return f"{endpoint}/abort/{quote(str(request_id), safe='')}"
+
+# Concurrently aborts the (endpoint, request_id) jobs within the deadline and maps results
+async def abort_all(jobs, deadline, session=None):
+    if session is None:
+        async with aiohttp.ClientSession() as session:
+            return await abort_all(jobs, deadline, session)
+    timeout = aiohttp.ClientTimeout(total=deadline)
+    tasks = {job: async_abort(abort_url(*job), session, timeout) for job in jobs}
+    results = await asyncio.gather(*tasks.values())
+    return dict(zip(tasks.keys(), results))
+
 # Refactored load_records function
 def load_records(var, keep_state=False):
-    logger.info(f"Loading records, Here's before\n{data}")
-    logger.info(f"Here's new records\n{var}")
+    logger.info(f"Loading records: {summarize_records(var)}")
+    logger.debug(f"Loading records, Here's before\n{data.snapshot()}")
+    logger.debug(f"Here's new records\n{var}")
 
     # Collect all endpoints to check health
     endpoints_to_check = [k[0] for i, o in var.items() for k in o]
@@ -51,19 +84,57 @@ def load_records(var, keep_state=False):
     # Run asynchronous health check for all endpoints
     health_results = asyncio.run(check_all_health(endpoints_to_check))
 
+    records = {}
     for i, o in var.items():
-        data[i] = []
+        records[i] = []
         for k in o:
             formatted_endpoint = endpoint_formatter(k[0])
 
             # Check if this endpoint passed the health check
             if health_results.get(k[0], False):
-                data[i].append(k if keep_state else [formatted_endpoint, "READY", -1, -1])
+                records[i].append(k if keep_state else [formatted_endpoint, "READY", -1, -1])
             else:
                 logger.info(f"Health check failed for {i} at {k[0]}, removed")
+    data.load(records)
+
+    snapshot = data.snapshot()
+    logger.info(f"Records loaded: {summarize_records(snapshot)}")
+    logger.debug(f"Records loaded, Here's After\n{snapshot}")
+
+
+class SSEFrameAligner:
+    """
+    Cut a byte stream of Server-Sent Events on the frame boundaries, so that
+    only whole frames are flushed to the client. The events of the executors
+    are single "data:" lines without the blank line terminator, see
+    kuwa.executor.sse.format_sse(), so a frame ends at a newline. An event of
+    several lines is only guaranteed to be cut between its lines. The chunks
+    ending on a boundary are passed through as is, and a partial frame is held
+    until it's completed or exceeds max_buffer bytes.
+    """
+
+    def __init__(self, max_buffer=65536):
+        self.max_buffer = max_buffer
+        self.buffer = b""
+
+    def feed(self, chunk):
+        """
+        Return the complete frames so far, which may be empty.
+        """
+        if self.buffer:
+            chunk, self.buffer = self.buffer + chunk, b""
+        if chunk.endswith(b"\n"):
+            return chunk
+        end = chunk.rfind(b"\n") + 1
+        if len(chunk) - end >= self.max_buffer:
+            return chunk
+        self.buffer = chunk[end:]
+        return chunk[:end]
+
+    def flush(self):
+        chunk, self.buffer = self.buffer, b""
+        return chunk
 
-        # Remove empty entries
-        if len(data[i]) == 0:
-            del data[i]
 
-    logger.info(f"Records loaded, Here's After\n{data}")
\ No newline at end of file
+def is_event_stream(content_type):
+    return content_type.split(";", 1)[0].strip().lower() == "text/event-stream"
@@ -0,0 +1,133 @@
+import logging, asyncio, threading, time
+from .variable import *
+from .functions import check_all_health
+
+logger = logging.getLogger(__name__)
+
+class CircuitBreaker:
+    """
+    The health state of an executor endpoint.
+    The circuit is closed while the endpoint is healthy. After consecutive
+    failures it's opened and the endpoint is removed from the registry. An open
+    circuit is half-opened periodically to probe the endpoint again, and the
+    endpoint is restored to the registry once it's healthy. The registrations
+    are kept in the persistent store while the circuit is open.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.last_probe = None
+        self.records = {}  # access_code -> capacity, restored when recovered
+
+    @property
+    def state(self):
+        return "closed" if self.opened_at is None else "open"
+
+    def export(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opened_at": self.opened_at,
+            "access_codes": list(self.records.keys()),
+        }
+
+class HealthProber:
+    """
+    Periodically probe the /health route of the executors and open the circuit
+    of the unhealthy ones, so that traffic is not routed to them.
+    """
+
+    def __init__(self, registry, failure_threshold=3, retry_interval_sec=30, max_open_sec=24*60*60):
+        self.registry = registry
+        self.failure_threshold = failure_threshold
+        self.retry_interval_sec = retry_interval_sec
+        self.max_open_sec = max_open_sec
+        self.breakers = {}  # endpoint -> CircuitBreaker
+        self.lock = threading.Lock()
+
+    def status(self):
+        with self.lock:
+            return {endpoint: breaker.export() for endpoint, breaker in self.breakers.items()}
+
+    def probe(self):
+        """
+        The cronjob to check the health of the registered and the quarantined executors.
+        """
+        now = time.time()
+        with self.lock:
+            half_open = [
+                endpoint for endpoint, breaker in self.breakers.items()
+                if breaker.opened_at is not None and now - breaker.last_probe >= self.retry_interval_sec
+            ]
+        endpoints = set(self.registry.endpoints()) | set(half_open)
+        if not endpoints: return
+        results = asyncio.run(check_all_health(list(endpoints)))
+        for endpoint, healthy in results.items():
+            self.report(endpoint, healthy)
+
+    def report(self, endpoint, healthy):
+        """
+        Update the circuit of the endpoint with a health check result.
+        """
+        with self.lock:
+            breaker = self.breakers.get(endpoint)
+            if healthy:
+                if breaker is None: return
+                if breaker.opened_at is not None:
+                    for access_code, capacity in breaker.records.items():
+                        self.registry.register(access_code, endpoint, capacity)
+                    logger.info(f"{endpoint} is healthy again, restored for {list(breaker.records.keys())}")
+                del self.breakers[endpoint]
+            else:
+                breaker = self.breakers.setdefault(endpoint, CircuitBreaker())
+                breaker.failures += 1
+                breaker.last_probe = time.time()
+                if breaker.opened_at is None and breaker.failures >= self.failure_threshold:
+                    self._open(endpoint, breaker)
+                elif breaker.opened_at is not None and breaker.last_probe - breaker.opened_at > self.max_open_sec:
+                    logger.warning(f"{endpoint} is unhealthy for too long, dropped")
+                    for access_code in breaker.records.keys():
+                        store.remove(access_code, endpoint)
+                    del self.breakers[endpoint]
+
+    def trip(self, endpoint):
+        """
+        Open the circuit of the endpoint immediately, e.g. when it's unreachable.
+        """
+        with self.lock:
+            breaker = self.breakers.setdefault(endpoint, CircuitBreaker())
+            breaker.failures = max(breaker.failures, self.failure_threshold)
+            breaker.last_probe = time.time()
+            if breaker.opened_at is None:
+                self._open(endpoint, breaker)
+
+    def adopt(self, records):
+        """
+        Open the circuit of the endpoints in {access_code: [slot, ...]} that are
+        not in the registry, e.g. those failed the health check at startup.
+        """
+        registrations = self.registry.registrations()
+        now = time.time()
+        with self.lock:
+            for access_code, slots in records.items():
+                for slot in slots:
+                    endpoint = slot[0]
+                    if endpoint in registrations.get(access_code, {}): continue
+                    breaker = self.breakers.setdefault(endpoint, CircuitBreaker())
+                    breaker.failures = self.failure_threshold
+                    breaker.opened_at = breaker.opened_at or now
+                    breaker.last_probe = now
+                    breaker.records[access_code] = breaker.records.get(access_code, 0) + 1
+
+    def _open(self, endpoint, breaker):
+        records = {}
+        for access_code in self.registry.access_codes():
+            removed = self.registry.unregister(access_code, lambda i: i == endpoint)
+            if removed:
+                records[access_code] = len(removed)
+        breaker.records.update(records)
+        breaker.opened_at = breaker.last_probe
+        logger.warning(f"{endpoint} failed {breaker.failures} health checks, removed from {list(records.keys())}")
+
+prober = HealthProber(data)
@@ -0,0 +1,108 @@
+"""
+A synthetic load generator of chat requests to the kernel, e.g. for exercising
+the autoscaler with the debug or dummy executors.
+Requests arrive open-loop following a profile of phases "rate:seconds", each
+sent through the single round-trip /chat/stream endpoint.
+
+Example:
+    python -m kuwa.kernel.loadgen --access_code dbg --profile 5:60,0:120,1:60
+"""
+import time, json, asyncio, argparse, logging, itertools, random, aiohttp
+from statistics import median
+
+logger = logging.getLogger(__name__)
+
+def parse_profile(profile):
+    """
+    Parse "rate:seconds,..." into [(requests per second, seconds)].
+    """
+    phases = []
+    for phase in profile.split(","):
+        rate, seconds = phase.split(":")
+        phases.append((float(rate), float(seconds)))
+    return phases
+
+async def send_request(session, url, form):
+    """
+    Send a chat request and read the whole stream.
+    Return the result ("READY", "BUSY", "NOMACHINE" or "ERROR"), the time to the
+    first byte, the duration and the arrival time of each chunk relative to the start.
+    """
+    start_time = time.perf_counter()
+    result = {"result": "ERROR", "ttfb": None, "duration": None, "chunk_times": []}
+    try:
+        async with session.post(url, data=form) as resp:
+            if resp.status != 200:
+                result["result"] = (await resp.text()).strip() or "ERROR"
+            else:
+                result["result"] = "READY"
+                async for _ in resp.content.iter_any():
+                    result["chunk_times"].append(time.perf_counter() - start_time)
+                if result["chunk_times"]:
+                    result["ttfb"] = result["chunk_times"][0]
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.debug(f"Request failed: {e}")
+    result["duration"] = time.perf_counter() - start_time
+    return result
+
+def summarize(results):
+    counts = {}
+    for i in results:
+        counts[i["result"]] = counts.get(i["result"], 0) + 1
+    durations = [i["duration"] for i in results if i["result"] == "READY"]
+    ttfbs = [i["ttfb"] for i in results if i["ttfb"] is not None]
+    return {
+        "requests": len(results),
+        "results": counts,
+        "median_duration_sec": median(durations) if durations else None,
+        "median_ttfb_sec": median(ttfbs) if ttfbs else None,
+    }
+
+async def generate_load(kernel_url, access_code, phases, prompt="Hello", users=10, max_wait=None):
+    url = kernel_url.rstrip("/") + "/v1.0/chat/stream"
+    history_ids = itertools.count(1)
+    report = []
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=600)
+    async with aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=0)) as session:
+        for rate, seconds in phases:
+            tasks = []
+            phase_start = time.monotonic()
+            if rate > 0:
+                for i in itertools.count():
+                    if i / rate >= seconds: break
+                    delay = phase_start + i / rate - time.monotonic()
+                    if delay > 0: await asyncio.sleep(delay)
+                    form = {
+                        "name": access_code,
+                        "history_id": str(next(history_ids)),
+                        "user_id": str(random.randrange(users)),
+                        "input": json.dumps([{"isbot": False, "msg": prompt}]),
+                    }
+                    if max_wait is not None: form["max_wait"] = str(max_wait)
+                    tasks.append(asyncio.create_task(send_request(session, url, form)))
+            remaining = phase_start + seconds - time.monotonic()
+            if remaining > 0: await asyncio.sleep(remaining)
+            results = await asyncio.gather(*tasks)
+            summary = {"rate": rate, "seconds": seconds, **summarize(results)}
+            logger.info(f"Phase done: {json.dumps(summary)}")
+            report.append(summary)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic chat load to the kernel.")
+    parser.add_argument("--kernel_url", default="http://127.0.0.1:9000/", help="The base URL of the kernel")
+    parser.add_argument("--access_code", required=True, help="The access code to request")
+    parser.add_argument("--profile", default="1:60", help='The phases of the load as "rate:seconds,..."')
+    parser.add_argument("--prompt", default="Hello", help="The user prompt to send")
+    parser.add_argument("--users", type=int, default=10, help="The number of distinct users")
+    parser.add_argument("--max_wait", type=float, default=None, help="The max_wait of each request in seconds")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    report = asyncio.run(generate_load(
+        args.kernel_url, args.access_code, parse_profile(args.profile),
+        prompt=args.prompt, users=args.users, max_wait=args.max_wait
+    ))
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
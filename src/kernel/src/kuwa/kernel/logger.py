@@ -1,8 +1,17 @@
 import logging
+import logging.handlers
 import os
+import copy
 import re
+import gzip
+import time
+import queue
+import shutil
+import threading
 import uvicorn
-from datetime import datetime
+import importlib
+
+logger = logging.getLogger(__name__)
 
 class InternalEndpointFilter(logging.Filter):
     """
@@ -26,12 +35,149 @@ class InternalEndpointFilter(logging.Filter):
         result = all([full_path != x for x in internal_endpoints])
         return result
 
+class LargeMessageFilter(logging.Filter):
+    """
+    Truncate the messages longer than max_length, and let at most burst of
+    them pass every interval_sec seconds. The number of the dropped ones is
+    reported by the next one passing. The decision is kept on the record,
+    since it passes the filter of each handler.
+    """
+
+    def __init__(self, max_length=4096, burst=10, interval_sec=60):
+        super().__init__()
+        self.max_length = max_length
+        self.burst = burst
+        self.interval_sec = interval_sec
+        self.window_start = 0
+        self.passed = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        decision = getattr(record, "large_message_passed", None)
+        if decision is not None:
+            return decision
+        msg = record.msg
+        if isinstance(msg, str) and not record.args:
+            if len(msg) <= self.max_length:
+                return True
+        else:
+            msg = record.getMessage()
+            if len(msg) <= self.max_length:
+                return True
+
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= self.interval_sec:
+                self.window_start, self.passed = now, 0
+            if self.passed >= self.burst:
+                self.dropped += 1
+                record.large_message_passed = False
+                return False
+            self.passed += 1
+            dropped, self.dropped = self.dropped, 0
+        msg = f"{msg[:self.max_length]}... ({len(msg) - self.max_length} characters truncated)"
+        if dropped:
+            msg += f" ({dropped} large messages dropped)"
+        record.msg, record.args = msg, None
+        record.large_message_passed = True
+        return True
+
+class QueuedHandler(logging.handlers.QueueHandler):
+    """
+    Hand the records over to a thread, which formats and emits them with the
+    target handler, so that the formatting and the I/O are off the request
+    threads. The filters are still applied before queuing. The records are
+    dropped and counted if the queue is full. The number of the dropped ones
+    is logged once the queue accepts records again, and on closing.
+    """
+
+    def __init__(self, target="logging.StreamHandler", queue_size=10000, **kwargs):
+        super().__init__(queue.Queue(queue_size))
+        module, _, name = target.rpartition(".")
+        self.target = getattr(importlib.import_module(module), name)(**kwargs)
+        self.dropped = 0
+        self.reported = 0
+        self.listener = logging.handlers.QueueListener(self.queue, self.target)
+        self.listener.start()
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # The arguments are kept for the formatters and filters of uvicorn
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped > self.reported:
+            # Reported to the module logger, since the records of the access
+            # log are formatted from their arguments
+            dropped, self.reported = self.dropped - self.reported, self.dropped
+            logger.warning(f"{dropped} log records dropped, the queue of {self.target} is full")
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        if self.dropped > self.reported and logging.lastResort is not None:
+            # The other handlers may be closed already
+            dropped, self.reported = self.dropped - self.reported, self.dropped
+            logging.lastResort.handle(logging.makeLogRecord({
+                "name": __name__,
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": f"{dropped} log records dropped, the queue of {self.target} is full",
+            }))
+        self.target.close()
+        super().close()
+
+class CompressedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotate the log file when it exceeds max_bytes or every interval_sec
+    seconds, and compress the rotated files with gzip.
+    """
+
+    def __init__(self, filename, max_bytes=0, interval_sec=0, backup_count=0, compress=True, encoding='utf-8'):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding=encoding, delay=True)
+        self.interval_sec = interval_sec
+        self.rollover_at = time.time() + interval_sec if interval_sec > 0 else None
+        if compress:
+            self.namer = lambda name: name + ".gz"
+            self.rotator = self.compress
+
+    @staticmethod
+    def compress(source, dest):
+        with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+                return True
+            self.rollover_at = time.time() + self.interval_sec
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.rollover_at is not None:
+            self.rollover_at = time.time() + self.interval_sec
+
 class ANSIEscapeCodeRemover:
     ANSI_ESCAPE = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]')
+    ACCESS_LOG = re.compile(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3} - - \[\d{2}/[A-Za-z]{3}/\d{4} \d{2}:\d{2}:\d{2}\] "[^"]*" \d{3} -')
+    ACCESS_LOG_TIME = re.compile(r'\[\d{1,2}/[A-Za-z]{3}/\d{4} \d{2}:\d{2}:\d{2}\]')
     @staticmethod
     def remove(msg):
-        if re.search(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3} - - \[\d{2}/[A-Za-z]{3}/\d{4} \d{2}:\d{2}:\d{2}\] "[^"]*" \d{3} -', msg):
-            msg = re.sub(r'\[\d{1,2}/[A-Za-z]{3}/\d{4} \d{2}:\d{2}:\d{2}\]', "", msg).replace(" - -  ", " -> ")[:-2]
+        if ' - - [' in msg and ANSIEscapeCodeRemover.ACCESS_LOG.search(msg):
+            msg = ANSIEscapeCodeRemover.ACCESS_LOG_TIME.sub("", msg).replace(" - -  ", " -> ")[:-2]
+        if '\x1b' not in msg:
+            return msg
         return ANSIEscapeCodeRemover.ANSI_ESCAPE.sub('', msg)
 
 class DefaultFileFormatter(uvicorn.logging.ColourizedFormatter):
@@ -81,29 +227,38 @@ class KernelLoggerFactory:
         'filters': {
             'internal_endpoint_filter': {
                 '()': 'kuwa.kernel.logger.InternalEndpointFilter'
+            },
+            'large_message_filter': {
+                '()': 'kuwa.kernel.logger.LargeMessageFilter'
             }
         },
         'handlers': {
             'default': {
+                '()': 'kuwa.kernel.logger.QueuedHandler',
                 'formatter': 'default',
-                'class': 'logging.StreamHandler',
+                'filters': ['large_message_filter'],
+                'target': 'logging.StreamHandler',
                 'stream': 'ext://sys.stderr'
             },
             'access': {
+                '()': 'kuwa.kernel.logger.QueuedHandler',
                 'formatter': 'access',
                 'filters': ['internal_endpoint_filter'],
-                'class': 'logging.StreamHandler',
+                'target': 'logging.StreamHandler',
                 'stream': 'ext://sys.stdout'
             },
             'default_file': {
+                '()': 'kuwa.kernel.logger.QueuedHandler',
                 'formatter': 'default_file',
-                'class': 'logging.FileHandler',
+                'filters': ['large_message_filter'],
+                'target': 'kuwa.kernel.logger.CompressedRotatingFileHandler',
                 'filename': ''
             },
             'access_file': {
+                '()': 'kuwa.kernel.logger.QueuedHandler',
                 'formatter': 'access_file',
                 'filters': ['internal_endpoint_filter'],
-                'class': 'logging.FileHandler',
+                'target': 'kuwa.kernel.logger.CompressedRotatingFileHandler',
                 'filename': ''
             }
         },
@@ -125,18 +280,24 @@ class KernelLoggerFactory:
         }
     }
 
-    def __init__(self, level="INFO", log_dir="logs", datetime_format="%Y-%m-%d_%H-%M-%S.%f"):
+    def __init__(self, level="INFO", log_dir="logs", max_bytes=64 * 2**20, interval_sec=86400, backup_count=14):
+        """
+        The logs are written to kernel.log and access.log under log_dir, which
+        are rotated when exceeding max_bytes or every interval_sec seconds,
+        keeping backup_count compressed files.
+        """
         level = level.upper()
-        self.conf = self.template.copy()
+        self.conf = copy.deepcopy(self.template)
         self.conf["root"]["level"] = level
         for logger in self.conf["loggers"].keys():
             self.conf["loggers"][logger]["level"] = level
         
-        formatted_date = datetime.now().strftime(datetime_format)
         if not os.path.exists(log_dir): os.mkdir(log_dir)
-        self.log_file_path = os.path.join(log_dir, f"{formatted_date}.log")
-        self.conf["handlers"]["default_file"]["filename"] = self.log_file_path
-        self.conf["handlers"]["access_file"]["filename"] = self.log_file_path
+        self.log_file_path = os.path.join(log_dir, "kernel.log")
+        self.access_log_file_path = os.path.join(log_dir, "access.log")
+        rotation = {"max_bytes": max_bytes, "interval_sec": interval_sec, "backup_count": backup_count}
+        self.conf["handlers"]["default_file"].update(filename=self.log_file_path, **rotation)
+        self.conf["handlers"]["access_file"].update(filename=self.access_log_file_path, **rotation)
     
     def get_config(self):
-        return self.conf.copy()
\ No newline at end of file
+        return copy.deepcopy(self.conf)
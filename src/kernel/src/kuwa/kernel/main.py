@@ -1,5 +1,5 @@
 # -#- coding: UTF-8 -*-
-import time, re, os, click, requests, sys
+import time, re, os, click, requests, sys, shlex, uvicorn
 import logging.config
 import argparse
 from datetime import datetime
@@ -9,12 +9,20 @@ from apscheduler.schedulers.background import BackgroundScheduler
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from .variable import *
-from .functions import load_records, load_variable_from_file, save_variable_to_file
+from .functions import load_records, load_variable_from_file
 from .logger import KernelLoggerFactory
+from .asgi import KernelASGIApp
 from .safety_middleware import update_safety_guard
+from .health import prober
+from .model_cache import model_cache
+from .executor_pool import executor_pool
+from .autoscaler import autoscaler
+from .federation import federation, backend_from_url
+from .coalescer import coalescer
 from .routes.executor import executor
 from .routes.model import model
 from .routes.chat import chat
+from .routes.metrics import prometheus
 
 logger = logging.getLogger(__name__)
 
@@ -27,12 +35,44 @@ def main():
     parser.add_argument('--log_level', type=str, default="INFO", help="Log level")
     parser.add_argument('--port', type=int, default=9000, help="The port to serve")
     parser.add_argument('--host', type=str, default="0.0.0.0", help="The host IP address to serve")
+    parser.add_argument('--asgi', action='store_true', help="Serve with the asyncio-native ASGI server, which streams chat completions through a pooled connection")
+    parser.add_argument('--pool_size', type=int, default=1000, help="The maximum number of pooled connections to the executors in ASGI mode")
+    parser.add_argument('--schedule_max_wait', type=float, default=schedule_max_wait_sec, help="The maximum seconds a scheduling request waits in the queue before BUSY is returned")
+    parser.add_argument('--affinity_wait', type=float, default=affinity_wait_sec, help="The maximum seconds a scheduling request waits for the executor that served the same session_id, 0 to only prefer it when it's free. Keep it well below a second")
+    parser.add_argument('--reservation_timeout', type=float, default=reservation_timeout_sec, help="The seconds after which a scheduled but unused executor slot is released, 0 to disable")
+    parser.add_argument('--model_cache_quota', type=float, default=None, help="The disk quota in GiB of the model cache, the least-recently-used models are evicted when exceeded")
+    parser.add_argument('--warm_pool_size', type=int, default=0, help="The number of pre-spawned executors waiting for /model/start")
+    parser.add_argument('--executor_command', default="kuwa-executor", help="The command to spawn executors for /model/start and the autoscaler")
+    parser.add_argument('--warm_pool_executor', default="huggingface", help="The executor type of the warm pool")
+    parser.add_argument('--health_check_interval', type=float, default=health_check_interval_sec, help="The interval in seconds to check the health of the executors, 0 to disable")
+    parser.add_argument('--federation', default=None, help="The URL of the registry shared by the federated kernels, e.g. redis://localhost:6379/1, or \"local\" for the in-process one")
+    parser.add_argument('--federation_lease_ttl', type=float, default=federation_lease_ttl_sec, help="The seconds after which the executor slots leased by a crashed kernel are released")
+    parser.add_argument('--coalesce', nargs='*', default=[], metavar="ACCESS_CODE", help="The access codes with deterministic generation, whose identical concurrent requests share a single stream from the executor")
+    parser.add_argument('--coalesce_max_buffer', type=float, default=coalesce_max_buffer_bytes / 2**20, help="The maximum MiB of a shared stream buffered for the coalesced requests")
     args = parser.parse_args()
     logging.config.dictConfig(KernelLoggerFactory(level=args.log_level).get_config())
     
-    # Load savefile
-    if os.path.exists(record_file):
-        load_records(load_variable_from_file(record_file))
+    # Load savefile, the legacy pickle records are imported once
+    if store.is_empty() and os.path.exists(record_file):
+        store.import_records(load_variable_from_file(record_file))
+        logger.info(f"Imported the records from {record_file}")
+    records = store.load()
+    load_records(records)
+    prober.adopt(records)
+    if args.federation is not None:
+        federation.lease_ttl_sec = args.federation_lease_ttl
+        federation.enable(backend_from_url(args.federation))
+    if args.model_cache_quota is not None:
+        model_cache.quota_bytes = int(args.model_cache_quota * 2**30)
+    model_cache.rescan()
+    executor_pool.size = args.warm_pool_size
+    executor_pool.executor = args.warm_pool_executor
+    executor_pool.command = shlex.split(args.executor_command)
+    executor_pool.fill()
+    coalescer.access_codes = set(args.coalesce)
+    coalescer.max_buffer_bytes = int(args.coalesce_max_buffer * 2**20)
+    autoscaler.kernel_url = f"http://127.0.0.1:{args.port}/"
+    autoscaler.load()
 
     # Schedule background job to update the Safety Guard
     logging.getLogger('apscheduler.executors.default').setLevel(logging.WARNING)
@@ -43,6 +83,40 @@ def main():
         seconds=safety_guard_update_interval_sec,
         next_run_time=datetime.now()
     )
+    scheduler.add_job(
+        func=store.compact,
+        trigger="interval",
+        seconds=store_compaction_interval_sec,
+    )
+    if args.reservation_timeout > 0:
+        scheduler.add_job(
+            func=data.expire_reservations,
+            args=(args.reservation_timeout,),
+            trigger="interval",
+            seconds=max(args.reservation_timeout / 2, 1),
+        )
+    scheduler.add_job(
+        func=model_cache.rescan,
+        trigger="interval",
+        seconds=model_cache_rescan_interval_sec,
+    )
+    scheduler.add_job(
+        func=autoscaler.evaluate,
+        trigger="interval",
+        seconds=autoscale_interval_sec,
+    )
+    if args.health_check_interval > 0:
+        scheduler.add_job(
+            func=prober.probe,
+            trigger="interval",
+            seconds=args.health_check_interval,
+        )
+    if federation.enabled:
+        scheduler.add_job(
+            func=federation.sync,
+            trigger="interval",
+            seconds=federation_sync_interval_sec,
+        )
     scheduler.start()
 
     # Init Flask Apps
@@ -50,22 +124,29 @@ def main():
     app.config["REDIS_URL"] = "redis://localhost:6379/0"
     app.config['MAX_CONTENT_LENGTH'] = None
     app.config['MAX_FORM_MEMORY_SIZE'] = MAX_PART_SIZE
+    app.config['SCHEDULE_MAX_WAIT_SEC'] = args.schedule_max_wait
+    app.config['AFFINITY_WAIT_SEC'] = args.affinity_wait
     sse = ServerSentEventsBlueprint('sse', __name__)
     app.register_blueprint(sse, url_prefix='/')
     app.register_blueprint(executor, url_prefix=f'/{KUWA_KERNEL_API_VERSION}/worker')
     app.register_blueprint(chat, url_prefix=f'/{KUWA_KERNEL_API_VERSION}/chat')
     app.register_blueprint(model, url_prefix=f'/{KUWA_KERNEL_API_VERSION}/model')
+    app.register_blueprint(prometheus, url_prefix='/')
     logger.info("Route list:\n{}\n".format('\n'.join([str(i) for i in app.url_map.iter_rules()])))
     logger.info("Server started")
-    app.run(port=args.port, host=args.host, threaded=True)
+    if args.asgi:
+        asgi_app = KernelASGIApp(app, api_prefix=f'/{KUWA_KERNEL_API_VERSION}', pool_size=args.pool_size)
+        uvicorn.run(asgi_app, port=args.port, host=args.host, log_config=None, lifespan="on")
+    else:
+        app.run(port=args.port, host=args.host, threaded=True)
     for model_name in list(download_jobs.keys()):
         job_details = download_jobs[model_name]
         job_details['stop_event'].set()
-        if job_details['process']:
-            job_details['process'].terminate()
         job_details['thread'].join()
+    executor_pool.shutdown()
     #Stopped, saving to file
-    save_variable_to_file(record_file, data)
+    store.compact()
+    store.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
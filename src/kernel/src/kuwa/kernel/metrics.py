@@ -0,0 +1,131 @@
+import time
+import prometheus_client
+
+LATENCY_BUCKETS = [
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75,
+    1.0, 2.5, 5.0, 7.5, 10.0, 20.0, 30.0, 60.0, float("inf"),
+]
+
+class KernelMetrics:
+    metrics_template = {
+        "schedule_total": {
+            "type": "Counter",
+            "description": "Number of scheduling requests by result.",
+            "labelnames": ("access_code", "result"),
+        },
+        "schedule_latency_seconds": {
+            "type": "Histogram",
+            "description": "Time to schedule a job including the waiting in queue with unit: Seconds.",
+            "labelnames": ("access_code",),
+            "buckets": LATENCY_BUCKETS,
+        },
+        "upstream_ttfb_seconds": {
+            "type": "Histogram",
+            "description": "Time to the first byte from the executor with unit: Seconds.",
+            "labelnames": ("access_code", "endpoint"),
+            "buckets": LATENCY_BUCKETS,
+        },
+        "inter_chunk_seconds": {
+            "type": "Histogram",
+            "description": "Gap between consecutive chunks from the executor with unit: Seconds.",
+            "labelnames": ("access_code", "endpoint"),
+            "buckets": LATENCY_BUCKETS,
+        },
+        "stream_duration_seconds": {
+            "type": "Histogram",
+            "description": "Duration of a proxied stream with unit: Seconds.",
+            "labelnames": ("access_code", "endpoint"),
+            "buckets": LATENCY_BUCKETS,
+        },
+        "proxied_bytes": {
+            "type": "Counter",
+            "description": "Number of bytes proxied from the executors.",
+            "labelnames": ("access_code", "endpoint"),
+        },
+        "upstream_errors": {
+            "type": "Counter",
+            "description": "Number of failed requests to the executors.",
+            "labelnames": ("access_code", "endpoint"),
+        },
+        "coalesced_total": {
+            "type": "Counter",
+            "description": "Number of requests served by the stream of an identical request in flight.",
+            "labelnames": ("access_code",),
+        },
+        "free_slots": {
+            "type": "Gauge",
+            "description": "Number of free executor slots.",
+            "labelnames": ("access_code",),
+        },
+        "busy_slots": {
+            "type": "Gauge",
+            "description": "Number of reserved or busy executor slots.",
+            "labelnames": ("access_code",),
+        },
+        "queue_length": {
+            "type": "Gauge",
+            "description": "Number of jobs waiting in the admission queue.",
+            "labelnames": ("access_code",),
+        },
+    }
+
+    def __init__(self):
+        self.name_space = "kernel"
+        self.subsystem = "scheduler"
+
+        for name, spec in self.metrics_template.items():
+            spec = dict(spec)
+            type_class = getattr(prometheus_client, spec.pop("type"))
+            description = spec.pop("description", "")
+            metric = type_class(
+                namespace=self.name_space,
+                subsystem=self.subsystem,
+                name=name,
+                documentation=description,
+                **spec,
+            )
+            setattr(self, name, metric)
+
+    def update_slots(self, registry):
+        """
+        Refresh the gauges of the slots from the registry.
+        """
+        self.free_slots.clear()
+        self.busy_slots.clear()
+        self.queue_length.clear()
+        for access_code, (free, total, queued) in registry.slot_counts().items():
+            self.free_slots.labels(access_code).set(free)
+            self.busy_slots.labels(access_code).set(total - free)
+            self.queue_length.labels(access_code).set(queued)
+
+    def generate_latest(self, registry):
+        self.update_slots(registry)
+        return prometheus_client.generate_latest()
+
+class StreamMonitor:
+    """
+    Record the timing of a stream proxied from an executor.
+    """
+
+    def __init__(self, metrics, access_code, endpoint):
+        self.metrics = metrics
+        self.labels = (access_code, endpoint)
+        self.start_time = time.perf_counter()
+        self.last_chunk_time = None
+
+    def on_chunk(self, chunk):
+        now = time.perf_counter()
+        if self.last_chunk_time is None:
+            self.metrics.upstream_ttfb_seconds.labels(*self.labels).observe(now - self.start_time)
+        else:
+            self.metrics.inter_chunk_seconds.labels(*self.labels).observe(now - self.last_chunk_time)
+        self.last_chunk_time = now
+        self.metrics.proxied_bytes.labels(*self.labels).inc(len(chunk) if isinstance(chunk, bytes) else len(chunk.encode("utf-8")))
+
+    def on_error(self):
+        self.metrics.upstream_errors.labels(*self.labels).inc()
+
+    def finish(self):
+        self.metrics.stream_duration_seconds.labels(*self.labels).observe(time.perf_counter() - self.start_time)
+
+metrics = KernelMetrics()
@@ -0,0 +1,199 @@
+import os, time, shutil, logging, threading
+from .variable import *
+
+logger = logging.getLogger(__name__)
+
+def folder_of(repo_id):
+    return "models--" + repo_id.replace("/", "--")
+
+def access_code_of(folder):
+    # The access code of the executors started by the /model/start route
+    return "hf/" + folder[len("models--"):]
+
+class CachedModel:
+    """
+    The index entry of a model in the Hugging Face cache.
+    """
+
+    def __init__(self, folder, size, revisions, last_used, partial=False):
+        self.folder = folder
+        self.size = size
+        self.revisions = revisions
+        self.last_used = last_used
+        self.partial = partial
+
+    @property
+    def repo_id(self):
+        return self.folder[len("models--"):].replace("--", "/", 1)
+
+class ModelCache:
+    """
+    An index of the models in the Hugging Face cache directory with their size,
+    revisions and last used time, so that listing doesn't walk the directory.
+    The last used time is persisted in the store, and the models in use by the
+    registered executors or being downloaded are never evicted.
+    If a quota is set, the least-recently-used models are evicted until the
+    total size is within the quota.
+    """
+
+    def __init__(self, registry, store, cache_dir=None, quota_bytes=None):
+        self.registry = registry
+        self.store = store
+        self.cache_dir = cache_dir or os.path.join(os.path.expanduser("~"), ".cache", "huggingface", "hub")
+        self.quota_bytes = quota_bytes
+        self.models = {}  # folder -> CachedModel
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def disk_usage(path):
+        """
+        Return the bytes used by the regular files under the path, the
+        symbolic links of the snapshots are not followed.
+        """
+        total = 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                file_path = os.path.join(root, name)
+                if not os.path.islink(file_path):
+                    total += os.path.getsize(file_path)
+        return total
+
+    @staticmethod
+    def is_partial(path, revisions):
+        """
+        Whether the model is partially downloaded, e.g. the download was
+        aborted or failed and kept for resuming. It has blobs still being
+        fetched, broken links or no snapshot with any file.
+        """
+        blobs = os.path.join(path, "blobs")
+        if os.path.isdir(blobs) and any(".incomplete" in i for i in os.listdir(blobs)):
+            return True
+        has_files = False
+        for revision in revisions:
+            for root, dirs, files in os.walk(os.path.join(path, "snapshots", revision)):
+                for name in files:
+                    if not os.path.exists(os.path.join(root, name)):
+                        return True
+                    has_files = True
+        return not has_files
+
+    def _scan(self, folder, usage):
+        path = os.path.join(self.cache_dir, folder)
+        snapshots = os.path.join(path, "snapshots")
+        revisions = sorted(os.listdir(snapshots)) if os.path.isdir(snapshots) else []
+        last_used = usage.get(folder) or os.path.getmtime(path)
+        return CachedModel(folder, self.disk_usage(path), revisions, last_used, self.is_partial(path, revisions))
+
+    def rescan(self):
+        """
+        Rebuild the index from the cache directory.
+        """
+        usage = self.store.model_usage()
+        folders = [
+            d for d in os.listdir(self.cache_dir)
+            if d.startswith("models--") and os.path.isdir(os.path.join(self.cache_dir, d))
+        ] if os.path.exists(self.cache_dir) else []
+        models = {}
+        for folder in folders:
+            try:
+                models[folder] = self._scan(folder, usage)
+            except FileNotFoundError:
+                pass  # Removed while scanning
+        with self.lock:
+            self.models = models
+        logger.info(f"Indexed {len(models)} cached models, {sum(i.size for i in models.values())} bytes in total")
+
+    def refresh(self, folder):
+        """
+        Update the index entry of a model, e.g. after it's downloaded.
+        """
+        with self.lock:
+            if os.path.isdir(os.path.join(self.cache_dir, folder)):
+                self.models[folder] = self._scan(folder, self.store.model_usage())
+            else:
+                self.models.pop(folder, None)
+
+    def touch(self, folder):
+        """
+        Mark the model as used now if it's in the cache.
+        """
+        with self.lock:
+            if folder not in self.models: return
+            now = time.time()
+            self.models[folder].last_used = now
+        self.store.touch_model(folder, now)
+
+    def in_use(self):
+        """
+        Return the endpoints of the registered executors using each model as {folder: [endpoint]}.
+        """
+        registrations = self.registry.registrations()
+        return {
+            folder: list(registrations.get(access_code_of(folder), {}).keys())
+            for folder in self.models.keys()
+        }
+
+    def total_size(self):
+        with self.lock:
+            return sum(i.size for i in self.models.values())
+
+    def list(self):
+        with self.lock:
+            in_use = self.in_use()
+            return [
+                {
+                    "folder": model.folder,
+                    "repo_id": model.repo_id,
+                    "size": model.size,
+                    "revisions": model.revisions,
+                    "last_used": model.last_used,
+                    "in_use": in_use[model.folder],
+                    "partial": model.partial,
+                }
+                for model in sorted(self.models.values(), key=lambda i: i.folder)
+            ]
+
+    def remove(self, folder):
+        path = os.path.join(self.cache_dir, folder)
+        shutil.rmtree(path)
+        # Clean up any associated locks
+        lock_dir = os.path.join(self.cache_dir, ".locks", folder)
+        if os.path.exists(lock_dir):
+            shutil.rmtree(lock_dir)
+        self.store.remove_model(folder)
+        with self.lock:
+            self.models.pop(folder, None)
+
+    def evict(self, quota_bytes=None, protected=()):
+        """
+        Evict the least-recently-used models that are not in use, not being
+        downloaded and not protected until the total size is within the quota.
+        Return the evicted folders.
+        """
+        quota_bytes = self.quota_bytes if quota_bytes is None else quota_bytes
+        if quota_bytes is None: return []
+        evicted = []
+        with self.lock:
+            in_use = self.in_use()
+            downloading = {folder_of(i) for i in download_jobs.keys()}
+            total = self.total_size()
+            candidates = sorted(
+                (i for i in self.models.values()
+                 if not in_use[i.folder] and i.folder not in downloading and i.folder not in protected),
+                key=lambda i: i.last_used
+            )
+            for model in candidates:
+                if total <= quota_bytes: break
+                try:
+                    self.remove(model.folder)
+                except OSError as e:
+                    logger.warning(f"Failed to evict {model.folder}: {e}")
+                    continue
+                total -= model.size
+                evicted.append(model.folder)
+                logger.info(f"Evicted {model.folder} ({model.size} bytes) from the model cache")
+            if total > quota_bytes:
+                logger.warning(f"The model cache uses {total} bytes over the quota {quota_bytes} bytes, the rest are in use")
+        return evicted
+
+model_cache = ModelCache(data, store)
@@ -0,0 +1,628 @@
+import logging
+import threading
+import time
+import uuid
+from collections import deque, OrderedDict
+
+READY = "READY"
+BUSY = "BUSY"
+NO_JOB = -1
+
+logger = logging.getLogger(__name__)
+
+class Waiter:
+    """
+    A job waiting in the admission queue of an access code.
+    """
+
+    def __init__(self, access_code, history_id, user_id, session=None, preferred=None):
+        self.access_code = access_code
+        self.history_id = history_id
+        self.user_id = user_id
+        self.session = session
+        self.preferred = preferred  # Only accept the slot of this endpoint if not None
+        self.enqueue_time = time.time()
+        self.state = None
+        self.event = threading.Event()
+        self.callbacks = []
+
+    def wait_sec(self):
+        return time.time() - self.enqueue_time
+
+    def add_done_callback(self, callback):
+        """
+        The callback will be invoked with the registry lock held once the
+        waiter is handed a slot or the access code is gone.
+        """
+        self.callbacks.append(callback)
+        if self.event.is_set():
+            callback()
+
+    def _done(self, state):
+        self.state = state
+        self.event.set()
+        for callback in self.callbacks:
+            callback()
+
+class ExecutorRegistry:
+    """
+    Thread-safe registry of the executor slots.
+    Each slot is a list of [endpoint, status, history_id, user_id], which is the
+    same format exposed by the /worker/read and /worker/debug routes.
+    An executor endpoint may own several slots to serve concurrent requests.
+    The free slots are kept in a deque per endpoint, and an index on
+    (history_id, user_id) and the access code makes lookup and release O(1). Scheduling picks the
+    least-loaded endpoint, which is O(number of endpoints of the access code).
+    Jobs that can't be scheduled immediately can wait in a FIFO admission
+    queue per access code, which is handed the released slots in order.
+    An affinity table remembers the endpoint that last served each session, so
+    that the executor holding a warm prompt cache is preferred.
+    If leases is given, e.g. a Federation, a slot is only reserved after
+    leases.claim() succeeds, so that the kernels sharing the executors never
+    exceed their capacity. The lease is released with the slot. Since the
+    leases may be a round trip to a remote backend, they are claimed and
+    released without the lock held, and the slot is reserved afterwards.
+    """
+
+    def __init__(self, affinity_table_size=10000, leases=None):
+        self.lock = threading.RLock()
+        self._slots = {}    # access_code -> [slot, ...]
+        self._free = {}     # access_code -> {endpoint: deque([slot, ...])}
+        self._capacity = {} # (access_code, endpoint) -> number of slots
+        self._retiring = {} # (access_code, endpoint) -> number of busy slots to remove once released
+        self._queued = set()  # id() of the slots in the free deques
+        self._owner = {}    # id(slot) -> access_code
+        self._index = {}    # (history_id, user_id) -> {access_code: slot}
+        self._waiters = {}  # access_code -> deque([Waiter, ...])
+        self._affinity = OrderedDict()  # (access_code, session) -> endpoint
+        self._reserved_at = {}  # id(slot) -> (reservation time, slot), until the slot is acquired
+        self._request_ids = {}  # id(slot) -> the X-Request-Id of the request of the job
+        self._unleases = []  # (access_code, endpoint, history_id, user_id) to release once the lock is left
+        self.affinity_table_size = affinity_table_size
+        self.leases = leases
+
+    @staticmethod
+    def _key(history_id, user_id):
+        return (str(history_id), str(user_id))
+
+    @staticmethod
+    def is_free(slot):
+        return slot[1] == READY and slot[2] == NO_JOB and slot[3] == NO_JOB
+
+    def _claim(self, access_code, endpoint, capacity, history_id, user_id):
+        """
+        Claim the lease of the job on the endpoint. Called without the lock held.
+        """
+        if self.leases is None: return True
+        return self.leases.claim(access_code, endpoint, capacity, history_id, user_id)
+
+    def _unclaim(self, access_code, endpoint, history_id, user_id):
+        """
+        Give back the lease claimed for a slot that was taken meanwhile.
+        """
+        if self.leases is not None:
+            self.leases.release(access_code, endpoint, history_id, user_id)
+
+    def _unlease(self, access_code, slot):
+        if self.leases is not None and slot[2] != NO_JOB and slot[3] != NO_JOB:
+            self._unleases.append((access_code, slot[0], slot[2], slot[3]))
+
+    def _flush_leases(self):
+        """
+        Release the leases of the freed slots. Called without the lock held.
+        """
+        if not self._unleases: return
+        with self.lock:
+            unleases, self._unleases = self._unleases, []
+        for lease in unleases:
+            self.leases.release(*lease)
+
+    def _settle(self, access_codes=None):
+        """
+        Release the leases of the freed slots and hand the free slots to the
+        waiters, which are deferred until the lock is left if there are leases.
+        """
+        if self.leases is None: return
+        self._flush_leases()
+        self.retry_waiters(access_codes)
+
+    def _hand(self, access_code, slot, waiter):
+        waiters = self._waiters[access_code]
+        waiters.remove(waiter)
+        if not waiters: del self._waiters[access_code]
+        self._reserve(access_code, slot, waiter.history_id, waiter.user_id, waiter.session)
+        waiter._done(READY)
+
+    def _enqueue(self, access_code, slot):
+        if id(slot) in self._queued or not self.is_free(slot): return
+        waiters = self._waiters.get(access_code)
+        # Hand the slot to the oldest waiter accepting it directly to keep the queue fair.
+        # With leases, retry_waiters() does it once the lease is claimed.
+        waiter = next((i for i in waiters if i.preferred in (None, slot[0])), None) if waiters and self.leases is None else None
+        if waiter is not None:
+            self._hand(access_code, slot, waiter)
+            return
+        self._free.setdefault(access_code, {}).setdefault(slot[0], deque()).append(slot)
+        self._queued.add(id(slot))
+
+    def _add(self, access_code, slot):
+        self._slots.setdefault(access_code, []).append(slot)
+        self._owner[id(slot)] = access_code
+        self._capacity[(access_code, slot[0])] = self._capacity.get((access_code, slot[0]), 0) + 1
+        if slot[2] != NO_JOB and slot[3] != NO_JOB:
+            self._index.setdefault(self._key(slot[2], slot[3]), {})[access_code] = slot
+        self._enqueue(access_code, slot)
+
+    def _reserve(self, access_code, slot, history_id, user_id, session=None):
+        slot[2], slot[3] = history_id, user_id
+        self._index.setdefault(self._key(history_id, user_id), {})[access_code] = slot
+        self._reserved_at[id(slot)] = (time.monotonic(), slot)
+        # Sent to the executor, so that the job can be aborted before it starts streaming
+        self._request_ids[id(slot)] = uuid.uuid4().hex
+        if session is not None:
+            self._affinity[(access_code, str(session))] = slot[0]
+            self._affinity.move_to_end((access_code, str(session)))
+            if len(self._affinity) > self.affinity_table_size:
+                self._affinity.popitem(last=False)
+
+    def _preferred(self, access_code, session):
+        """
+        Return the endpoint that last served the session if it's still registered.
+        """
+        if session is None: return None
+        endpoint = self._affinity.get((access_code, str(session)))
+        return endpoint if (access_code, endpoint) in self._capacity else None
+
+    def _remove(self, access_code, slot):
+        self._unlease(access_code, slot)
+        self._slots[access_code] = [i for i in self._slots[access_code] if i is not slot]
+        self._owner.pop(id(slot), None)
+        self._unindex(slot)
+        endpoint = slot[0]
+        self._capacity[(access_code, endpoint)] -= 1
+        if self._capacity[(access_code, endpoint)] == 0:
+            del self._capacity[(access_code, endpoint)]
+            self._retiring.pop((access_code, endpoint), None)
+        free = self._free.get(access_code, {})
+        if id(slot) in self._queued and endpoint in free:
+            self._queued.discard(id(slot))
+            free[endpoint] = deque(i for i in free[endpoint] if i is not slot)
+            if not free[endpoint]: del free[endpoint]
+        if not self._slots[access_code]:
+            del self._slots[access_code]
+            self._free.pop(access_code, None)
+            for waiter in self._waiters.pop(access_code, []):
+                waiter._done("NOMACHINE")
+
+    def _capacity_of(self, access_code, endpoint):
+        return self._capacity[(access_code, endpoint)] - self._retiring.get((access_code, endpoint), 0)
+
+    def _by_load(self, access_code):
+        """
+        Return the endpoints with free slots, the fewest in-flight jobs first.
+        """
+        free = self._free.get(access_code, {})
+        return sorted(free.keys(), key=lambda endpoint: self._capacity[(access_code, endpoint)] - len(free[endpoint]))
+
+    def _candidates(self, access_code):
+        """
+        Return the endpoints to try to schedule on. Without leases a free slot
+        can always be reserved, so only the least-loaded endpoint is returned.
+        """
+        endpoints = self._by_load(access_code)
+        return endpoints[:1] if self.leases is None else endpoints
+
+    def _find_waiter(self, access_code, history_id, user_id):
+        key = self._key(history_id, user_id)
+        for waiter in self._waiters.get(access_code, []):
+            if self._key(waiter.history_id, waiter.user_id) == key:
+                return waiter
+        return None
+
+    def _take(self, access_code, endpoint):
+        """
+        Pop a free slot of the endpoint.
+        """
+        free = self._free[access_code]
+        slot = free[endpoint].popleft()
+        if not free[endpoint]: del free[endpoint]
+        self._queued.discard(id(slot))
+        return slot
+
+    def _unindex(self, slot):
+        self._reserved_at.pop(id(slot), None)
+        self._request_ids.pop(id(slot), None)
+        key = self._key(slot[2], slot[3])
+        slots = self._index.get(key, {})
+        for access_code in [i for i, s in slots.items() if s is slot]:
+            del slots[access_code]
+        if not slots:
+            self._index.pop(key, None)
+
+    def __contains__(self, access_code):
+        with self.lock:
+            return access_code in self._slots
+
+    def access_codes(self):
+        with self.lock:
+            return list(self._slots.keys())
+
+    def endpoints(self):
+        with self.lock:
+            return [slot[0] for slots in self._slots.values() for slot in slots]
+
+    def registrations(self):
+        """
+        Return the registered endpoints as {access_code: {endpoint: capacity}}.
+        """
+        with self.lock:
+            result = {}
+            for (access_code, endpoint), capacity in self._capacity.items():
+                result.setdefault(access_code, {})[endpoint] = capacity
+            return result
+
+    def slot_counts(self):
+        """
+        Return {access_code: (free slots, total slots, waiting jobs)}.
+        """
+        with self.lock:
+            return {
+                access_code: (
+                    sum(len(i) for i in self._free.get(access_code, {}).values()),
+                    len(slots),
+                    len(self._waiters.get(access_code, [])),
+                )
+                for access_code, slots in self._slots.items()
+            }
+
+    def snapshot(self):
+        """
+        Return a deep copy of the registry as {access_code: [slot, ...]}.
+        """
+        with self.lock:
+            return {k: [list(slot) for slot in v] for k, v in self._slots.items()}
+
+    def load(self, records):
+        """
+        Replace the slots of each access code in {access_code: [slot, ...]}.
+        Access codes not in the records are left untouched.
+        """
+        with self.lock:
+            for access_code, slots in records.items():
+                for slot in list(self._slots.get(access_code, [])):
+                    self._remove(access_code, slot)
+                for slot in slots:
+                    self._add(access_code, list(slot))
+        self._settle(list(records.keys()))
+
+    def register(self, access_code, endpoint, capacity=1):
+        """
+        Register an executor endpoint with the given number of concurrent slots.
+        """
+        with self.lock:
+            if (access_code, endpoint) in self._capacity or capacity < 1:
+                return False
+            for _ in range(capacity):
+                self._add(access_code, [endpoint, READY, NO_JOB, NO_JOB])
+        self._settle([access_code])
+        return True
+
+    def resize(self, access_code, endpoint, capacity):
+        """
+        Change the number of slots of a registered endpoint. The free slots
+        beyond the capacity are removed at once and the busy ones once
+        they're released. Return False if the endpoint isn't registered.
+        """
+        with self.lock:
+            if (access_code, endpoint) not in self._capacity or capacity < 1:
+                return False
+            self._retiring.pop((access_code, endpoint), None)
+            for _ in range(capacity - self._capacity[(access_code, endpoint)]):
+                self._add(access_code, [endpoint, READY, NO_JOB, NO_JOB])
+            free = list(self._free.get(access_code, {}).get(endpoint, []))
+            for slot in free[:max(self._capacity[(access_code, endpoint)] - capacity, 0)]:
+                self._remove(access_code, slot)
+            if self._capacity[(access_code, endpoint)] > capacity:
+                self._retiring[(access_code, endpoint)] = self._capacity[(access_code, endpoint)] - capacity
+        self._settle([access_code])
+        return True
+
+    def load_of(self, access_code, endpoint):
+        """
+        Return the number of in-flight jobs and the capacity of the endpoint.
+        """
+        with self.lock:
+            capacity = self._capacity.get((access_code, endpoint), 0)
+            free = len(self._free.get(access_code, {}).get(endpoint, []))
+            return capacity - free, capacity
+
+    def unregister(self, access_code, match):
+        """
+        Remove the slots of the access code whose endpoint satisfies match().
+        Return the removed slots.
+        """
+        with self.lock:
+            targets = [i for i in self._slots.get(access_code, []) if match(i[0])]
+            for slot in targets:
+                self._remove(access_code, slot)
+        self._flush_leases()
+        return targets
+
+    def schedule(self, access_code, history_id, user_id, session=None, endpoint=None):
+        """
+        Reserve a free slot of the access code for the job. The endpoint that
+        last served the session is preferred. If endpoint is given, only the
+        slots of that endpoint are considered.
+        Return "READY", "BUSY" or "NOMACHINE".
+        """
+        with self.lock:
+            if not self._slots.get(access_code):
+                return "NOMACHINE"
+            slot = self._index.get(self._key(history_id, user_id), {}).get(access_code)
+            if slot is not None and slot[1] == READY:
+                # The job has already reserved a slot, e.g. a retried schedule request.
+                return READY
+            free = self._free.get(access_code, {})
+            if endpoint is not None:
+                candidates = [endpoint] if endpoint in free else []
+            else:
+                preferred = self._preferred(access_code, session)
+                candidates = [preferred] if preferred in free else []
+                candidates += [i for i in self._candidates(access_code) if i != preferred]
+            if self.leases is None:
+                if not candidates: return BUSY
+                self._reserve(access_code, self._take(access_code, candidates[0]), history_id, user_id, session)
+                return READY
+            candidates = [(i, self._capacity_of(access_code, i)) for i in candidates]
+        for endpoint, capacity in candidates:
+            if not self._claim(access_code, endpoint, capacity, history_id, user_id):
+                continue
+            with self.lock:
+                if endpoint in self._free.get(access_code, {}):
+                    self._reserve(access_code, self._take(access_code, endpoint), history_id, user_id, session)
+                    return READY
+            self._unclaim(access_code, endpoint, history_id, user_id)
+        return BUSY
+
+    def enqueue(self, access_code, history_id, user_id, session=None, affinity=False):
+        """
+        Schedule the job, or put it into the admission queue of the access code
+        if there is no free slot. If affinity is True, the job waits for the
+        endpoint that last served the session even if other slots are free,
+        until relax() is called. The returned waiter is done immediately if
+        the job is scheduled or there is no machine.
+        """
+        with self.lock:
+            waiter = self._find_waiter(access_code, history_id, user_id)
+            if waiter is not None:
+                return waiter
+            preferred = self._preferred(access_code, session) if affinity else None
+            waiter = Waiter(access_code, history_id, user_id, session, preferred)
+        state = self.schedule(access_code, history_id, user_id, session, preferred)
+        with self.lock:
+            if state == BUSY and access_code not in self._slots:
+                state = "NOMACHINE"
+            if state != BUSY:
+                waiter._done(state)
+                return waiter
+            queued = self._find_waiter(access_code, history_id, user_id)
+            if queued is not None:
+                return queued
+            self._waiters.setdefault(access_code, deque()).append(waiter)
+        # A slot may have been freed before the waiter joined the queue
+        self.retry_waiters([access_code])
+        return waiter
+
+    def dequeue(self, waiter):
+        """
+        Leave the admission queue and return the final scheduling state.
+        """
+        with self.lock:
+            if waiter.state is not None:
+                return waiter.state
+            waiters = self._waiters.get(waiter.access_code, deque())
+            if waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters: del self._waiters[waiter.access_code]
+            return BUSY
+
+    def relax(self, waiter):
+        """
+        Stop waiting for the preferred endpoint and accept any free slot.
+        """
+        with self.lock:
+            if waiter.state is not None or waiter.preferred is None: return
+            waiter.preferred = None
+        self.retry_waiters([waiter.access_code])
+
+    def wait(self, access_code, history_id, user_id, timeout, session=None, affinity_wait=0):
+        """
+        Schedule the job, waiting at most timeout seconds in the admission queue,
+        of which at most affinity_wait seconds for the endpoint that last served
+        the session. Return "READY", "BUSY" or "NOMACHINE".
+        """
+        waiter = self.enqueue(access_code, history_id, user_id, session, affinity=affinity_wait > 0)
+        if waiter.preferred is not None and not waiter.event.wait(min(affinity_wait, timeout)):
+            self.relax(waiter)
+        waiter.event.wait(max(timeout - waiter.wait_sec(), 0))
+        return self.dequeue(waiter)
+
+    def queue_status(self, access_code, history_id=None, user_id=None):
+        """
+        Return the length of the admission queue of the access code, and the
+        1-based position and the waiting time of the job if it is waiting.
+        """
+        with self.lock:
+            waiters = self._waiters.get(access_code, [])
+            status = {"length": len(waiters), "position": None, "wait_sec": None}
+            key = self._key(history_id, user_id)
+            for position, waiter in enumerate(waiters, start=1):
+                if self._key(waiter.history_id, waiter.user_id) == key:
+                    status.update(position=position, wait_sec=waiter.wait_sec())
+                    break
+            return status
+
+    def lookup(self, access_code, history_id, user_id):
+        """
+        Return the slot reserved by the job, or None if not found.
+        """
+        with self.lock:
+            return self._index.get(self._key(history_id, user_id), {}).get(access_code)
+
+    def acquire(self, access_code, history_id, user_id):
+        """
+        Mark the slot reserved by the job as BUSY and return it.
+        Return None if there is no READY slot reserved by the job.
+        """
+        with self.lock:
+            slot = self.lookup(access_code, history_id, user_id)
+            if slot is None or slot[1] != READY:
+                return None
+            slot[1] = BUSY
+            self._reserved_at.pop(id(slot), None)
+            return slot
+
+    def attach(self, slot, history_id, user_id, request_id):
+        """
+        Record the id the executor reported for the request of the job, in
+        case it didn't take the one sent by the kernel. Return False if the
+        slot is no longer reserved by the job.
+        """
+        with self.lock:
+            if slot[2] == NO_JOB or self._key(slot[2], slot[3]) != self._key(history_id, user_id):
+                return False
+            if request_id:
+                self._request_ids[id(slot)] = request_id
+            return True
+
+    def request_id_of(self, slot):
+        """
+        Return the id of the request in the slot, or None if the slot isn't
+        reserved by this kernel, e.g. the job was loaded from the records.
+        """
+        with self.lock:
+            return self._request_ids.get(id(slot))
+
+    def expire_reservations(self, timeout):
+        """
+        Release the slots that are reserved but not acquired within timeout
+        seconds, e.g. the client never sent the completion request.
+        Return the number of released slots.
+        """
+        with self.lock:
+            now = time.monotonic()
+            expired = [(slot, slot[2], slot[3]) for reserved_at, slot in self._reserved_at.values() if now - reserved_at > timeout]
+        count = 0
+        for slot, history_id, user_id in expired:
+            if self.release(slot, history_id, user_id):
+                logger.info(f"Reservation of {slot[0]} for {history_id},{user_id} expired")
+                count += 1
+        return count
+
+    def release(self, slot, history_id, user_id):
+        """
+        Reset the slot reserved by the job to the free state and return it to
+        the free deque. Return False without touching the slot if it's no
+        longer reserved by the job, e.g. it was released and handed to the
+        next waiter already.
+        """
+        with self.lock:
+            if slot[2] == NO_JOB or self._key(slot[2], slot[3]) != self._key(history_id, user_id):
+                return False
+            self._unindex(slot)
+            access_code = self._owner.get(id(slot))
+            if access_code is not None:
+                self._unlease(access_code, slot)
+            slot[1], slot[2], slot[3] = READY, NO_JOB, NO_JOB
+            if access_code is not None and self._retiring.get((access_code, slot[0])):
+                # The capacity of the endpoint was reduced while the slot was busy
+                self._retiring[(access_code, slot[0])] -= 1
+                self._remove(access_code, slot)
+            elif access_code is not None:
+                self._enqueue(access_code, slot)
+        if access_code is not None:
+            self._settle([access_code])
+        return True
+
+    def retry_waiters(self, access_codes=None):
+        """
+        Hand the free slots to the waiters of the access codes, all by
+        default, e.g. since the leases held by other kernels may have been
+        released meanwhile. The leases are claimed without the lock held.
+        Return the number of the scheduled waiters.
+        """
+        self._flush_leases()
+        with self.lock:
+            if access_codes is None:
+                access_codes = list(self._waiters.keys())
+            plan = [
+                (access_code, [(i, self._capacity_of(access_code, i)) for i in self._by_load(access_code)])
+                for access_code in access_codes if access_code in self._waiters
+            ]
+        scheduled = 0
+        for access_code, endpoints in plan:
+            for endpoint, capacity in endpoints:
+                while True:
+                    with self.lock:
+                        waiters = self._waiters.get(access_code)
+                        waiter = next((i for i in waiters if i.preferred in (None, endpoint)), None) if waiters else None
+                        if waiter is None or endpoint not in self._free.get(access_code, {}):
+                            break
+                    if not self._claim(access_code, endpoint, capacity, waiter.history_id, waiter.user_id):
+                        break
+                    with self.lock:
+                        if waiter in self._waiters.get(access_code, ()) and endpoint in self._free.get(access_code, {}):
+                            self._hand(access_code, self._take(access_code, endpoint), waiter)
+                            scheduled += 1
+                            continue
+                    self._unclaim(access_code, endpoint, waiter.history_id, waiter.user_id)
+                    break
+        return scheduled
+
+    def jobs(self):
+        """
+        Return the (access_code, endpoint, history_id, user_id) of the reserved and busy slots.
+        """
+        with self.lock:
+            return [
+                (access_code, slot[0], slot[2], slot[3])
+                for access_code, slots in self._slots.items() for slot in slots
+                if slot[2] != NO_JOB and slot[3] != NO_JOB
+            ]
+
+    def remove(self, slot):
+        """
+        Remove the slot from the registry, e.g. when the executor is unreachable.
+        """
+        with self.lock:
+            access_code = self._owner.get(id(slot))
+            if access_code is not None:
+                self._remove(access_code, slot)
+        self._flush_leases()
+
+    def find_jobs(self, history_ids, user_id):
+        """
+        Return the slots serving any of the history ids of the user.
+        """
+        with self.lock:
+            result = []
+            for history_id in history_ids:
+                result.extend(self._index.get(self._key(history_id, user_id), {}).values())
+            return result
+
+    def find(self, access_code, record, pop=False):
+        """
+        Find the first slot of the access code equals to the record.
+        If pop is True, delete the slot from the registry before returning it.
+        """
+        with self.lock:
+            found = next((slot for slot in self._slots.get(access_code, []) if slot == record), None)
+            if found is not None and pop:
+                self._remove(access_code, found)
+        self._flush_leases()
+        return found
+
+    def add(self, access_code, record):
+        with self.lock:
+            self._add(access_code, list(record))
+        self._settle([access_code])
@@ -1,8 +1,13 @@
-import requests
+import requests, time, json, asyncio, codecs
 from typing import List, Optional
-from flask import Blueprint, request, Response
+from flask import Blueprint, request, Response, current_app, jsonify
 from ..variable import *
 from ..safety_middleware import safety_middleware
+from ..functions import abort_all, SSEFrameAligner, is_event_stream
+from ..health import prober
+from ..metrics import metrics, StreamMonitor
+from ..autoscaler import autoscaler
+from ..coalescer import coalescer
 chat = Blueprint('chat', __name__)
 
 @chat.route("/completions", methods=["POST"])
@@ -10,20 +15,98 @@ def completions():
     # Forward SSE stream to the READY state LLM API, If no exist then return empty message
     # Parameters: name, input, history_id, user_id
     llm_name = request.form.get("name")
-    if data.get(llm_name):
-        dest = [i for i in data[llm_name] if i[1] == "READY" and i[2] == request.form.get("history_id") and i[3] == request.form.get("user_id")]
-        if len(dest) > 0:
-            dest = dest[0]
-            result = completions_backend(
-                form=request.form,
-                headers=request.headers,
-                dest=dest
-            )
-            return result
+    dest = data.acquire(llm_name, request.form.get("history_id"), request.form.get("user_id"))
+    if dest is not None:
+        result = forward(
+            form=request.form,
+            headers=request.headers,
+            dest=dest
+        )
+        return result
     return ""
 
+@chat.route("/stream", methods=["POST"])
+def stream():
+    # Schedule the job and forward the SSE stream in a single request, so that
+    # the reservation can't leak between the scheduling and the completion request.
+    # Return "BUSY" with status 503 or "NOMACHINE" with status 404 if not scheduled.
+    # Parameters: name, input, history_id, user_id, max_wait (optional), session_id (optional)
+    llm_name, history_id, user_id = request.form.get("name"), request.form.get("history_id"), request.form.get("user_id")
+    if not llm_name or not history_id:
+        return Response("BUSY", status=503)
+    # An identical request in flight is followed without taking a slot
+    key = coalescer.key(request.form, request.headers.get("Accept-Language"))
+    result = coalescer.follow(key, (str(history_id), str(user_id))) if key is not None else None
+    if result is not None:
+        metrics.coalesced_total.labels(llm_name).inc()
+        return result
+    state = schedule_job(request.form, current_app.config)
+    if state != "READY":
+        return Response(state, status=SCHEDULE_FAILURE_STATUS[state])
+    dest = data.acquire(llm_name, history_id, user_id)
+    if dest is None:
+        return Response("BUSY", status=503)
+    return forward(
+        form=request.form,
+        headers=request.headers,
+        dest=dest,
+        key=key
+    )
+
+SCHEDULE_FAILURE_STATUS = {"BUSY": 503, "NOMACHINE": 404}
+
+def schedule_job(form, config):
+    """
+    Schedule the job in the form, waiting in the admission queue for at most
+    the max_wait seconds. Return "READY", "BUSY" or "NOMACHINE".
+    """
+    llm_name, history_id, user_id = form.get("name"), form.get("history_id"), form.get("user_id")
+    start_time = time.perf_counter()
+    max_wait = config.get("SCHEDULE_MAX_WAIT_SEC", schedule_max_wait_sec)
+    max_wait = min(float(form.get("max_wait", max_wait)), max_wait)
+    affinity_wait = config.get("AFFINITY_WAIT_SEC", affinity_wait_sec)
+    state = data.wait(llm_name, history_id, user_id, timeout=max_wait, session=session_of(form), affinity_wait=affinity_wait)
+    metrics.schedule_latency_seconds.labels(llm_name).observe(time.perf_counter() - start_time)
+    metrics.schedule_total.labels(llm_name, state).inc()
+    autoscaler.observe(llm_name, state)
+    return state
+
+def session_of(form):
+    """
+    The key of the session affinity, the explicit session_id or the history
+    id, so that a retried job is served by the same executor. It's not keyed
+    on the user, whose concurrent chats should be spread over the executors.
+    """
+    return form.get("session_id") or form.get("history_id")
+
+def forward(form, headers, dest, key=None):
+    """
+    Forward the request to the destination, or follow the stream of an
+    identical request in flight and release the destination if the request
+    can be coalesced.
+    """
+    if key is None:
+        key = coalescer.key(form, headers.get("Accept-Language"))
+    if key is None:
+        return completions_backend(form=form, headers=headers, dest=dest)
+    flight, token = coalescer.flight(key, (str(form.get("history_id")), str(form.get("user_id"))))
+    if token is not None:
+        result = flight.follow(token)
+        if result is not None:
+            data.release(dest, form.get("history_id"), form.get("user_id"))
+            metrics.coalesced_total.labels(form.get("name")).inc()
+            return result
+        # The leader failed to start the stream, serve the request on its own
+        return completions_backend(form=form, headers=headers, dest=dest)
+    try:
+        result = completions_backend(form=form, headers=headers, dest=dest)
+    except BaseException:
+        flight.fail()
+        raise
+    return flight.lead(result)
+
 @safety_middleware
-def completions_backend(form: dict, headers: dict, dest:list):
+def completions_backend(form: dict, headers: dict, dest:list, decode: bool = False):
     """
     The backend portion of the completions endpoint. It forwards the user
     request to the backend.  This separation enables middleware can be installed
@@ -33,41 +116,125 @@ def completions_backend(form: dict, headers: dict, dest:list):
         headers: The header going to be forwarded
         dest: The reference of the internal scheduling state. Note that the
         state should be reset after processing.
+        decode: Whether to decode the stream to str for the middleware that
+        inspects the content. The raw bytes are passed through by default.
     Return:
         A generator object should be returned representing the streaming content.
         When encounter an error, we return an empty string here to be compatible
         with the original framework.
     """
 
-    llm_name = form.get("name")
+    llm_name, history_id, user_id = form.get("name"), form.get("history_id"), form.get("user_id")
+    monitor = StreamMonitor(metrics, llm_name, dest[0])
+    headers = {k: v for k, v in headers.items() if k.lower() != "x-request-id"}
+    request_id = data.request_id_of(dest)
+    if request_id is not None:
+        headers["X-Request-Id"] = request_id
     try:
         response = requests.post(dest[0], headers=headers, data=form, stream=True, timeout=5000)
+        data.attach(dest, history_id, user_id, response.headers.get("X-Request-Id"))
+        content_type = response.headers.get("Content-Type", "text/plain")
+        # Event streams are flushed on the frame boundaries
+        aligner = SSEFrameAligner() if is_event_stream(content_type) else None
         def event_stream(dest, response):
-            dest[1] = "BUSY"
             try:
-                for c in response.iter_content(chunk_size=None, decode_unicode=True):
+                for c in response.iter_content(chunk_size=None):
+                    monitor.on_chunk(c)
+                    if aligner is not None:
+                        c = aligner.feed(c)
+                        if not c: continue
                     yield c
+                if aligner is not None and aligner.buffer:
+                    yield aligner.flush()
             except Exception as e:
+                monitor.on_error()
                 print('Error: {0}'.format(str(e)))
             finally:
-                dest[3] = -1
-                dest[2] = -1
-                dest[1] = "READY"
+                monitor.finish()
+                response.close()
+                data.release(dest, history_id, user_id)
                 print("Done")
-        return event_stream(dest, response), {'Content-Type': 'text/plain'}
+        stream = event_stream(dest, response)
+        if decode:
+            stream = decode_stream(stream, charset_of(content_type))
+        return stream, {'Content-Type': content_type}
     except requests.exceptions.ConnectionError as e:
-        #POST Failed, unregister this LLM
-        data[llm_name] = [i for i in data[llm_name] if i[0] != dest[0]]
-        if data[llm_name] == []: del data[llm_name]
+        #POST Failed, remove this LLM until it's healthy again
+        monitor.on_error()
+        prober.trip(dest[0])
         return ""
 
+def charset_of(content_type, default="utf-8"):
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.partition("=")
+        if key.strip().lower() == "charset" and value.strip():
+            return value.strip().strip('"')
+    return default
+
+def decode_stream(stream, encoding):
+    """
+    Decode the byte stream incrementally, closing it when the decoded stream is closed.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    try:
+        for c in stream:
+            c = decoder.decode(c)
+            if c: yield c
+        c = decoder.decode(b"", final=True)
+        if c: yield c
+    finally:
+        stream.close()
+
 @chat.route("/abort", methods=["POST"])
 def abort():
+    # Abort the jobs of the user, the executors are called concurrently within abort_deadline_sec
+    # Parameters: history_id (JSON list), user_id
+    # Return the results of the jobs serving each history id
     history_id, user_id = request.form.get("history_id"), request.form.get("user_id")
+    targets, coalesced = [], []
     if history_id and user_id:
-        history_id = eval(history_id)
-        for i, o in data.items():
-            dest = [k for k in o if int(k[2]) in history_id and k[3] == user_id]
-            for d in dest:
-                requests.get(d[0] + "/abort", timeout=10)
-    return "Success"
+        try:
+            history_ids = parse_history_ids(history_id)
+        except ValueError:
+            return jsonify({"status": "Failed", "msg": "history_id should be a JSON list"}), 400
+        coalesced, targets = abort_coalesced(history_ids, user_id)
+    jobs = [job for _, job in targets]
+    results = asyncio.run(abort_all(jobs, abort_deadline_sec)) if jobs else {}
+    return jsonify(abort_report(targets, results, coalesced))
+
+def parse_history_ids(value):
+    """
+    Parse the JSON list of history ids. A JSON object, which is produced by
+    json_encode() of a non-sequential PHP array, is accepted as well.
+    """
+    history_ids = json.loads(value)
+    if isinstance(history_ids, dict):
+        history_ids = list(history_ids.values())
+    elif not isinstance(history_ids, list):
+        history_ids = [history_ids]
+    return history_ids
+
+def abort_targets(history_ids, user_id):
+    """
+    Return the (history_id, (endpoint, request_id)) of the jobs serving the
+    history ids, several if a history id is served by several access codes.
+    The request id is None if it's unknown, then the whole executor is aborted.
+    """
+    return [(slot[2], (slot[0], data.request_id_of(slot))) for slot in data.find_jobs(history_ids, user_id)]
+
+def abort_coalesced(history_ids, user_id):
+    """
+    Stop streaming to the coalesced jobs without cancelling the stream shared
+    with the others. Return the history ids left to the coalescer and the
+    abort_targets() of the rest.
+    """
+    coalesced = [i for i in history_ids if coalescer.abort((str(i), str(user_id)))]
+    return coalesced, abort_targets([i for i in history_ids if i not in coalesced], user_id)
+
+def abort_report(targets, results, coalesced=()):
+    report = {}
+    for history_id, job in targets:
+        report.setdefault(str(history_id), []).append({"endpoint": job[0], "result": results.get(job, "timeout")})
+    for history_id in coalesced:
+        report.setdefault(str(history_id), []).append({"endpoint": None, "result": "aborted"})
+    return {"status": "Success", "results": report}
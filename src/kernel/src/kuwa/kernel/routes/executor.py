@@ -4,41 +4,62 @@ import time, os, subprocess
 from textwrap import dedent
 from datetime import datetime
 from urllib.parse import urlparse
-from flask import Blueprint, request, json, redirect, url_for, jsonify, Response, stream_with_context
+from flask import Blueprint, request, json, redirect, url_for, jsonify, Response, stream_with_context, current_app
 from ..variable import *
-from ..functions import save_variable_to_file, endpoint_formatter, get_base_url, load_records
+from ..functions import endpoint_formatter, get_base_url, load_records
+from ..health import prober
+from ..model_cache import model_cache
+from ..executor_pool import executor_pool
+from ..autoscaler import autoscaler, ScalingPolicy
+from ..federation import federation
+from .chat import schedule_job
 executor = Blueprint('executor', __name__)
 
 logger = logging.getLogger(__name__)
 
 @executor.route("/schedule", methods=["POST"])
 def status():
-    # This will check if any LLM that is READY, then return "READY", if every is busy, return "BUSY"
-    # Parameters: name, history_id, user_id
+    # This will check if any LLM that is READY, then return "READY", if every is busy,
+    # wait in the queue of the LLM for at most max_wait seconds, then return "BUSY".
+    # The executor that served the same session_id (or history_id) is preferred, and waited for up to --affinity_wait seconds.
+    # Parameters: name, history_id, user_id, max_wait (optional), session_id (optional)
     llm_name, history_id, user_id = request.form.get("name"), request.form.get("history_id"), request.form.get("user_id")
     if llm_name and history_id:
-        if data.get(llm_name):
-            for i in data[llm_name]:
-                if i[1] == "READY" and i[2] == -1 and i[3] == -1:
-                    i[2] = history_id
-                    i[3] = user_id
-                    logger.info(f"Scheduled {llm_name},{i[0]} for {history_id},{user_id}")
-                    return "READY"
-        else:
+        state = schedule_job(request.form, current_app.config)
+        if state == "READY":
+            logger.info(f"Scheduled {llm_name} for {history_id},{user_id}")
+            return "READY"
+        elif state == "NOMACHINE":
             logger.warning(f"No machine for {llm_name} has founded, returning NOMACHINE code")
             return "NOMACHINE"
     logger.warning(f"No READY machine for {llm_name}, returning BUSY code")
     return "BUSY"
    
+@executor.route("/queue", methods=["GET"])
+def queue_status():
+    # Return the queue length of the LLM, and the position and waiting time of the job if it's in the queue
+    # Parameters: name, history_id (optional), user_id (optional)
+    llm_name, history_id, user_id = request.args.get("name"), request.args.get("history_id"), request.args.get("user_id")
+    if not llm_name:
+        return jsonify({"error": "name parameter is required"}), 400
+    return jsonify(data.queue_status(llm_name, history_id, user_id)), 200
+
 @executor.route("/register", methods=["POST"])
 def register():
     # For Online LLM register themself
-    # Parameters: name, endpoint
+    # Parameters: name, endpoint, capacity (optional, the number of concurrent requests it can serve)
     llm_name, endpoint = request.form.get("name"), request.form.get("endpoint")
-    if endpoint == None or llm_name == None or endpoint_formatter(endpoint) in [j[0] for j in data.get(llm_name, [])]: return "Failed"
-    data.setdefault(llm_name, []).append([endpoint_formatter(endpoint), "READY", -1, -1])
-    save_variable_to_file(record_file, data)
-    logger.info(f"A new {llm_name} is registered at {endpoint}")
+    try:
+        capacity = int(request.form.get("capacity", 1))
+    except ValueError:
+        return "Failed"
+    if endpoint == None or llm_name == None or not data.register(llm_name, endpoint_formatter(endpoint), capacity): return "Failed"
+    store.add(llm_name, endpoint_formatter(endpoint), capacity)
+    federation.register(llm_name, endpoint_formatter(endpoint), capacity)
+    if llm_name.startswith("hf/"):
+        model_cache.touch("models--" + llm_name[len("hf/"):])
+    executor_pool.on_register(llm_name, endpoint_formatter(endpoint))
+    logger.info(f"A new {llm_name} is registered at {endpoint} with capacity {capacity}")
     return "Success"
 
 @executor.route("/unregister", methods=["POST"])
@@ -47,11 +68,11 @@ def unregister():
     # Parameters: name, endpoint
     llm_name, endpoint = request.form.get("name"), get_base_url(request.form.get("endpoint"))
     if llm_name in data:
-        old = len(data[llm_name])
-        data[llm_name] = [i for i in data[llm_name] if get_base_url(i[0]) != endpoint]
-        if data[llm_name] == []: del data[llm_name]
-        if data.get(llm_name) == None or old != len(data[llm_name]):
-            save_variable_to_file(record_file, data)
+        removed = data.unregister(llm_name, lambda i: get_base_url(i) == endpoint)
+        if removed:
+            for i in {slot[0] for slot in removed}:
+                store.remove(llm_name, i)
+                federation.unregister(llm_name, i)
             logger.info(f"{llm_name} , {endpoint} just unregistered from agent")
             return "Success"
     logger.warning(f"{llm_name} , {endpoint} failed to unregister")
@@ -61,11 +82,14 @@ def unregister():
 def debug():
     # This route is for debugging
     if request.method == 'POST':
-        load_records(json.loads(request.form.get('data')), True)
+        records = json.loads(request.form.get('data'))
+        load_records(records, True)
+        registrations = data.registrations()
+        store.replace({k: registrations.get(k, {}) for k in records.keys()})
         return redirect(url_for('executor.debug'))
     if request.headers.get("Accept") == "application/json":
         exported_data = {}
-        for access_code, group in data.items():
+        for access_code, group in data.snapshot().items():
             exported_group = []
             for executor in group:
                 exported_group.append({
@@ -85,11 +109,11 @@ def debug():
             document.querySelector("textarea").style.height = 'auto';
             document.querySelector("textarea").style.height = (document.querySelector("textarea").scrollHeight) + 'px';
         </script>
-        """).format(str(json.dumps(data, indent=2)))
+        """).format(str(json.dumps(data.snapshot(), indent=2)))
 
 @executor.route("/list", methods=["GET"])
 def list_executor():
-    return jsonify(list(data.keys()))
+    return jsonify(data.access_codes())
 
 @executor.route("/shutdown", methods=["POST"])
 def shutdown_executor():
@@ -114,24 +138,41 @@ def shutdown_executor():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@executor.route("/autoscale", methods=["GET", "POST", "DELETE"])
+def autoscale():
+    # GET: Return the autoscaling policies and the replicas they started
+    # POST: Set the policy of an access code, the JSON fields are
+    #       access_code, executor, argv, min_replicas, max_replicas, target_queue_depth and scale_down_idle_sec
+    # DELETE: Remove the policy of the access_code, the running replicas are kept
+    if request.method == "GET":
+        return jsonify(autoscaler.status()), 200
+    request_data = request.get_json(silent=True) or {}
+    if request.method == "DELETE":
+        if autoscaler.remove_policy(request_data.get("access_code")):
+            return jsonify({"status": "success"}), 200
+        return jsonify({"status": "error", "message": "No policy founded"}), 404
+    try:
+        policy = ScalingPolicy.from_dict(request_data)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    autoscaler.set_policy(policy)
+    return jsonify({"status": "success", "policy": policy.export()}), 200
+
+@executor.route("/health", methods=["GET"])
+def health_status():
+    # Return the circuit state of the executors that failed the health check
+    return jsonify(prober.status()), 200
+
 @executor.route("/read", methods=["GET"])
 def read_executor():
-    return jsonify(data), 200
+    return jsonify(data.snapshot()), 200
 
 def find_and_pop_record(access_code, endpoint, status, history_id, user_id, pop=False):
     """
     Find the first record in the data for the given access code and endpoint.
     If pop is True, delete the record from the data before returning it.
     """
-    if access_code in data:
-        for index, record in enumerate(data[access_code]):
-            if record == [endpoint, status, history_id, user_id]:
-                # Found the record
-                if pop:
-                    # Delete the record if pop is True
-                    return data[access_code].pop(index)  # This deletes the record and returns it
-                return record  # Just return the record without deleting
-    return None  # Return None if no record was found
+    return data.find(access_code, [endpoint, status, history_id, user_id], pop=pop)
 
 
 @executor.route("/update", methods=["POST"])
@@ -156,13 +197,11 @@ def update_executor():
 
         # If record was found and deleted
         if original_record is not None:
-            # If the new access code doesn't exist, create it
-            if new_access_code not in data:
-                data[new_access_code] = []
-
             # Insert the new record into the correct access code
             new_record = [new_endpoint, new_status, int(new_history_id), int(new_user_id)]
-            data[new_access_code].append(new_record)
+            data.add(new_access_code, new_record)
+            registrations = data.registrations()
+            store.replace({k: registrations.get(k, {}) for k in {original_access_code, new_access_code}})
 
             return jsonify({"status": "success", "message": "Record updated successfully"}), 200
         else:
@@ -0,0 +1,9 @@
+from flask import Blueprint, Response
+from ..variable import *
+from ..metrics import metrics
+
+prometheus = Blueprint('prometheus', __name__)
+
+@prometheus.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.generate_latest(data), mimetype="text/plain")
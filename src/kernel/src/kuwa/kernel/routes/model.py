@@ -1,13 +1,20 @@
 import os
+import json
+import queue
+import logging
 import threading
 import time
 import subprocess
 import shutil
 from datetime import datetime
 from flask import Blueprint, request, jsonify, Response, stream_with_context
+from ..variable import download_jobs, download_workers, download_max_bytes_per_sec
+from ..downloader import ModelDownloader, DownloadAborted, format_event
+from ..model_cache import model_cache, folder_of
+from ..executor_pool import executor_pool
 
 model = Blueprint('model', __name__)
-download_jobs = {}
+logger = logging.getLogger(__name__)
 
 def ensure_cache_directory():
     cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "huggingface", "hub")
@@ -23,43 +30,40 @@ def clean_up_partial_download(model_name):
     except Exception as e:
         print(f"Error during cleanup: {e}")
 
-def capture_output(pipe, output_list, stop_event):
-    for line in iter(pipe.readline, ""):
-        if stop_event.is_set():
-            pipe.close()
-            break
-        output_list.append(line.strip())
-    pipe.close()
-
-def download_model_cli(model_name, result_list, stop_event):
-    cache_dir = ensure_cache_directory()
-    command = ["huggingface-cli", "download", model_name, "--cache-dir", cache_dir]
-    result_list.append("Executing: " + " ".join(command))
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1)
-    download_jobs[model_name]['process'] = process
-
-    stdout_thread = threading.Thread(target=capture_output, args=(process.stdout, result_list, stop_event))
-    stderr_thread = threading.Thread(target=capture_output, args=(process.stderr, result_list, stop_event))
-    stdout_thread.start()
-    stderr_thread.start()
-
+def download_model_native(model_name, revision, events, stop_event, max_bytes_per_sec=None):
+    downloader = ModelDownloader(
+        cache_dir=ensure_cache_directory(),
+        max_workers=download_workers,
+        max_bytes_per_sec=max_bytes_per_sec or download_max_bytes_per_sec,
+    )
+    completed = []
+    def on_event(event):
+        if event["event"] == "progress":
+            download_jobs[model_name]['progress'] = event
+        if event["event"] == "complete":
+            # Postponed until the model cache is updated
+            completed.append(event)
+            return
+        events.put(event)
     try:
-        process.wait()
+        downloader.download(model_name, revision=revision, stop_event=stop_event, on_event=on_event)
+        model_cache.refresh(folder_of(model_name))
+        model_cache.touch(folder_of(model_name))
+        evicted = model_cache.evict(protected=(folder_of(model_name),))
+        if evicted:
+            events.put({"event": "evicted", "model_name": model_name, "folders": evicted})
+        events.put(completed[0])
+    except DownloadAborted:
+        events.put({"event": "aborted", "model_name": model_name})
     except Exception as e:
-        result_list.append(f"Process error: {e}")
-
-    stdout_thread.join()
-    stderr_thread.join()
-
-    if not stop_event.is_set():
-        result_list.append(f"Model downloaded and cached at: {cache_dir}")
-    else:
-        clean_up_partial_download(model_name)
-
-    del download_jobs[model_name]
+        logger.exception(f"Failed to download {model_name}")
+        events.put({"event": "error", "model_name": model_name, "msg": str(e)})
+    finally:
+        del download_jobs[model_name]
 
 @model.route("/abort", methods=["POST"])
 def stop_download():
+    # The partial download is kept to be resumed unless clean_up is true
     model_name = request.json.get("model_name")
     if not model_name or model_name not in download_jobs:
         return jsonify({"error": "Valid model_name parameter is required"}), 400
@@ -67,12 +71,12 @@ def stop_download():
     job_details = download_jobs[model_name]
     job_details['stop_event'].set()
 
-    if job_details['process']:
-        job_details['process'].terminate()
-
-    clean_up_partial_download(model_name)
+    if request.json.get("clean_up", False):
+        job_details['thread'].join()
+        clean_up_partial_download(model_name)
+        return jsonify({"message": f"Download job for model '{model_name}' is stopped and cleaned up."}), 200
 
-    return jsonify({"message": f"Download job for model '{model_name}' is being stopped and cleaned up."}), 200
+    return jsonify({"message": f"Download job for model '{model_name}' is being stopped, it will be resumed on the next download."}), 200
 
 @model.route("/remove", methods=["POST"])
 def remove_model():
@@ -87,60 +91,93 @@ def remove_model():
         return jsonify({"error": f"Model '{folder_name}' does not exist."}), 404
     
     try:
-        shutil.rmtree(base_model_dir)
-        # Clean up any associated locks
-        lock_dir = os.path.join(os.path.expanduser("~"), ".cache", "huggingface", "hub", ".locks", folder_name)
-        if os.path.exists(lock_dir):
-            shutil.rmtree(lock_dir)
-        
+        model_cache.remove(folder_name)
         return jsonify({"message": f"Model '{folder_name}' has been removed successfully."}), 200
     except Exception as e:
         return jsonify({"error": f"Failed to remove model '{folder_name}': {str(e)}"}), 500
 
 @model.route("/start", methods=["POST"])
 def start_model():
+    # Start an executor serving the model, a warm executor from the pool is used if available.
+    # Return the job immediately, its readiness can be followed through /start/<job_id>
     model_path = request.json.get("model_path")
     if not model_path:
         return jsonify({"error": "model_path parameter is required"}), 400
 
-    # Base command and optional parameters
-    command = ["kuwa-executor", "huggingface", "--access_code", "hf/" + model_path.replace('/','--')]
+    # Base arguments and optional parameters
+    access_code = "hf/" + model_path.replace('/','--')
+    argv = ["--access_code", access_code]
     for arg in ["model_path", "visible_gpu", "limit", "timeout"]:
         value = request.json.get(arg)
         if value is not None:
-            command.extend([f"--{arg}", str(value)])
+            argv.extend([f"--{arg}", str(value)])
+
+    model_cache.touch(folder_of(model_path))
+
+    job = executor_pool.start(access_code, argv)
+    return jsonify({
+        "message": f"Model '{model_path}' is starting.",
+        "job_id": job.id,
+        "access_code": access_code,
+    }), 202
+
+@model.route("/start/<job_id>", methods=["GET"])
+def start_status(job_id):
+    # Return the state and the events of the start job.
+    # Parameters: stream (optional, stream the events as JSON lines until the job is ready or failed)
+    job = executor_pool.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Start job '{job_id}' does not exist."}), 404
+    if request.args.get("stream", "false").lower() != "true":
+        return jsonify(job.export()), 200
 
-    # Attempt to start the process
-    try:
-        process = subprocess.Popen(
-            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True
-        )
-        stdout, stderr = process.communicate()
-        if process.returncode != 0:
-            return jsonify({"error": f"Failed to start model '{model_path}': {stderr.decode().strip()}"}), 500
-        return jsonify({"message": f"Model '{model_path}' has been started successfully."}), 200
-    except Exception as e:
-        return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
+    def generate():
+        since = 0
+        while True:
+            events = job.wait_events(since, timeout=1)
+            if not events:
+                yield "\n"
+                continue
+            since += len(events)
+            for event in events:
+                yield json.dumps(event) + "\n"
+            if events[-1]["event"] in job.TERMINAL_STATES: break
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 @model.route("/", methods=["GET"])
 def list_models():
-    cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "huggingface", "hub")
-    cached_models = [
-        d for d in os.listdir(cache_dir) 
-        if os.path.isdir(os.path.join(cache_dir, d)) and not d.startswith('.')
-    ] if os.path.exists(cache_dir) else []
-    
-    downloading_models = {
-        "models--" + model_name.replace("/", "--") 
-        for model_name in download_jobs.keys()
-    }
-    
-    available_models = [model for model in cached_models if model not in downloading_models]
+    # List the cached models from the index, the details include the size,
+    # revisions, last used time and the executors using each model.
+    # The partially downloaded models are only listed in the details.
+    # Parameters: refresh (optional, rescan the cache directory)
+    if request.args.get("refresh", "false").lower() == "true":
+        model_cache.rescan()
+
+    downloading_models = {folder_of(model_name) for model_name in download_jobs.keys()}
+    details = [i for i in model_cache.list() if i["folder"] not in downloading_models]
     
-    return jsonify(models=sorted(available_models)), 200
+    return jsonify(
+        models=[i["folder"] for i in details if not i["partial"]],
+        details=details,
+        total_size=model_cache.total_size(),
+        quota=model_cache.quota_bytes,
+    ), 200
+
+@model.route("/evict", methods=["POST"])
+def evict_models():
+    # Evict the least-recently-used models that are not in use until the cache is within the quota
+    # Parameters: quota (optional, in bytes, default to the configured quota)
+    quota = (request.get_json(silent=True) or {}).get("quota")
+    if quota is None and model_cache.quota_bytes is None:
+        return jsonify({"error": "No quota is configured"}), 400
+    evicted = model_cache.evict(quota_bytes=quota)
+    return jsonify({"evicted": evicted, "total_size": model_cache.total_size()}), 200
 
 @model.route("/download", methods=["GET"])
 def download_model():
+    # Stream the progress of the download as text lines, or JSON lines if format is "json"
+    # Parameters: model_name, revision (optional), max_bytes_per_sec (optional), format (optional)
     model_name = request.args.get("model_name")
     if not model_name:
         return jsonify({"error": "model_name parameter is required"}), 400
@@ -148,38 +185,42 @@ def download_model():
     if model_name in download_jobs:
         return jsonify({"error": f"Download for model '{model_name}' is already in progress."}), 400
 
-    result_list = []
+    revision = request.args.get("revision", "main")
+    max_bytes_per_sec = request.args.get("max_bytes_per_sec", type=int)
+    as_json = request.args.get("format") == "json"
+    events = queue.Queue()
     stop_event = threading.Event()
     start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
     download_jobs[model_name] = {
-        'result_list': result_list,
         'stop_event': stop_event,
-        'process': None,
         'thread': None,
-        'start_time': start_time
+        'start_time': start_time,
+        'progress': None,
     }
 
-    download_thread = threading.Thread(target=download_model_cli, args=(model_name, result_list, stop_event))
+    download_thread = threading.Thread(
+        target=download_model_native,
+        args=(model_name, revision, events, stop_event, max_bytes_per_sec),
+        daemon=True
+    )
     download_jobs[model_name]['thread'] = download_thread
     download_thread.start()
 
     def generate():
         try:
-            while download_thread.is_alive() or result_list:
-                time.sleep(0.1)
-                if result_list:
-                    yield result_list.pop(0) + "\n"
-                else:
+            while True:
+                try:
+                    event = events.get(timeout=1)
+                except queue.Empty:
                     yield " "
-            if not stop_event.is_set():
-                yield 'Complete!\n'
-            else:
-                yield 'Aborted!\n'
+                    continue
+                yield (json.dumps(event) if as_json else format_event(event)) + "\n"
+                if event["event"] in ("complete", "aborted", "error"): break
+            if not as_json:
+                yield 'Complete!\n' if event["event"] == "complete" else 'Aborted!\n'
         except GeneratorExit:
             stop_event.set()
-            if download_jobs[model_name]['process']:
-                download_jobs[model_name]['process'].terminate()
             download_thread.join()
 
     return Response(stream_with_context(generate()), mimetype='text/plain')
@@ -187,7 +228,7 @@ def download_model():
 @model.route("/jobs", methods=["GET"])
 def list_download_jobs():
     active_jobs = [
-        {"model_name": model_name, "start_time": details['start_time']}
+        {"model_name": model_name, "start_time": details['start_time'], "progress": details['progress']}
         for model_name, details in download_jobs.items()
     ]
     return jsonify({"active_jobs": active_jobs}), 200
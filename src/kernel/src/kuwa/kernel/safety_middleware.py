@@ -1,47 +1,189 @@
 import logging
 import inspect
 import json
+import threading
 import requests
 from typing import List
+from .variable import data, safety_guard_pool_size
+from .functions import abort_url
 
 logger = logging.getLogger(__name__)
 
-def safety_middleware(func, n_max_buffer=50, streaming=True):
-    bypass = True
-    try:
-        from llm_safety_guard import LlmSafetyGuard
-        bypass = False
-    except ImportError:
-        logger.warning('Bypassing safety middleware due to the package "llm-safety-guard" is not installed.')
+# The pools of all the installed middlewares, invalidated after the rules are updated
+pools = []
+
+def safety_middleware(func, n_max_buffer=50, streaming=True, pool_size=safety_guard_pool_size, guard_class=None):
+    if guard_class is None:
+        try:
+            from llm_safety_guard import LlmSafetyGuard as guard_class
+        except ImportError:
+            logger.warning('Bypassing safety middleware due to the package "llm-safety-guard" is not installed.')
+    bypass = guard_class is None
+
+    # Forward path: Flask --[Convert]--> Safety Guard --[Convert]--> Chat completion backend.
+    # Normal return path:  Chat completion backend --> Safety Guard --> Flask
+    # Return path under violation of pre-filter rules:  Safety Guard --> Flask
+    def build():
+        safety_guard = guard_class(n_max_buffer=n_max_buffer, streaming=streaming)
+        local_func = to_safety_guard_signature(func)
+        local_func = safety_guard.guard(local_func)
+        return to_completions_backend_signature(local_func)
+
+    pool = None if bypass else SafetyGuardPool(build, size=pool_size)
+    if pool is not None:
+        pools.append(pool)
 
     def wrap(*args, **kwargs):
-        nonlocal func
         if bypass:
             return func(*args, **kwargs)
-        
-        # Forward path: Flask --[Convert]--> Safety Guard --[Convert]--> Chat completion backend.
-        # Normal return path:  Chat completion backend --> Safety Guard --> Flask
-        # Return path under violation of pre-filter rules:  Safety Guard --> Flask
-        safety_guard = LlmSafetyGuard(n_max_buffer=n_max_buffer, streaming=streaming)
-        local_func = to_safety_guard_signature(func)
-        local_func = safety_guard.guard(local_func)
-        local_func = to_completions_backend_signature(local_func)
-        return local_func(*args, **kwargs)
-    
+
+        guard = pool.acquire()
+        try:
+            result = guard.func(*args, **kwargs)
+        except BaseException:
+            pool.release(guard)
+            raise
+        return release_after_stream(result, lambda: pool.release(guard))
+
     wrap.__signature__ = inspect.signature(func)
+    wrap.bypass = bypass
+    wrap.pool = pool
     return wrap
 
+class PooledGuard:
+    def __init__(self, func, generation):
+        self.func = func
+        self.generation = generation
+
+class SafetyGuardPool:
+    """
+    The warm safety guard instances shared across the requests, each wrapping
+    the backend once. A guard is held by one request until its stream ends,
+    and the pool grows on demand but keeps at most size idle instances.
+    """
+
+    def __init__(self, factory, size):
+        self.factory = factory
+        self.size = size
+        self.idle = []
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def fill(self):
+        """
+        Construct the idle instances ahead of the first requests.
+        """
+        while True:
+            with self.lock:
+                if len(self.idle) >= self.size: return
+                generation = self.generation
+            guard = PooledGuard(self.factory(), generation)
+            with self.lock:
+                if guard.generation != self.generation or len(self.idle) >= self.size: return
+                self.idle.append(guard)
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                # The most recently used instance is the warmest one
+                return self.idle.pop()
+            generation = self.generation
+        return PooledGuard(self.factory(), generation)
+
+    def release(self, guard):
+        with self.lock:
+            if guard.generation == self.generation and len(self.idle) < self.size:
+                self.idle.append(guard)
+
+    def invalidate(self):
+        """
+        Drop the idle instances, the ones in use are dropped when released.
+        """
+        with self.lock:
+            self.generation += 1
+            self.idle.clear()
+
+class ReleasingStream:
+    """
+    Pass the stream through and call release once it's exhausted, failed or
+    closed by the server.
+    """
+
+    def __init__(self, stream, release):
+        self.stream = stream
+        self.release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.stream)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        try:
+            close = getattr(self.stream, "close", None)
+            if close is not None:
+                close()
+        finally:
+            release, self.release = self.release, None
+            if release is not None:
+                release()
+
+def release_after_stream(result, release):
+    """
+    Defer the release to the end of the returned stream, which is either the
+    result itself or the body of a (body, headers) tuple.
+    """
+    if inspect.isgenerator(result) or isinstance(result, ReleasingStream):
+        return ReleasingStream(result, release)
+    if isinstance(result, tuple) and result and inspect.isgenerator(result[0]):
+        return (ReleasingStream(result[0], release), *result[1:])
+    release()
+    return result
+
+class ConvertedHistory(list):
+    """
+    The chat history converted to the OpenAI format, remembering the Kuwa
+    format records and the form it came from, so that it needn't be converted
+    back if the safety guard passes it through.
+    """
+
+    def __init__(self, records, form):
+        super().__init__(
+            {'role': 'assistant' if r['isbot'] else 'user', 'content': r['msg']}
+            for r in records
+        )
+        self.records = records
+        self.form = form
+
+    def unchanged(self):
+        return len(self) == len(self.records) and all(
+            r['content'] == s['msg'] and (r['role'] == 'assistant') == bool(s['isbot'])
+            for r, s in zip(self, self.records)
+        )
+
 def to_safety_guard_signature(func):
     """
     Convert the function signature to the llm-safety-guard compatible one.
     """
 
     def wrap(chat_history:List[dict], model_id:str, *args, **kwargs):
+        form = kwargs.pop("form")
+        # The guard inspects the content, so the backend should decode the stream
+        kwargs["decode"] = True
+        if isinstance(chat_history, ConvertedHistory) and chat_history.form is form \
+                and form.get("name", "") == model_id and chat_history.unchanged():
+            # Fast path: Forward the original form as is
+            return func(form=form, *args, **kwargs)
         chat_history = [
             {'isbot': r['role']=='assistant', 'msg': r['content']}
             for r in chat_history
         ]
-        form = dict(kwargs.pop("form"))
+        form = dict(form)
         form["input"] = json.dumps(chat_history)
         form["name"] = model_id
         return func(form=form, *args, **kwargs)
@@ -57,18 +199,16 @@ def to_completions_backend_signature(func):
         llm_name = form.get("name", "")
         if isinstance(input, str):
             input = json.loads(input)
-        input = [
-            {'role': 'assistant' if r['isbot'] else 'user', 'content': r['msg']}
-            for r in input
-        ]
+        input = ConvertedHistory(input, form)
         def at_exit():
             nonlocal kwargs
             dest = kwargs['dest']
-            requests.get(dest[0] + "/abort", timeout=10)
-            dest[3] = -1
-            dest[2] = -1
-            dest[1] = "READY"
-            print("Done")
+            try:
+                requests.get(abort_url(dest[0], data.request_id_of(dest)), timeout=10)
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Failed to abort {dest[0]}: {e}")
+            # The backend stream never runs if the guard blocks the request
+            data.release(dest, form.get("history_id"), form.get("user_id"))
 
         return func(chat_history=input, model_id=llm_name, at_exit=at_exit, form=form, *args, **kwargs)
     return wrap
@@ -82,4 +222,7 @@ def update_safety_guard():
         from llm_safety_guard import LlmSafetyGuard
         LlmSafetyGuard.update()
     except ImportError:
-        pass
+        return
+    for pool in pools:
+        pool.invalidate()
+        pool.fill()
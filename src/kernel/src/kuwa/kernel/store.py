@@ -0,0 +1,154 @@
+import json, logging, sqlite3, threading
+from .registry import READY, NO_JOB
+
+logger = logging.getLogger(__name__)
+
+class RegistryStore:
+    """
+    Persistent store of the executor registrations backed by SQLite in WAL mode.
+    Each registration or unregistration is a single-row write, so its cost does
+    not grow with the fleet size. Only (access_code, endpoint, capacity) is
+    persisted since the scheduling state is reset on restart anyway.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS executors ("
+                "access_code TEXT NOT NULL, endpoint TEXT NOT NULL, capacity INTEGER NOT NULL DEFAULT 1, "
+                "PRIMARY KEY (access_code, endpoint))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS models ("
+                "folder TEXT PRIMARY KEY, last_used REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS autoscale_policies ("
+                "access_code TEXT PRIMARY KEY, policy TEXT NOT NULL)"
+            )
+        return self.conn
+
+    def add(self, access_code, endpoint, capacity=1):
+        with self.lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO executors (access_code, endpoint, capacity) VALUES (?, ?, ?)",
+                (access_code, endpoint, capacity)
+            )
+        logger.debug(f"Stored {access_code} at {endpoint} with capacity {capacity}")
+
+    def remove(self, access_code, endpoint=None):
+        """
+        Remove the registration, or all registrations of the access code if endpoint is None.
+        """
+        with self.lock:
+            if endpoint is None:
+                self._connect().execute("DELETE FROM executors WHERE access_code = ?", (access_code,))
+            else:
+                self._connect().execute("DELETE FROM executors WHERE access_code = ? AND endpoint = ?", (access_code, endpoint))
+        logger.debug(f"Removed {access_code} at {endpoint} from store")
+
+    def replace(self, registrations, replace_all=False):
+        """
+        Atomically replace the registrations of each access code in
+        {access_code: {endpoint: capacity}}, or the whole store if replace_all is True.
+        """
+        rows = [(k, e, c) for k, v in registrations.items() for e, c in v.items()]
+        with self.lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if replace_all:
+                    conn.execute("DELETE FROM executors")
+                else:
+                    conn.executemany("DELETE FROM executors WHERE access_code = ?", [(k,) for k in registrations.keys()])
+                conn.executemany("INSERT INTO executors (access_code, endpoint, capacity) VALUES (?, ?, ?)", rows)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        logger.info(f"Stored {len(rows)} registrations")
+
+    def import_records(self, records):
+        """
+        Import the legacy {access_code: [slot, ...]} records.
+        """
+        registrations = {}
+        for access_code, slots in records.items():
+            for slot in slots:
+                endpoints = registrations.setdefault(access_code, {})
+                endpoints[slot[0]] = endpoints.get(slot[0], 0) + 1
+        self.replace(registrations, replace_all=True)
+
+    def is_empty(self):
+        with self.lock:
+            return self._connect().execute("SELECT 1 FROM executors LIMIT 1").fetchone() is None
+
+    def load(self):
+        """
+        Return the stored registrations as {access_code: [slot, ...]}.
+        """
+        with self.lock:
+            rows = self._connect().execute("SELECT access_code, endpoint, capacity FROM executors").fetchall()
+        records = {}
+        for access_code, endpoint, capacity in rows:
+            records.setdefault(access_code, []).extend([endpoint, READY, NO_JOB, NO_JOB] for _ in range(capacity))
+        return records
+
+    def touch_model(self, folder, last_used):
+        with self.lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO models (folder, last_used) VALUES (?, ?)",
+                (folder, last_used)
+            )
+
+    def remove_model(self, folder):
+        with self.lock:
+            self._connect().execute("DELETE FROM models WHERE folder = ?", (folder,))
+
+    def model_usage(self):
+        """
+        Return the last used time of the cached models as {folder: timestamp}.
+        """
+        with self.lock:
+            return dict(self._connect().execute("SELECT folder, last_used FROM models").fetchall())
+
+    def save_policy(self, access_code, policy):
+        with self.lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO autoscale_policies (access_code, policy) VALUES (?, ?)",
+                (access_code, json.dumps(policy))
+            )
+
+    def remove_policy(self, access_code):
+        with self.lock:
+            self._connect().execute("DELETE FROM autoscale_policies WHERE access_code = ?", (access_code,))
+
+    def load_policies(self):
+        """
+        Return the autoscaling policies as {access_code: policy}.
+        """
+        with self.lock:
+            rows = self._connect().execute("SELECT access_code, policy FROM autoscale_policies").fetchall()
+        return {access_code: json.loads(policy) for access_code, policy in rows}
+
+    def compact(self):
+        """
+        Checkpoint the write-ahead log into the database file.
+        """
+        with self.lock:
+            if self.conn is None: return
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
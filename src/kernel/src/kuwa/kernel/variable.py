@@ -1,10 +1,27 @@
 import os
+from .registry import ExecutorRegistry
+from .store import RegistryStore
 
 download_jobs = {}
-data = {}
+download_workers = 4
+download_max_bytes_per_sec = None
+model_cache_rescan_interval_sec = 600
+autoscale_interval_sec = 5
+data = ExecutorRegistry()
 record_file = "records.pickle"
+store = RegistryStore("records.db")
+store_compaction_interval_sec = 600
+schedule_max_wait_sec = 30
+affinity_wait_sec = 0
+reservation_timeout_sec = 60
+abort_deadline_sec = 10
+health_check_interval_sec = 10
+federation_sync_interval_sec = 1
+federation_lease_ttl_sec = 600
+coalesce_max_buffer_bytes = 4 * 2**20
 
 # Set following environment variable before importing the Safety Guard client
 os.environ['SAFETY_GUARD_MANAGER_URL'] = 'http://localhost:8000'
 os.environ['SAFETY_GUARD_DETECTOR_URL'] = 'grpc://localhost:50051'
-safety_guard_update_interval_sec = 30
\ No newline at end of file
+safety_guard_update_interval_sec = 30
+safety_guard_pool_size = 16
\ No newline at end of file
@@ -0,0 +1,62 @@
+import time
+import asyncio
+import unittest
+import logging
+from aiohttp import web
+from kuwa.kernel.functions import abort_all
+
+
+class TestAbortFanOut(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        async def abort(request):
+            if request.match_info["request_id"] != "r 1":
+                return web.json_response({"msg": "No process to abort"}, status=404)
+            return web.json_response({"msg": "Aborted"})
+        async def slow_abort(request):
+            await asyncio.sleep(1)
+            return web.json_response({"msg": "Aborted"})
+        app = web.Application()
+        async def abort_all_requests(request):
+            return web.json_response({"msg": "Aborted"})
+        app.router.add_get("/fast/abort/{request_id}", abort)
+        app.router.add_get("/fast/abort", abort_all_requests)
+        app.router.add_get("/slow/abort/{request_id}", slow_abort)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+
+    async def test_results_within_deadline(self):
+        jobs = [(f"{self.base_url}/{i}", "r 1") for i in ("fast", "slow", "missing")]
+        start_time = time.monotonic()
+        results = await abort_all(jobs, deadline=0.5)
+        self.assertLess(time.monotonic() - start_time, 2)
+        self.assertEqual(results[jobs[0]], "aborted")
+        self.assertEqual(results[jobs[1]], "timeout")
+        self.assertEqual(results[jobs[2]], "failed with HTTP 404")
+
+    async def test_abort_the_request_only(self):
+        job = (f"{self.base_url}/fast", "r 2")
+        results = await abort_all([job], deadline=0.5)
+        self.assertEqual(results[job], "failed with HTTP 404")
+
+    async def test_unknown_request_id(self):
+        # The whole executor is aborted
+        job = (f"{self.base_url}/fast", None)
+        results = await abort_all([job], deadline=0.5)
+        self.assertEqual(results[job], "aborted")
+
+    async def test_unreachable(self):
+        job = ("http://127.0.0.1:1/chat", "1")
+        results = await abort_all([job], deadline=1)
+        self.assertEqual(results[job], "unreachable")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,49 @@
+import asyncio
+import unittest
+import logging
+from urllib.parse import urlencode
+from flask import Flask
+from kuwa.kernel.asgi import KernelASGIApp
+from kuwa.kernel.variable import data
+
+
+class PendingSession:
+    """
+    A client session whose requests never get a response.
+    """
+
+    async def post(self, *args, **kwargs):
+        await asyncio.sleep(60)
+
+
+class TestKernelASGIApp(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.app = KernelASGIApp(Flask(__name__), "/v1.0")
+        self.app.session = PendingSession()
+        data.register("asgi", "http://127.0.0.1:1/chat")
+        self.addCleanup(data.unregister, "asgi", lambda endpoint: True)
+
+    async def test_release_on_disconnect(self):
+        body = urlencode({"name": "asgi", "input": "[]", "history_id": "1", "user_id": "1"}).encode()
+        scope = {
+            "type": "http", "method": "POST", "path": "/v1.0/chat/stream",
+            "headers": [(b"content-type", b"application/x-www-form-urlencoded")],
+        }
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+        async def send(message):
+            pass
+        task = asyncio.create_task(self.app(scope, receive, send))
+        await asyncio.sleep(0.1)
+        slot = data.lookup("asgi", "1", "1")
+        self.assertEqual(slot[1], "BUSY")
+        # The client disconnects while the request to the executor is pending
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertTrue(data.is_free(slot))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import unittest
+import logging
+import tempfile
+from kuwa.kernel.registry import ExecutorRegistry
+from kuwa.kernel.store import RegistryStore
+from kuwa.kernel.executor_pool import StartJob
+from kuwa.kernel.autoscaler import Autoscaler, ScalingPolicy
+
+
+class FakeProcess:
+    def __init__(self):
+        self.terminated = False
+
+    def terminate(self):
+        self.terminated = True
+
+
+class FakePool:
+    """
+    Start the jobs without spawning processes, they are made ready by register().
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.jobs = []
+
+    def start(self, access_code, argv, executor=None):
+        job = StartJob(access_code, argv, executor)
+        job.process = FakeProcess()
+        job.emit("loading")
+        self.jobs.append(job)
+        return job
+
+    def register(self, job, endpoint):
+        self.registry.register(job.access_code, endpoint)
+        job.endpoint = endpoint
+        job.emit("ready", endpoint=endpoint)
+
+
+class TestAutoscaler(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = RegistryStore(os.path.join(self.tmp_dir.name, "records.db"))
+        self.registry = ExecutorRegistry()
+        self.pool = FakePool(self.registry)
+        self.autoscaler = Autoscaler(self.registry, self.pool, self.store, kernel_url="http://127.0.0.1:9000/")
+        self.autoscaler.set_policy(ScalingPolicy(
+            "a", executor="debug", min_replicas=1, max_replicas=2, target_queue_depth=1, scale_down_idle_sec=0
+        ))
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp_dir.cleanup()
+
+    def test_min_replicas(self):
+        self.autoscaler.evaluate()
+        self.assertEqual(len(self.pool.jobs), 1)
+        job = self.pool.jobs[0]
+        self.assertEqual(job.executor, "debug")
+        self.assertEqual(job.argv, ["--access_code", "a", "--kernel_url", "http://127.0.0.1:9000/"])
+        # No more replicas while loading
+        self.autoscaler.evaluate()
+        self.assertEqual(len(self.pool.jobs), 1)
+
+    def test_scale_up_on_queue_depth(self):
+        self.autoscaler.evaluate()
+        self.pool.register(self.pool.jobs[0], "http://e1")
+        self.registry.schedule("a", "1", "1")
+        self.registry.enqueue("a", "2", "1")
+        self.autoscaler.evaluate()
+        self.assertEqual(len(self.pool.jobs), 1)
+        self.registry.enqueue("a", "3", "1")
+        self.autoscaler.evaluate()
+        self.assertEqual(len(self.pool.jobs), 2)
+        # Bounded by max_replicas
+        self.pool.register(self.pool.jobs[1], "http://e2")
+        self.registry.enqueue("a", "4", "1")
+        self.registry.enqueue("a", "5", "1")
+        self.autoscaler.evaluate()
+        self.assertEqual(len(self.pool.jobs), 2)
+
+    def test_scale_from_zero(self):
+        self.autoscaler.set_policy(ScalingPolicy("b", min_replicas=0, max_replicas=1))
+        self.autoscaler.evaluate()
+        self.assertEqual([i.access_code for i in self.pool.jobs], ["a"])
+        self.autoscaler.observe("b", "NOMACHINE")
+        self.autoscaler.evaluate()
+        self.assertEqual([i.access_code for i in self.pool.jobs], ["a", "b"])
+
+    def test_scale_down_idle(self):
+        self.autoscaler.evaluate()
+        self.pool.register(self.pool.jobs[0], "http://e1")
+        self.registry.schedule("a", "1", "1")
+        self.registry.enqueue("a", "2", "1")
+        self.registry.enqueue("a", "3", "1")
+        self.autoscaler.evaluate()
+        self.pool.register(self.pool.jobs[1], "http://e2")
+        for history_id in ("1", "2", "3"):
+            slot = self.registry.lookup("a", history_id, "1")
+            if slot is not None: self.registry.release(slot, history_id, "1")
+        # The idle replica is retired, down to min_replicas
+        self.autoscaler.evaluate()
+        self.autoscaler.evaluate()
+        self.assertEqual(len(self.registry.endpoints()), 1)
+        self.assertEqual(sum(i.process.terminated for i in self.pool.jobs), 1)
+        self.autoscaler.evaluate()
+        self.assertEqual(len(self.registry.endpoints()), 1)
+
+    def test_keep_busy_replica(self):
+        self.autoscaler.set_policy(ScalingPolicy("a", min_replicas=0, max_replicas=1, scale_down_idle_sec=0))
+        self.autoscaler.observe("a", "NOMACHINE")
+        self.autoscaler.evaluate()
+        self.pool.register(self.pool.jobs[0], "http://e1")
+        self.registry.schedule("a", "1", "1")
+        self.autoscaler.evaluate()
+        self.assertEqual(self.registry.endpoints(), ["http://e1"])
+
+    def test_policy_persisted(self):
+        autoscaler = Autoscaler(self.registry, self.pool, self.store)
+        autoscaler.load()
+        self.assertEqual(autoscaler.policies["a"].export(), self.autoscaler.policies["a"].export())
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            ScalingPolicy.from_dict({"access_code": "a", "min_replicas": 2, "max_replicas": 1})
+        with self.assertRaises(ValueError):
+            ScalingPolicy.from_dict({"access_code": "a", "unknown": 1})
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
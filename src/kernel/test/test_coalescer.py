@@ -0,0 +1,197 @@
+import json
+import queue
+import unittest
+import logging
+import threading
+from kuwa.kernel.coalescer import Coalescer, parse_parameters, is_deterministic
+
+HEADERS = {"Content-Type": "text/event-stream"}
+
+
+def make_form(msg="hi", modelfile=None, history_id="1"):
+    form = {"name": "a", "input": json.dumps([{"isbot": False, "msg": msg}]), "history_id": history_id, "user_id": "1"}
+    if modelfile is not None:
+        form["modelfile"] = json.dumps(modelfile)
+    return form
+
+
+def upstream(chunks):
+    """
+    A stream yielding the chunks put into the queue until None.
+    """
+    def stream():
+        while (c := chunks.get()) is not None:
+            yield c
+    return stream()
+
+
+class TestCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.coalescer = Coalescer(access_codes=["a"], max_buffer_bytes=1024)
+
+    def test_key(self):
+        key = self.coalescer.key(make_form("hi"))
+        self.assertIsNotNone(key)
+        self.assertEqual(self.coalescer.key(make_form(" hi\n", history_id="2")), key)
+        self.assertNotEqual(self.coalescer.key(make_form("hello")), key)
+        self.assertNotEqual(self.coalescer.key(make_form("hi"), language="en"), key)
+        self.assertIsNone(self.coalescer.key({**make_form(), "name": "b"}))
+        self.assertIsNone(self.coalescer.key({**make_form(), "input": "not json"}))
+
+    def test_deterministic_parameters(self):
+        def parameter(args): return [{"name": "parameter", "args": args}]
+        self.assertIsNotNone(self.coalescer.key(make_form(modelfile=parameter("llm_max_new_tokens 100"))))
+        self.assertIsNone(self.coalescer.key(make_form(modelfile=parameter("llm_temperature 0.7"))))
+        self.assertIsNotNone(self.coalescer.key(make_form(modelfile=parameter("llm_temperature 0"))))
+        self.assertIsNone(self.coalescer.key(make_form(modelfile=parameter("llm_do_sample true"))))
+        self.assertTrue(is_deterministic(parse_parameters(
+            parameter("llm_do_sample false") + parameter("llm_top_p 0.9 # ignored by the greedy decoding")
+        )))
+
+    def test_fan_out(self):
+        key = self.coalescer.key(make_form())
+        leader, token = self.coalescer.flight(key)
+        self.assertIsNone(token)
+        chunks = queue.Queue()
+        chunks.put(b"data: 1\n")
+        stream, headers = leader.lead((upstream(chunks), HEADERS))
+        self.assertEqual(next(stream), b"data: 1\n")
+
+        follower, token = self.coalescer.flight(key)
+        self.assertIs(follower, leader)
+        replay, follower_headers = follower.follow(token)
+        self.assertEqual(follower_headers, HEADERS)
+        late = self.coalescer.follow(key)
+
+        chunks.put(b"data: 2\n")
+        chunks.put(None)
+        self.assertEqual(list(stream), [b"data: 2\n"])
+        self.assertEqual(list(replay), [b"data: 1\n", b"data: 2\n"])
+        self.assertEqual(list(late[0]), [b"data: 1\n", b"data: 2\n"])
+        # The finished flight is not joined again
+        self.assertIsNone(self.coalescer.follow(key))
+        self.assertEqual(leader.chunks, [])
+
+    def test_wait_for_leader(self):
+        key = self.coalescer.key(make_form())
+        leader, _ = self.coalescer.flight(key)
+        results = []
+        follower = threading.Thread(target=lambda: results.append(self.coalescer.follow(key)))
+        follower.start()
+        while not leader.cursors: pass
+        chunks = queue.Queue()
+        stream, _ = leader.lead((upstream(chunks), HEADERS))
+        chunks.put(b"data: 1\n")
+        chunks.put(None)
+        self.assertEqual(list(stream), [b"data: 1\n"])
+        follower.join()
+        self.assertEqual(list(results[0][0]), [b"data: 1\n"])
+
+    def test_leader_failed(self):
+        key = self.coalescer.key(make_form())
+        leader, _ = self.coalescer.flight(key)
+        results = []
+        follower = threading.Thread(target=lambda: results.append(self.coalescer.follow(key)))
+        follower.start()
+        while not leader.cursors: pass
+        self.assertEqual(leader.lead(""), "")
+        follower.join()
+        self.assertEqual(results, [None])
+        self.assertNotIn(key, self.coalescer.flights)
+
+    def test_leader_disconnected(self):
+        key = self.coalescer.key(make_form())
+        leader, _ = self.coalescer.flight(key)
+        chunks = queue.Queue()
+        stream, _ = leader.lead((upstream(chunks), HEADERS))
+        replay, _ = self.coalescer.follow(key)
+        chunks.put(b"data: 1\n")
+        self.assertEqual(next(stream), b"data: 1\n")
+        stream.close()
+        chunks.put(b"data: 2\n")
+        chunks.put(None)
+        self.assertEqual(list(replay), [b"data: 1\n", b"data: 2\n"])
+
+    def test_bounded_buffer(self):
+        key = self.coalescer.key(make_form())
+        leader, _ = self.coalescer.flight(key)
+        chunks = queue.Queue()
+        stream, _ = leader.lead((upstream(chunks), HEADERS))
+        replay, _ = self.coalescer.follow(key)
+        chunks.put(b"x" * 1000)
+        chunks.put(b"y" * 1000)
+        next(stream), next(stream)
+        # The buffer is full, no more followers can join
+        self.assertIsNone(self.coalescer.follow(key))
+        self.assertEqual(next(replay), b"x" * 1000)
+        self.assertEqual(next(replay), b"y" * 1000)
+        self.assertEqual(leader.size, 0)
+        replay.close()
+        chunks.put(None)
+        self.assertEqual(list(stream), [])
+
+    def test_unused_replay(self):
+        key = self.coalescer.key(make_form())
+        leader, _ = self.coalescer.flight(key)
+        leader.lead((upstream(queue.Queue()), HEADERS))
+        replay, _ = self.coalescer.follow(key)
+        replay.close()
+        self.assertEqual(leader.cursors, {})
+
+    def test_abort_leader(self):
+        key = self.coalescer.key(make_form())
+        leader, _ = self.coalescer.flight(key, ("1", "1"))
+        chunks = queue.Queue()
+        closed = threading.Event()
+        def source():
+            try:
+                yield from upstream(chunks)
+            finally:
+                closed.set()
+        stream, _ = leader.lead((source(), HEADERS))
+        replay, _ = self.coalescer.follow(key, ("2", "1"))
+        chunks.put(b"data: 1\n")
+        self.assertEqual(next(stream), b"data: 1\n")
+        self.assertTrue(self.coalescer.abort(("1", "1")))
+        chunks.put(b"data: 2\n")
+        # The leader stops while the follower keeps the upstream
+        self.assertEqual(list(stream), [])
+        self.assertFalse(closed.is_set())
+        self.assertEqual([next(replay), next(replay)], [b"data: 1\n", b"data: 2\n"])
+        # The upstream is closed once the last follower is aborted
+        self.assertTrue(self.coalescer.abort(("2", "1")))
+        self.assertEqual(list(replay), [])
+        chunks.put(b"data: 3\n")
+        self.assertTrue(closed.wait(1))
+        self.assertNotIn(("1", "1"), self.coalescer.jobs)
+
+    def test_abort_follower(self):
+        key = self.coalescer.key(make_form())
+        leader, _ = self.coalescer.flight(key, ("1", "1"))
+        chunks = queue.Queue()
+        stream, _ = leader.lead((upstream(chunks), HEADERS))
+        replay, _ = self.coalescer.follow(key, ("2", "1"))
+        results = []
+        follower = threading.Thread(target=lambda: results.extend(replay))
+        follower.start()
+        self.assertTrue(self.coalescer.abort(("2", "1")))
+        follower.join(1)
+        self.assertFalse(follower.is_alive())
+        chunks.put(b"data: 1\n")
+        chunks.put(None)
+        self.assertEqual(list(stream), [b"data: 1\n"])
+        self.assertEqual(results, [])
+
+    def test_abort_alone(self):
+        key = self.coalescer.key(make_form())
+        leader, _ = self.coalescer.flight(key, ("1", "1"))
+        leader.lead((upstream(queue.Queue()), HEADERS))
+        # The upstream is aborted on the executor, so no follower can join it
+        self.assertFalse(self.coalescer.abort(("1", "1")))
+        self.assertIsNone(self.coalescer.follow(key))
+        self.assertFalse(self.coalescer.abort(("3", "1")))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
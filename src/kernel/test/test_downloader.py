@@ -0,0 +1,192 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import unittest
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from kuwa.kernel.downloader import ModelDownloader, DownloadAborted, ChecksumError
+
+REPO_ID = "org/model"
+COMMIT = "0123456789abcdef0123456789abcdef01234567"
+
+class HubStandIn(BaseHTTPRequestHandler):
+    """
+    A minimal stand-in of the Hugging Face Hub API serving an in-memory repository.
+    """
+    files = {}
+    corrupted = set()
+    unchecked = set()  # Files listed without their checksum
+    ranges = True
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        type(self).requests.append((self.path, self.headers.get("Range")))
+        if self.path.startswith(f"/api/models/{REPO_ID}/revision/"):
+            siblings = []
+            for name, content in self.files.items():
+                if name in self.unchecked:
+                    siblings.append({"rfilename": name})
+                elif name.endswith(".bin"):
+                    siblings.append({"rfilename": name, "lfs": {"sha256": hashlib.sha256(content).hexdigest(), "size": len(content)}})
+                else:
+                    blob_id = hashlib.sha1(f"blob {len(content)}\0".encode() + content).hexdigest()
+                    siblings.append({"rfilename": name, "blobId": blob_id, "size": len(content)})
+            return self.reply(200, json.dumps({"sha": COMMIT, "siblings": siblings}).encode())
+        prefix = f"/{REPO_ID}/resolve/{COMMIT}/"
+        name = self.path[len(prefix):]
+        if not self.path.startswith(prefix) or name not in self.files:
+            return self.reply(404, b"")
+        content = self.files[name]
+        if name in self.corrupted:
+            content = content[:-1] + b"?"
+        range_header = self.headers.get("Range")
+        if range_header and self.ranges:
+            start, _, end = range_header[len("bytes="):].partition("-")
+            start, end = int(start), int(end) + 1 if end else len(content)
+            if start >= len(content):
+                return self.reply(416, b"")
+            return self.reply(206, content[start:end])
+        self.reply(200, content)
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestModelDownloader(unittest.TestCase):
+    def setUp(self):
+        HubStandIn.files = {
+            "config.json": b'{"model_type": "llama"}',
+            "model.bin": os.urandom(300 * 1024),
+            "tokenizer/vocab.txt": b"a\nb\nc\n",
+        }
+        HubStandIn.corrupted = set()
+        HubStandIn.unchecked = set()
+        HubStandIn.ranges = True
+        HubStandIn.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), HubStandIn)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.downloader = ModelDownloader(
+            cache_dir=self.tmp_dir.name,
+            endpoint=f"http://127.0.0.1:{self.server.server_port}",
+            token="",
+            chunk_size=16 * 1024,
+            progress_interval_sec=0,
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def blob_path(self, name):
+        content = HubStandIn.files[name]
+        return os.path.join(self.downloader.repo_dir(REPO_ID), "blobs", hashlib.sha256(content).hexdigest())
+
+    def test_download(self):
+        events = []
+        path = self.downloader.download(REPO_ID, on_event=events.append)
+        for name, content in HubStandIn.files.items():
+            with open(os.path.join(path, name), "rb") as f:
+                self.assertEqual(f.read(), content)
+        with open(os.path.join(self.downloader.repo_dir(REPO_ID), "refs", "main")) as f:
+            self.assertEqual(f.read(), COMMIT)
+        total = sum(len(i) for i in HubStandIn.files.values())
+        self.assertEqual(events[0]["event"], "start")
+        self.assertEqual(events[0]["total_bytes"], total)
+        self.assertEqual(events[-1]["event"], "complete")
+        progress = [i for i in events if i["event"] == "progress"]
+        self.assertEqual(progress[-1]["downloaded_bytes"], total)
+
+        # Downloading again is a no-op
+        HubStandIn.requests = []
+        self.downloader.download(REPO_ID)
+        self.assertEqual(len(HubStandIn.requests), 1)
+
+    def test_resume(self):
+        content = HubStandIn.files["model.bin"]
+        os.makedirs(os.path.dirname(self.blob_path("model.bin")))
+        with open(self.blob_path("model.bin") + ".incomplete", "wb") as f:
+            f.write(content[:100 * 1024])
+        path = self.downloader.download(REPO_ID)
+        with open(os.path.join(path, "model.bin"), "rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertIn((f"/{REPO_ID}/resolve/{COMMIT}/model.bin", f"bytes={100 * 1024}-"), HubStandIn.requests)
+
+    def test_checksum_mismatch(self):
+        HubStandIn.corrupted = {"model.bin"}
+        with self.assertRaises(ChecksumError):
+            self.downloader.download(REPO_ID)
+        self.assertFalse(os.path.exists(self.blob_path("model.bin")))
+        self.assertFalse(os.path.exists(self.blob_path("model.bin") + ".incomplete"))
+
+    def test_abort_keeps_partial_blob(self):
+        stop_event = threading.Event()
+        def on_event(event):
+            if event["event"] == "progress" and event["downloaded_bytes"] > 64 * 1024:
+                stop_event.set()
+        self.downloader.limiter.rate = 256 * 1024
+        with self.assertRaises(DownloadAborted):
+            self.downloader.download(REPO_ID, stop_event=stop_event, on_event=on_event)
+        self.assertFalse(os.path.exists(self.blob_path("model.bin")))
+        self.assertTrue(os.path.exists(self.blob_path("model.bin") + ".incomplete"))
+
+    def test_unchecked_file_in_directory(self):
+        HubStandIn.unchecked = {"tokenizer/vocab.txt"}
+        path = self.downloader.download(REPO_ID)
+        with open(os.path.join(path, "tokenizer", "vocab.txt"), "rb") as f:
+            self.assertEqual(f.read(), HubStandIn.files["tokenizer/vocab.txt"])
+
+    def test_shared_blob(self):
+        HubStandIn.files["copy/model.bin"] = HubStandIn.files["model.bin"]
+        path = self.downloader.download(REPO_ID)
+        for name in ("model.bin", "copy/model.bin"):
+            with open(os.path.join(path, name), "rb") as f:
+                self.assertEqual(f.read(), HubStandIn.files["model.bin"])
+        # The blob is fetched once
+        self.assertEqual(len([p for p, _ in HubStandIn.requests if p.endswith("model.bin")]), 1)
+
+    def test_segmented(self):
+        self.downloader.segment_size = 64 * 1024
+        content = HubStandIn.files["model.bin"]
+        # The second segment is resumed
+        os.makedirs(os.path.dirname(self.blob_path("model.bin")))
+        with open(self.blob_path("model.bin") + ".incomplete.1", "wb") as f:
+            f.write(content[64 * 1024:80 * 1024])
+        events = []
+        path = self.downloader.download(REPO_ID, on_event=events.append)
+        with open(os.path.join(path, "model.bin"), "rb") as f:
+            self.assertEqual(f.read(), content)
+        ranges = [r for p, r in HubStandIn.requests if p.endswith("/model.bin")]
+        self.assertEqual(len(ranges), 5)
+        self.assertIn(f"bytes={80 * 1024}-{128 * 1024 - 1}", ranges)
+        self.assertEqual([i for i in os.listdir(os.path.dirname(self.blob_path("model.bin"))) if "incomplete" in i], [])
+        self.assertEqual(events[-2]["downloaded_bytes"], sum(len(i) for i in HubStandIn.files.values()))
+
+    def test_segmented_checksum_mismatch(self):
+        self.downloader.segment_size = 64 * 1024
+        HubStandIn.corrupted = {"model.bin"}
+        with self.assertRaises(ChecksumError):
+            self.downloader.download(REPO_ID)
+        self.assertFalse(os.path.exists(self.blob_path("model.bin")))
+        self.assertEqual([i for i in os.listdir(os.path.dirname(self.blob_path("model.bin"))) if "incomplete" in i], [])
+
+    def test_segmented_without_ranges(self):
+        self.downloader.segment_size = 64 * 1024
+        HubStandIn.ranges = False
+        path = self.downloader.download(REPO_ID)
+        with open(os.path.join(path, "model.bin"), "rb") as f:
+            self.assertEqual(f.read(), HubStandIn.files["model.bin"])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,74 @@
+import sys
+import time
+import unittest
+import logging
+from kuwa.kernel.executor_pool import ExecutorPool
+
+# A stand-in of "kuwa-executor" that exits with the code given by --exit after --sleep seconds
+STAND_IN = """
+import sys, json, time
+argv = sys.argv[1:]
+if argv[0] == "warm":
+    print("KUWA_WARM_EXECUTOR_READY", flush=True)
+    line = sys.stdin.readline()
+    if not line: sys.exit(0)
+    argv = json.loads(line)["argv"]
+else:
+    argv = argv[1:]
+print("serving", " ".join(argv), flush=True)
+if "--sleep" in argv: time.sleep(float(argv[argv.index("--sleep") + 1]))
+sys.exit(int(argv[argv.index("--exit") + 1]))
+"""
+
+
+class TestExecutorPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = ExecutorPool(size=1, executor="debug", command=(sys.executable, "-c", STAND_IN))
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def wait_state(self, job, states, timeout=10):
+        deadline = time.monotonic() + timeout
+        while job.state not in states and time.monotonic() < deadline:
+            job.wait_events(len(job.events), timeout=0.1)
+        return job.state
+
+    def test_warm_start(self):
+        self.pool.fill()
+        self.assertTrue(self.pool.idle[0].ready.wait(10))
+        job = self.pool.start("a", ["--exit", "3"])
+        self.assertEqual(self.wait_state(job, ["failed"]), "failed")
+        loading, failed = job.events
+        self.assertTrue(loading["warm"])
+        self.assertEqual(failed["returncode"], 3)
+        self.assertEqual(failed["output"], ["serving --exit 3"])
+
+    def test_cold_start(self):
+        job = self.pool.start("a", ["--exit", "0"])
+        self.assertEqual(self.wait_state(job, ["failed"]), "failed")
+        self.assertFalse(job.events[0]["warm"])
+        self.assertEqual(job.events[1]["output"], ["serving --exit 0"])
+
+    def test_ready_on_register(self):
+        job = self.pool.start("a", ["--sleep", "1", "--exit", "0"])
+        self.assertEqual(self.wait_state(job, ["loading", "failed"]), "loading")
+        self.pool.on_register("a", "http://127.0.0.1:8000/chat")
+        self.assertEqual(self.wait_state(job, ["exited"]), "exited")
+        self.assertEqual([i["event"] for i in job.events], ["loading", "ready", "exited"])
+        self.assertIs(self.pool.get(job.id), job)
+
+    def test_refill(self):
+        self.pool.fill()
+        job = self.pool.start("a", ["--exit", "0"])
+        self.wait_state(job, ["failed"])
+        deadline = time.monotonic() + 10
+        while not (self.pool.idle and self.pool.idle[0].ready.is_set()) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(self.pool.idle), 1)
+        self.assertTrue(self.pool.idle[0].ready.is_set())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
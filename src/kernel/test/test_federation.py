@@ -0,0 +1,146 @@
+import time
+import unittest
+import threading
+import logging
+from kuwa.kernel.registry import ExecutorRegistry
+from kuwa.kernel.federation import Federation, LocalBackend
+
+ENDPOINT = "http://127.0.0.1:8000/chat"
+
+
+class BrokenBackend(LocalBackend):
+    def claim(self, *args, **kwargs):
+        raise ConnectionError("unreachable")
+
+
+class LockCheckingBackend(LocalBackend):
+    """
+    Record whether the registry lock is held while the backend is called.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.registry = None
+        self.locked = []
+
+    def _check(self):
+        # The lock is reentrant, so try it from another thread
+        checker = threading.Thread(target=self._try_lock)
+        checker.start()
+        checker.join()
+
+    def _try_lock(self):
+        acquired = self.registry.lock.acquire(blocking=False)
+        if acquired: self.registry.lock.release()
+        self.locked.append(not acquired)
+
+    def claim(self, *args, **kwargs):
+        self._check()
+        return super().claim(*args, **kwargs)
+
+    def release(self, *args, **kwargs):
+        self._check()
+        return super().release(*args, **kwargs)
+
+
+class TestFederation(unittest.TestCase):
+    def setUp(self):
+        self.backend = LocalBackend()
+        self.registries = [ExecutorRegistry(), ExecutorRegistry()]
+        self.kernels = [Federation(i, self.backend) for i in self.registries]
+
+    def register(self, kernel, access_code="a", endpoint=ENDPOINT, capacity=1):
+        self.registries[kernel].register(access_code, endpoint, capacity)
+        self.kernels[kernel].register(access_code, endpoint, capacity)
+
+    def test_propagate_registration(self):
+        self.register(0)
+        self.assertNotIn("a", self.registries[1])
+        self.kernels[1].sync()
+        self.assertEqual(self.registries[1].registrations(), {"a": {ENDPOINT: 1}})
+
+    def test_share_capacity(self):
+        self.register(0)
+        self.kernels[1].sync()
+        self.assertEqual(self.registries[0].schedule("a", "1", "1"), "READY")
+        self.assertEqual(self.registries[1].schedule("a", "2", "1"), "BUSY")
+
+        waiter = self.registries[1].enqueue("a", "2", "1")
+        self.assertIsNone(waiter.state)
+        self.registries[0].release(self.registries[0].acquire("a", "1", "1"), "1", "1")
+        self.kernels[1].sync()
+        self.assertEqual(waiter.state, "READY")
+        self.assertEqual(self.registries[0].schedule("a", "3", "1"), "BUSY")
+
+    def test_propagate_capacity(self):
+        self.register(0)
+        self.kernels[1].sync()
+        self.registries[0].resize("a", ENDPOINT, 2)
+        self.kernels[0].register("a", ENDPOINT, 2)
+        self.kernels[1].sync()
+        self.assertEqual(self.registries[1].registrations(), {"a": {ENDPOINT: 2}})
+        self.assertEqual(self.registries[1].schedule("a", "1", "1"), "READY")
+        self.assertEqual(self.registries[1].schedule("a", "2", "1"), "READY")
+
+    def test_propagate_unregistration(self):
+        self.register(0)
+        self.kernels[1].sync()
+        self.registries[0].unregister("a", lambda i: i == ENDPOINT)
+        self.kernels[0].unregister("a", ENDPOINT)
+        self.kernels[1].sync()
+        self.assertNotIn("a", self.registries[1])
+
+    def test_lease_expiry(self):
+        for i in self.kernels: i.lease_ttl_sec = 0.05
+        self.register(0)
+        self.kernels[1].sync()
+        # The kernel 0 crashes with the slot reserved
+        self.assertEqual(self.registries[0].schedule("a", "1", "1"), "READY")
+        self.assertEqual(self.registries[1].schedule("a", "2", "1"), "BUSY")
+        time.sleep(0.1)
+        self.assertEqual(self.registries[1].schedule("a", "2", "1"), "READY")
+
+    def test_renew_leases(self):
+        for i in self.kernels: i.lease_ttl_sec = 0.2
+        self.register(0)
+        self.kernels[1].sync()
+        self.assertEqual(self.registries[0].schedule("a", "1", "1"), "READY")
+        for _ in range(4):
+            time.sleep(0.1)
+            self.kernels[0].sync()
+        self.assertEqual(self.registries[1].schedule("a", "2", "1"), "BUSY")
+
+    def test_keep_local_quarantine(self):
+        self.register(0)
+        self.kernels[1].sync()
+        # Quarantined by the health prober of the kernel 1
+        self.registries[1].unregister("a", lambda i: i == ENDPOINT)
+        self.register(0, access_code="b")
+        self.kernels[1].sync()
+        self.assertNotIn("a", self.registries[1])
+        self.assertIn("b", self.registries[1])
+
+    def test_backend_outside_lock(self):
+        backend = LockCheckingBackend()
+        registry = ExecutorRegistry()
+        backend.registry = registry
+        Federation(registry, backend)
+        registry.register("a", ENDPOINT, 1)
+        self.assertEqual(registry.schedule("a", "1", "1"), "READY")
+        waiter = registry.enqueue("a", "2", "1")
+        registry.release(registry.acquire("a", "1", "1"), "1", "1")
+        self.assertEqual(waiter.state, "READY")
+        registry.unregister("a", lambda i: True)
+        self.assertGreaterEqual(len(backend.locked), 4)
+        self.assertFalse(any(backend.locked))
+
+    def test_fail_open(self):
+        kernel = Federation(ExecutorRegistry(), BrokenBackend())
+        kernel.registry.register("a", ENDPOINT, 1)
+        self.assertEqual(kernel.registry.schedule("a", "1", "1"), "READY")
+        self.assertTrue(kernel.degraded)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
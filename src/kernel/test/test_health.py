@@ -0,0 +1,51 @@
+import os
+import unittest
+import logging
+import tempfile
+from kuwa.kernel.registry import ExecutorRegistry
+from kuwa.kernel.health import HealthProber
+
+
+class TestHealthProber(unittest.TestCase):
+    endpoint = "http://127.0.0.1:8000/chat"
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+        self.registry = ExecutorRegistry()
+        self.registry.register("a", self.endpoint, capacity=2)
+        self.registry.register("b", self.endpoint)
+        self.prober = HealthProber(self.registry, failure_threshold=2, retry_interval_sec=0)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+    def test_open_after_threshold(self):
+        self.prober.report(self.endpoint, False)
+        self.assertEqual(self.registry.access_codes(), ["a", "b"])
+        self.prober.report(self.endpoint, False)
+        self.assertEqual(self.registry.access_codes(), [])
+        self.assertEqual(self.prober.status()[self.endpoint]["state"], "open")
+
+    def test_reset_on_success(self):
+        self.prober.report(self.endpoint, False)
+        self.prober.report(self.endpoint, True)
+        self.prober.report(self.endpoint, False)
+        self.assertEqual(self.registry.access_codes(), ["a", "b"])
+
+    def test_restore(self):
+        self.prober.trip(self.endpoint)
+        self.assertEqual(self.registry.access_codes(), [])
+        self.prober.report(self.endpoint, False)
+        self.assertEqual(self.prober.status()[self.endpoint]["state"], "open")
+        self.prober.report(self.endpoint, True)
+        self.assertEqual(self.registry.load_of("a", self.endpoint), (0, 2))
+        self.assertEqual(self.registry.load_of("b", self.endpoint), (0, 1))
+        self.assertEqual(self.prober.status(), {})
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import gzip
+import unittest
+import logging
+import tempfile
+from kuwa.kernel.logger import LargeMessageFilter, QueuedHandler
+
+
+class TestLogger(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, "kernel.log")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def record(self, msg):
+        return logging.LogRecord("test", logging.INFO, __file__, 0, msg, None, None)
+
+    def test_rotate_and_compress(self):
+        handler = QueuedHandler(
+            target="kuwa.kernel.logger.CompressedRotatingFileHandler",
+            filename=self.filename, max_bytes=100, backup_count=2
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        for i in range(10):
+            handler.handle(self.record(f"message {i:02d} " + "x" * 40))
+        handler.close()
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)), ["kernel.log", "kernel.log.1.gz", "kernel.log.2.gz"])
+        with gzip.open(self.filename + ".1.gz", "rt") as f:
+            self.assertIn("message 08", f.read())
+        with open(self.filename) as f:
+            self.assertIn("message 09", f.read())
+
+    def test_rotate_by_time(self):
+        handler = QueuedHandler(
+            target="kuwa.kernel.logger.CompressedRotatingFileHandler",
+            filename=self.filename, interval_sec=0.001, backup_count=1
+        )
+        handler.handle(self.record("first"))
+        handler.listener.stop()
+        handler.target.rollover_at = 0
+        handler.target.handle(self.record("second"))
+        handler.listener = None
+        handler.close()
+        with gzip.open(self.filename + ".1.gz", "rt") as f:
+            self.assertEqual(f.read(), "first\n")
+
+    def test_report_dropped(self):
+        handler = QueuedHandler(queue_size=1)
+        handler.listener.stop()
+        for i in range(3):
+            handler.handle(self.record(f"message {i}"))
+        self.assertEqual(handler.dropped, 2)
+        handler.queue.get_nowait()
+        with self.assertLogs("kuwa.kernel.logger", logging.WARNING) as logs:
+            handler.handle(self.record("message 3"))
+        self.assertIn("2 log records dropped", logs.output[0])
+
+        # The rest is reported on closing
+        handler.handle(self.record("message 4"))
+        records = []
+        last_resort = logging.lastResort
+        logging.lastResort = logging.Handler()
+        logging.lastResort.emit = records.append
+        try:
+            handler.listener = None
+            handler.close()
+        finally:
+            logging.lastResort = last_resort
+        self.assertEqual([i.getMessage() for i in records], [f"1 log records dropped, the queue of {handler.target} is full"])
+
+    def test_large_message(self):
+        large_message_filter = LargeMessageFilter(max_length=10, burst=2, interval_sec=3600)
+        self.assertTrue(large_message_filter.filter(self.record("short")))
+        records = [self.record("y" * 100) for _ in range(4)]
+        self.assertEqual([large_message_filter.filter(i) for i in records], [True, True, False, False])
+        self.assertEqual(records[0].msg, "y" * 10 + "... (90 characters truncated)")
+        # The decision is the same for the other handlers
+        self.assertFalse(large_message_filter.filter(records[2]))
+        large_message_filter.window_start -= 3600
+        record = self.record("z" * 100)
+        self.assertTrue(large_message_filter.filter(record))
+        self.assertTrue(record.msg.endswith("(2 large messages dropped)"))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
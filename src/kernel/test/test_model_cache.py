@@ -0,0 +1,85 @@
+import os
+import unittest
+import logging
+import tempfile
+from kuwa.kernel.registry import ExecutorRegistry
+from kuwa.kernel.store import RegistryStore
+from kuwa.kernel.model_cache import ModelCache
+
+
+class TestModelCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, "hub")
+        self.store = RegistryStore(os.path.join(self.tmp_dir.name, "records.db"))
+        self.registry = ExecutorRegistry()
+        self.cache = ModelCache(self.registry, self.store, cache_dir=self.cache_dir)
+        for name in ["a", "b", "c"]:
+            self.add_model(name, size=1000)
+        self.cache.rescan()
+        for name in ["a", "b", "c"]:
+            self.cache.touch(f"models--org--{name}")
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp_dir.cleanup()
+
+    def add_model(self, name, size):
+        model_dir = os.path.join(self.cache_dir, f"models--org--{name}")
+        os.makedirs(os.path.join(model_dir, "blobs"))
+        os.makedirs(os.path.join(model_dir, "snapshots", "rev"))
+        with open(os.path.join(model_dir, "blobs", "blob"), "wb") as f:
+            f.write(b"0" * size)
+        os.symlink("../../blobs/blob", os.path.join(model_dir, "snapshots", "rev", "model.bin"))
+
+    def test_index(self):
+        models = self.cache.list()
+        self.assertEqual([i["repo_id"] for i in models], ["org/a", "org/b", "org/c"])
+        self.assertEqual(models[0]["size"], 1000)
+        self.assertEqual(models[0]["revisions"], ["rev"])
+        self.assertEqual(self.cache.total_size(), 3000)
+
+    def test_last_used_is_persisted(self):
+        last_used = {i["folder"]: i["last_used"] for i in self.cache.list()}
+        cache = ModelCache(self.registry, self.store, cache_dir=self.cache_dir)
+        cache.rescan()
+        self.assertEqual({i["folder"]: i["last_used"] for i in cache.list()}, last_used)
+
+    def test_evict_lru(self):
+        self.cache.touch("models--org--a")
+        self.assertEqual(self.cache.evict(quota_bytes=2000), ["models--org--b"])
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "models--org--b")))
+        self.assertEqual(self.cache.total_size(), 2000)
+
+    def test_keep_models_in_use(self):
+        self.registry.register("hf/org--a", "http://127.0.0.1:8000/chat")
+        self.assertEqual(self.cache.list()[0]["in_use"], ["http://127.0.0.1:8000/chat"])
+        self.assertEqual(self.cache.evict(quota_bytes=0), ["models--org--b", "models--org--c"])
+        self.assertEqual(self.cache.total_size(), 1000)
+
+    def test_partial(self):
+        self.assertFalse(any(i["partial"] for i in self.cache.list()))
+        model_dir = os.path.join(self.cache_dir, "models--org--b")
+        with open(os.path.join(model_dir, "blobs", "other.incomplete"), "wb") as f:
+            f.write(b"0" * 10)
+        # A download aborted before any file is linked
+        os.makedirs(os.path.join(self.cache_dir, "models--org--d", "snapshots", "rev"))
+        self.cache.rescan()
+        self.assertEqual(
+            {i["folder"]: i["partial"] for i in self.cache.list()},
+            {"models--org--a": False, "models--org--b": True, "models--org--c": False, "models--org--d": True},
+        )
+        self.assertEqual(self.cache.total_size(), 3010)
+        # A broken link
+        os.remove(os.path.join(model_dir, "blobs", "other.incomplete"))
+        os.remove(os.path.join(model_dir, "blobs", "blob"))
+        self.cache.refresh("models--org--b")
+        self.assertTrue(self.cache.list()[1]["partial"])
+
+    def test_no_quota(self):
+        self.assertEqual(self.cache.evict(), [])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,228 @@
+import unittest
+import logging
+import threading
+from kuwa.kernel.registry import ExecutorRegistry
+
+
+class TestExecutorRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = ExecutorRegistry()
+        self.registry.register("a", "http://127.0.0.1:8000/chat")
+        self.registry.register("a", "http://127.0.0.1:8001/chat")
+
+    def test_register_duplicated(self):
+        self.assertFalse(self.registry.register("a", "http://127.0.0.1:8000/chat"))
+        self.assertEqual(len(self.registry.snapshot()["a"]), 2)
+
+    def test_schedule(self):
+        self.assertEqual(self.registry.schedule("a", "1", "1"), "READY")
+        self.assertEqual(self.registry.schedule("a", "2", "1"), "READY")
+        self.assertEqual(self.registry.schedule("a", "3", "1"), "BUSY")
+        self.assertEqual(self.registry.schedule("b", "1", "1"), "NOMACHINE")
+
+    def test_schedule_idempotent(self):
+        self.assertEqual(self.registry.schedule("a", "1", "1"), "READY")
+        self.assertEqual(self.registry.schedule("a", "1", "1"), "READY")
+        self.assertEqual(self.registry.schedule("a", "2", "1"), "READY")
+
+    def test_acquire_and_release(self):
+        self.registry.schedule("a", "1", "1")
+        self.assertIsNone(self.registry.acquire("a", "2", "1"))
+        slot = self.registry.acquire("a", "1", "1")
+        self.assertEqual(slot[1:], ["BUSY", "1", "1"])
+        self.assertIsNone(self.registry.acquire("a", "1", "1"))
+        self.assertFalse(self.registry.release(slot, "2", "1"))
+        self.assertTrue(self.registry.release(slot, "1", "1"))
+        self.assertEqual(slot[1:], ["READY", -1, -1])
+        self.assertIsNone(self.registry.lookup("a", "1", "1"))
+
+    def test_request_id(self):
+        self.registry.schedule("a", "1", "1")
+        slot = self.registry.acquire("a", "1", "1")
+        # Assigned at the reservation, before the executor is called
+        request_id = self.registry.request_id_of(slot)
+        self.assertIsNotNone(request_id)
+        self.assertFalse(self.registry.attach(slot, "2", "1", "r1"))
+        self.assertEqual(self.registry.request_id_of(slot), request_id)
+        self.assertTrue(self.registry.attach(slot, "1", "1", "r1"))
+        self.assertEqual(self.registry.request_id_of(slot), "r1")
+        self.registry.release(slot, "1", "1")
+        self.assertIsNone(self.registry.request_id_of(slot))
+
+    def test_find_jobs(self):
+        self.registry.schedule("a", "1", "1")
+        self.registry.schedule("a", "2", "1")
+        self.assertEqual(len(self.registry.find_jobs([1, 2, 3], "1")), 2)
+        self.assertEqual(len(self.registry.find_jobs([1, 2], "2")), 0)
+
+    def test_job_on_access_codes(self):
+        self.registry.register("b", "http://127.0.0.1:8002/chat")
+        self.registry.schedule("a", "1", "1")
+        self.registry.schedule("b", "1", "1")
+        slots = [self.registry.acquire(i, "1", "1") for i in ("a", "b")]
+        self.assertEqual([i[0] for i in slots], ["http://127.0.0.1:8000/chat", "http://127.0.0.1:8002/chat"])
+        self.assertEqual(sorted(i[0] for i in self.registry.find_jobs([1], "1")), [i[0] for i in slots])
+        self.assertNotEqual(self.registry.request_id_of(slots[0]), self.registry.request_id_of(slots[1]))
+        self.assertTrue(self.registry.release(slots[0], "1", "1"))
+        self.assertIsNone(self.registry.lookup("a", "1", "1"))
+        self.assertIs(self.registry.lookup("b", "1", "1"), slots[1])
+        self.assertEqual(self.registry.find_jobs([1], "1"), [slots[1]])
+
+    def test_resize(self):
+        self.assertFalse(self.registry.resize("a", "http://127.0.0.1:9000/chat", 2))
+        self.assertTrue(self.registry.resize("a", "http://127.0.0.1:8000/chat", 3))
+        self.assertEqual(self.registry.load_of("a", "http://127.0.0.1:8000/chat"), (0, 3))
+        for i in range(3):
+            self.assertEqual(self.registry.schedule("a", str(i), "1", endpoint="http://127.0.0.1:8000/chat"), "READY")
+        # The busy slots are removed once released
+        self.assertTrue(self.registry.resize("a", "http://127.0.0.1:8000/chat", 1))
+        self.assertEqual(self.registry.schedule("a", "3", "1", endpoint="http://127.0.0.1:8000/chat"), "BUSY")
+        for i in range(2):
+            self.assertTrue(self.registry.release(self.registry.lookup("a", str(i), "1"), str(i), "1"))
+        self.assertEqual(self.registry.load_of("a", "http://127.0.0.1:8000/chat"), (1, 1))
+        self.assertTrue(self.registry.release(self.registry.lookup("a", "2", "1"), "2", "1"))
+        self.assertEqual(self.registry.load_of("a", "http://127.0.0.1:8000/chat"), (0, 1))
+
+    def test_unregister(self):
+        self.registry.schedule("a", "1", "1")
+        removed = self.registry.unregister("a", lambda endpoint: endpoint.endswith(":8000/chat"))
+        self.assertEqual(len(removed), 1)
+        self.assertIsNone(self.registry.lookup("a", "1", "1"))
+        self.assertEqual(self.registry.schedule("a", "2", "1"), "READY")
+        self.registry.unregister("a", lambda endpoint: True)
+        self.assertNotIn("a", self.registry)
+
+    def test_load(self):
+        self.registry.load({"b": [["http://127.0.0.1:8002/chat", "READY", "1", "1"]]})
+        self.assertEqual(self.registry.access_codes(), ["a", "b"])
+        self.assertIsNotNone(self.registry.lookup("b", 1, 1))
+        self.registry.load({"a": []})
+        self.assertEqual(self.registry.access_codes(), ["b"])
+
+
+class TestMultiSlotExecutor(unittest.TestCase):
+    def setUp(self):
+        self.registry = ExecutorRegistry()
+        self.registry.register("a", "http://127.0.0.1:8000/chat", capacity=3)
+        self.registry.register("a", "http://127.0.0.1:8001/chat", capacity=2)
+
+    def test_capacity(self):
+        for i in range(5):
+            self.assertEqual(self.registry.schedule("a", str(i), "1"), "READY")
+        self.assertEqual(self.registry.schedule("a", "5", "1"), "BUSY")
+        self.assertEqual(self.registry.load_of("a", "http://127.0.0.1:8000/chat"), (3, 3))
+        self.assertEqual(self.registry.load_of("a", "http://127.0.0.1:8001/chat"), (2, 2))
+
+    def test_least_loaded(self):
+        endpoints = []
+        for i in range(4):
+            self.registry.schedule("a", str(i), "1")
+            endpoints.append(self.registry.lookup("a", str(i), "1")[0])
+        self.assertEqual(endpoints.count("http://127.0.0.1:8000/chat"), 2)
+        self.assertEqual(endpoints.count("http://127.0.0.1:8001/chat"), 2)
+
+    def test_unregister_all_slots(self):
+        self.registry.schedule("a", "1", "1")
+        self.registry.unregister("a", lambda endpoint: endpoint.endswith(":8000/chat"))
+        self.assertEqual(len(self.registry.snapshot()["a"]), 2)
+        self.assertEqual(self.registry.load_of("a", "http://127.0.0.1:8000/chat"), (0, 0))
+
+
+class TestAdmissionQueue(unittest.TestCase):
+    def setUp(self):
+        self.registry = ExecutorRegistry()
+        self.registry.register("a", "http://127.0.0.1:8000/chat")
+        self.registry.schedule("a", "1", "1")
+        self.slot = self.registry.acquire("a", "1", "1")
+
+    def test_timeout(self):
+        self.assertEqual(self.registry.wait("a", "2", "1", timeout=0.01), "BUSY")
+        self.assertEqual(self.registry.queue_status("a")["length"], 0)
+
+    def test_fifo(self):
+        first = self.registry.enqueue("a", "2", "1")
+        second = self.registry.enqueue("a", "3", "1")
+        self.assertEqual(self.registry.queue_status("a", "3", "1")["position"], 2)
+        self.registry.release(self.slot, "1", "1")
+        self.assertEqual(self.registry.dequeue(first), "READY")
+        self.assertEqual(self.registry.dequeue(second), "BUSY")
+        self.assertIsNotNone(self.registry.lookup("a", "2", "1"))
+        self.assertEqual(self.registry.queue_status("a")["length"], 0)
+
+    def test_wait_until_released(self):
+        timer = threading.Timer(0.05, self.registry.release, args=(self.slot, "1", "1"))
+        timer.start()
+        self.assertEqual(self.registry.wait("a", "2", "1", timeout=5), "READY")
+        timer.join()
+
+    def test_expire_reservations(self):
+        self.registry.release(self.slot, "1", "1")
+        self.assertEqual(self.registry.schedule("a", "2", "1"), "READY")
+        self.assertEqual(self.registry.expire_reservations(60), 0)
+        self.assertEqual(self.registry.expire_reservations(0), 1)
+        self.assertIsNone(self.registry.acquire("a", "2", "1"))
+        self.assertEqual(self.registry.schedule("a", "3", "1"), "READY")
+        self.registry.acquire("a", "3", "1")
+        self.assertEqual(self.registry.expire_reservations(0), 0)
+
+    def test_release_twice(self):
+        waiter = self.registry.enqueue("a", "2", "1")
+        self.assertTrue(self.registry.release(self.slot, "1", "1"))
+        self.assertEqual(self.registry.dequeue(waiter), "READY")
+        # The second release of the previous job keeps the reservation of the waiter
+        self.assertFalse(self.registry.release(self.slot, "1", "1"))
+        self.assertEqual(self.registry.acquire("a", "2", "1"), self.slot)
+
+    def test_unregister_wakes_waiters(self):
+        waiter = self.registry.enqueue("a", "2", "1")
+        self.registry.unregister("a", lambda endpoint: True)
+        self.assertEqual(self.registry.dequeue(waiter), "NOMACHINE")
+
+class TestSessionAffinity(unittest.TestCase):
+    def setUp(self):
+        self.registry = ExecutorRegistry()
+        self.registry.register("a", "http://e1", capacity=1)
+        self.registry.register("a", "http://e2", capacity=1)
+
+    def _serve(self, history_id, session, **kwargs):
+        self.assertEqual(self.registry.schedule("a", history_id, "1", session, **kwargs), "READY")
+        slot = self.registry.acquire("a", history_id, "1")
+        self.registry.release(slot, history_id, "1")
+        return slot[0]
+
+    def test_prefer_previous_endpoint(self):
+        endpoint = self._serve("1", "s")
+        for history_id in ("2", "3", "4"):
+            self.assertEqual(self._serve(history_id, "s"), endpoint)
+
+    def test_fallback_when_busy(self):
+        endpoint = self._serve("1", "s")
+        self.assertEqual(self.registry.schedule("a", "2", "1", endpoint=endpoint), "READY")
+        self.assertNotEqual(self._serve("3", "s"), endpoint)
+
+    def test_wait_for_preferred_endpoint(self):
+        endpoint = self._serve("1", "s")
+        self.registry.schedule("a", "2", "1", endpoint=endpoint)
+        busy = self.registry.acquire("a", "2", "1")
+        waiter = self.registry.enqueue("a", "3", "1", "s", affinity=True)
+        self.assertEqual(waiter.preferred, endpoint)
+        self.registry.release(busy, "2", "1")
+        self.assertEqual(self.registry.dequeue(waiter), "READY")
+        self.assertEqual(self.registry.lookup("a", "3", "1")[0], endpoint)
+
+    def test_relax(self):
+        endpoint = self._serve("1", "s")
+        self.registry.schedule("a", "2", "1", endpoint=endpoint)
+        self.assertEqual(self.registry.wait("a", "3", "1", timeout=5, session="s", affinity_wait=0.01), "READY")
+        self.assertNotEqual(self.registry.lookup("a", "3", "1")[0], endpoint)
+
+    def test_bounded_table(self):
+        self.registry.affinity_table_size = 2
+        for history_id in ("1", "2", "3"):
+            self._serve(history_id, history_id)
+        self.assertEqual(len(self.registry._affinity), 2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,131 @@
+import json
+import unittest
+import logging
+from kuwa.kernel.safety_middleware import safety_middleware
+from kuwa.kernel.variable import data
+
+
+class PassThroughGuard:
+    """
+    A guard that counts its instances and forwards the history to the backend,
+    optionally masking the messages. The at_exit callback is consumed by the guard.
+    """
+    instances = 0
+
+    def __init__(self, n_max_buffer, streaming, mask=False):
+        PassThroughGuard.instances += 1
+        self.mask = mask
+
+    def guard(self, func):
+        def wrap(chat_history, model_id, *args, at_exit=None, **kwargs):
+            if self.mask:
+                chat_history = [{**r, 'content': '***'} for r in chat_history]
+            return func(chat_history, model_id, *args, **kwargs)
+        return wrap
+
+
+class MaskingGuard(PassThroughGuard):
+    def __init__(self, n_max_buffer, streaming):
+        super().__init__(n_max_buffer, streaming, mask=True)
+
+
+class BlockingGuard(PassThroughGuard):
+    """
+    A guard blocking every request by the pre-filter, so the backend never runs.
+    """
+
+    def guard(self, func):
+        def wrap(chat_history, model_id, *args, at_exit=None, **kwargs):
+            at_exit()
+            def event_stream():
+                yield "blocked"
+            return event_stream(), {'Content-Type': 'text/plain'}
+        return wrap
+
+
+class TestSafetyMiddleware(unittest.TestCase):
+    history = json.dumps([{"isbot": False, "msg": "hi"}, {"isbot": True, "msg": "hello"}])
+
+    def setUp(self):
+        PassThroughGuard.instances = 0
+        self.forms = []
+
+    def backend(self, form: dict, headers: dict, dest: list, decode: bool = False):
+        self.forms.append(form)
+        self.assertTrue(decode)
+        def event_stream():
+            yield "a"
+            yield "b"
+        return event_stream(), {'Content-Type': 'text/plain'}
+
+    def request(self, completions_backend, form):
+        stream, headers = completions_backend(form=form, headers={}, dest=["http://e1", "a", "1", "1"])
+        return "".join(stream)
+
+    def test_reuse_guard(self):
+        completions_backend = safety_middleware(self.backend, pool_size=2, guard_class=PassThroughGuard)
+        for _ in range(3):
+            self.assertEqual(self.request(completions_backend, {"name": "a", "input": self.history}), "ab")
+        self.assertEqual(PassThroughGuard.instances, 1)
+
+    def test_release_on_close(self):
+        completions_backend = safety_middleware(self.backend, pool_size=2, guard_class=PassThroughGuard)
+        form = {"name": "a", "input": self.history}
+        stream, _ = completions_backend(form=form, headers={}, dest=["http://e1", "a", "1", "1"])
+        self.assertEqual(completions_backend.pool.idle, [])
+        next(stream)
+        stream.close()
+        self.assertEqual(len(completions_backend.pool.idle), 1)
+
+    def test_bounded_pool(self):
+        completions_backend = safety_middleware(self.backend, pool_size=1, guard_class=PassThroughGuard)
+        form = {"name": "a", "input": self.history}
+        streams = [completions_backend(form=form, headers={}, dest=[])[0] for _ in range(3)]
+        for stream in streams:
+            list(stream)
+        self.assertEqual(PassThroughGuard.instances, 3)
+        self.assertEqual(len(completions_backend.pool.idle), 1)
+
+    def test_forward_original_form(self):
+        completions_backend = safety_middleware(self.backend, guard_class=PassThroughGuard)
+        form = {"name": "a", "input": self.history, "user_id": "1"}
+        self.request(completions_backend, form)
+        self.assertIs(self.forms[0], form)
+
+    def test_convert_modified_history(self):
+        completions_backend = safety_middleware(self.backend, guard_class=MaskingGuard)
+        form = {"name": "a", "input": self.history, "user_id": "1"}
+        self.request(completions_backend, form)
+        self.assertEqual(self.forms[0]["user_id"], "1")
+        self.assertEqual(
+            json.loads(self.forms[0]["input"]),
+            [{"isbot": False, "msg": "***"}, {"isbot": True, "msg": "***"}]
+        )
+
+    def test_release_blocked(self):
+        completions_backend = safety_middleware(self.backend, guard_class=BlockingGuard)
+        data.register("blocked", "http://127.0.0.1:1/chat")
+        try:
+            self.assertEqual(data.schedule("blocked", "1", "1"), "READY")
+            dest = data.acquire("blocked", "1", "1")
+            form = {"name": "blocked", "input": self.history, "history_id": "1", "user_id": "1"}
+            stream, _ = completions_backend(form=form, headers={}, dest=dest)
+            self.assertEqual("".join(stream), "blocked")
+            self.assertEqual(self.forms, [])
+            self.assertTrue(data.is_free(dest))
+            self.assertEqual(data.schedule("blocked", "2", "1"), "READY")
+        finally:
+            data.unregister("blocked", lambda endpoint: True)
+
+    def test_invalidate(self):
+        completions_backend = safety_middleware(self.backend, pool_size=2, guard_class=PassThroughGuard)
+        completions_backend.pool.fill()
+        self.assertEqual(PassThroughGuard.instances, 2)
+        completions_backend.pool.invalidate()
+        self.request(completions_backend, {"name": "a", "input": self.history})
+        self.assertEqual(PassThroughGuard.instances, 3)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+import logging
+from kuwa.kernel.functions import SSEFrameAligner, is_event_stream
+
+
+class TestSSEFrameAligner(unittest.TestCase):
+    def test_pass_through_whole_frames(self):
+        aligner = SSEFrameAligner()
+        chunk = b"data: a\ndata: b\n"
+        self.assertIs(aligner.feed(chunk), chunk)
+        self.assertEqual(aligner.flush(), b"")
+
+    def test_hold_partial_frame(self):
+        aligner = SSEFrameAligner()
+        self.assertEqual(aligner.feed(b"data: a\ndata: "), b"data: a\n")
+        self.assertEqual(aligner.feed(b"\xe4\xbd"), b"")
+        self.assertEqual(aligner.feed(b"\xa0\r\n\r\ndata: c"), "data: 你\r\n\r\n".encode("utf-8"))
+        self.assertEqual(aligner.flush(), b"data: c")
+
+    def test_max_buffer(self):
+        aligner = SSEFrameAligner(max_buffer=8)
+        self.assertEqual(aligner.feed(b"data: "), b"")
+        self.assertEqual(aligner.feed(b"abc"), b"data: abc")
+
+    def test_is_event_stream(self):
+        self.assertTrue(is_event_stream("text/event-stream; charset=utf-8"))
+        self.assertFalse(is_event_stream("text/plain"))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import unittest
+import logging
+import tempfile
+from kuwa.kernel.store import RegistryStore
+
+
+class TestRegistryStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, "records.db")
+        self.store = RegistryStore(self.filename)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp_dir.cleanup()
+
+    def test_add_and_remove(self):
+        self.assertTrue(self.store.is_empty())
+        self.store.add("a", "http://127.0.0.1:8000/chat", 2)
+        self.store.add("a", "http://127.0.0.1:8001/chat")
+        self.store.add("b", "http://127.0.0.1:8000/chat")
+        self.store.remove("a", "http://127.0.0.1:8001/chat")
+        self.assertEqual(self.store.load(), {
+            "a": [["http://127.0.0.1:8000/chat", "READY", -1, -1]] * 2,
+            "b": [["http://127.0.0.1:8000/chat", "READY", -1, -1]],
+        })
+
+    def test_replace(self):
+        self.store.add("a", "http://127.0.0.1:8000/chat")
+        self.store.add("b", "http://127.0.0.1:8001/chat")
+        self.store.replace({"a": {"http://127.0.0.1:8002/chat": 1}, "c": {}})
+        self.assertEqual(self.store.load(), {
+            "a": [["http://127.0.0.1:8002/chat", "READY", -1, -1]],
+            "b": [["http://127.0.0.1:8001/chat", "READY", -1, -1]],
+        })
+
+    def test_recovery(self):
+        self.store.add("a", "http://127.0.0.1:8000/chat")
+        # Reopen without checkpointing the write-ahead log.
+        store = RegistryStore(self.filename)
+        self.assertEqual(list(store.load().keys()), ["a"])
+        store.close()
+
+    def test_import_records(self):
+        self.store.import_records({"a": [
+            ["http://127.0.0.1:8000/chat", "BUSY", "1", "1"],
+            ["http://127.0.0.1:8000/chat", "READY", -1, -1],
+        ]})
+        self.store.compact()
+        self.assertEqual(self.store.load(), {"a": [["http://127.0.0.1:8000/chat", "READY", -1, -1]] * 2})
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()